@@ -0,0 +1,151 @@
+import sys
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.units import inch
+from reportlab.pdfgen import canvas
+from reportlab.graphics.barcode import code128
+
+try:
+    from pypdf import PdfWriter  # optional: merges parts rendered in parallel
+except ImportError:
+    PdfWriter = None
+
+# Label sheet generator. store.py writes a JSON job and runs this file as its own
+# process, so the worker pool never re-imports the GUI (spawn on Windows re-runs
+# the main module of every child):
+#
+#   python labels.py job.json
+#
+# job = {"output": "labels.pdf", "labels": [[sku, name, price], ...]}, price as text ("12.50")
+# Prints {"files": [...]} with the PDF(s) written.
+
+# Letter sheet, 3 x 10 labels of 2.625" x 1" (Avery 5160 layout)
+LABEL_COLUMNS = 3
+LABEL_ROWS = 10
+LABEL_WIDTH = 2.625 * inch
+LABEL_HEIGHT = 1 * inch
+LABEL_GAP_X = 0.125 * inch
+MARGIN_LEFT = 0.1875 * inch
+MARGIN_TOP = 0.5 * inch
+LABELS_PER_PAGE = LABEL_COLUMNS * LABEL_ROWS
+
+PAGES_PER_PART = 25  # pages handed to one worker at a time
+
+# EAN-13 digit patterns; R is the complement of L and G is R reversed
+EAN_L = ["0001101", "0011001", "0010011", "0111101", "0100011",
+         "0110001", "0101111", "0111011", "0110111", "0001011"]
+EAN_R = ["".join("1" if bit == "0" else "0" for bit in code) for code in EAN_L]
+EAN_G = [code[::-1] for code in EAN_R]
+EAN_PARITY = ["LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG",
+              "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL"]
+EAN_MODULE = 0.013 * inch
+BAR_HEIGHT = 0.42 * inch
+
+def ean13_check_digit(first12):
+    digits = [int(d) for d in first12]
+    total = sum(digits[0::2]) + 3 * sum(digits[1::2])
+    return str((10 - total % 10) % 10)
+
+def draw_ean13(c_pdf, x, y, code):
+    # Bars are drawn straight onto the canvas; the graphics/Drawing path costs
+    # ~10ms a label, which dominates large runs
+    left = "".join((EAN_L if parity == "L" else EAN_G)[int(d)]
+                   for parity, d in zip(EAN_PARITY[int(code[0])], code[1:7]))
+    right = "".join(EAN_R[int(d)] for d in code[7:])
+    bits = "101" + left + "01010" + right + "101"
+    guards = set(range(3)) | set(range(45, 50)) | set(range(92, 95))
+    text_height = 7
+    x0 = x + 7 * EAN_MODULE  # room for the leading digit
+    position = 0
+    while position < len(bits):
+        if bits[position] == "1":
+            end = position
+            while end < len(bits) and bits[end] == "1":
+                end += 1
+            extra = text_height / 2 if position in guards else 0
+            c_pdf.rect(x0 + position * EAN_MODULE, y + text_height - extra,
+                       (end - position) * EAN_MODULE, BAR_HEIGHT + extra, stroke=0, fill=1)
+            position = end
+        else:
+            position += 1
+    c_pdf.setFont("Helvetica", 7)
+    c_pdf.drawString(x, y, code[0])
+    c_pdf.drawCentredString(x0 + 24 * EAN_MODULE, y, code[1:7])
+    c_pdf.drawCentredString(x0 + 71 * EAN_MODULE, y, code[7:])
+
+def draw_barcode(c_pdf, x, y, sku):
+    # EAN-13 for retail codes (12 digits get their check digit added), Code128 for the rest
+    if sku.isdigit() and len(sku) == 12:
+        sku += ean13_check_digit(sku)
+    if sku.isdigit() and len(sku) == 13 and ean13_check_digit(sku[:12]) == sku[12]:
+        draw_ean13(c_pdf, x, y, sku)
+        return
+    barcode = code128.Code128(sku, barHeight=BAR_HEIGHT, barWidth=0.01 * inch,
+                              humanReadable=True, quiet=False)
+    # Shrink long codes to fit the label
+    max_width = LABEL_WIDTH - 12
+    if barcode.width > max_width:
+        barcode = code128.Code128(sku, barHeight=BAR_HEIGHT, barWidth=0.01 * inch * max_width / barcode.width,
+                                  humanReadable=True, quiet=False)
+    barcode.drawOn(c_pdf, x, y + 2)
+
+def draw_label(c_pdf, x, y, sku, name, price):
+    # x, y is the bottom-left corner of the label
+    c_pdf.setFont("Helvetica-Bold", 8)
+    c_pdf.drawString(x + 6, y + LABEL_HEIGHT - 11, name[:38])
+    c_pdf.setFont("Helvetica-Bold", 11)
+    c_pdf.drawRightString(x + LABEL_WIDTH - 6, y + LABEL_HEIGHT - 24, f"${price}")
+    draw_barcode(c_pdf, x + 6, y + 4, sku)
+
+def draw_labels(c_pdf, labels):
+    width, height = letter
+    for index, (sku, name, price) in enumerate(labels):
+        slot = index % LABELS_PER_PAGE
+        if index and slot == 0:
+            c_pdf.showPage()
+        column, row = slot % LABEL_COLUMNS, slot // LABEL_COLUMNS
+        x = MARGIN_LEFT + column * (LABEL_WIDTH + LABEL_GAP_X)
+        y = height - MARGIN_TOP - (row + 1) * LABEL_HEIGHT
+        draw_label(c_pdf, x, y, str(sku), str(name), str(price))
+
+def render_part(args):
+    # Runs in a worker process (or in this one): renders a slice of labels to one PDF
+    path, labels = args
+    c_pdf = canvas.Canvas(path, pagesize=letter)
+    draw_labels(c_pdf, labels)
+    c_pdf.save()
+    return path
+
+def render_labels(output, labels, workers=None):
+    # Splits the labels into whole-page parts, renders them in parallel and merges
+    # them in order. Without pypdf there is no merging, so every page is drawn on
+    # one canvas here instead; the output is the same single file, only slower.
+    chunk = LABELS_PER_PAGE * PAGES_PER_PART
+    base, ext = os.path.splitext(output)
+    parts = [(f"{base}_part{number:03d}{ext or '.pdf'}", labels[start:start + chunk])
+             for number, start in enumerate(range(0, len(labels), chunk), start=1)]
+    if not parts:
+        return []
+    if len(parts) == 1 or PdfWriter is None:
+        return [render_part((output, labels))]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        part_files = list(pool.map(render_part, parts))
+
+    writer = PdfWriter()
+    for part_file in part_files:
+        writer.append(part_file)
+    with open(output, "wb") as f:
+        writer.write(f)
+    writer.close()
+    for part_file in part_files:
+        os.remove(part_file)
+    return [output]
+
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8") as f:
+        job = json.load(f)
+    files = render_labels(job["output"], job["labels"], job.get("workers"))
+    print(json.dumps({"files": files}))
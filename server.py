@@ -1,15 +1,213 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import urllib.parse
+import urllib.request
+import threading
+import json
+import os
+import time
+import uuid
+
+# Always-on scan relay. Scanners send their scans here instead of to the register;
+# every scan is appended to an on-disk queue and fsynced before it is answered, and a forwarder
+# thread delivers the queue in batches to the register's POST /relay. The register
+# answers with the highest sequence number it has taken, and only then is the queue
+# advanced, so scans survive the register (or this relay) restarting.
+#
+#   GET  /?code=<sku>[&scanner=<name>][&scan_id=<id>]   one scan (same as the register)
+#   POST /scans  [{"code": ..., "scanner": ..., "scan_id": ...}, ...]   many scans
+RELAY_PORT = 8090
+REGISTER_URL = "http://127.0.0.1:8080/relay"
+RELAY_DIR = "relay"
+QUEUE_PATH = os.path.join(RELAY_DIR, "queue.log")
+STATE_PATH = os.path.join(RELAY_DIR, "state.json")
+BATCH_SIZE = 500
+FSYNC_INTERVAL = 0.05  # seconds; appends are fsynced in groups and answered once synced
+ROTATE_BYTES = 16 * 1024 * 1024  # start the file over once everything in it is acknowledged
+RETRY_MAX_SECONDS = 5
+
+queue_lock = threading.Condition()
+queue_file = None
+next_seq = 1
+needs_fsync = False
+synced_seq = 0  # highest seq known to be fsynced
+# relay_id: identifies this queue to the register; acked: last acknowledged seq;
+# offset: byte position of the first unacknowledged line
+state = None
+
+def save_state():
+    # Atomic replace so a crash leaves either the old or the new state
+    tmp_path = STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, STATE_PATH)
+
+def open_queue():
+    global queue_file, next_seq, synced_seq, state
+    os.makedirs(RELAY_DIR, exist_ok=True)
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH) as f:
+            state = json.load(f)
+    else:
+        # A new relay id starts the register's numbering over. Anything already in a
+        # queue without state cannot be told apart from delivered scans, so it is skipped.
+        existing = os.path.getsize(QUEUE_PATH) if os.path.exists(QUEUE_PATH) else 0
+        state = {'relay_id': uuid.uuid4().hex, 'acked': 0, 'offset': existing}
+        save_state()
+
+    # Find the last sequence number; a torn final line from a crash is cut off
+    next_seq = state['acked'] + 1
+    with open(QUEUE_PATH, "a+b") as f:
+        # An offset past the end (file lost or emptied) must not grow the file with zeros
+        f.seek(0, os.SEEK_END)
+        if state['offset'] > f.tell():
+            state['offset'] = f.tell()
+            save_state()
+        f.seek(state['offset'])
+        good_end = state['offset']
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            next_seq = json.loads(line)['seq'] + 1
+            good_end += len(line)
+        f.truncate(good_end)
+    synced_seq = next_seq - 1
+    queue_file = open(QUEUE_PATH, "ab")
+
+def append_scans(scans):
+    # scans are dicts with code, scanner and scan_id; returns once they are fsynced,
+    # so an answered scan survives a power loss as well as a crash
+    global next_seq, needs_fsync
+    with queue_lock:
+        lines = []
+        for scan in scans:
+            scan['seq'] = next_seq
+            next_seq += 1
+            lines.append(json.dumps(scan, separators=(",", ":")))
+        queue_file.write(("\n".join(lines) + "\n").encode("utf-8"))
+        queue_file.flush()
+        needs_fsync = True
+        queue_lock.notify_all()
+        last_seq = next_seq - 1
+        while synced_seq < last_seq:
+            queue_lock.wait()
+
+def fsync_worker():
+    global needs_fsync, synced_seq
+    while True:
+        time.sleep(FSYNC_INTERVAL)
+        with queue_lock:
+            if not needs_fsync:
+                continue
+            needs_fsync = False
+            fileno = queue_file.fileno()
+            written_seq = next_seq - 1
+        os.fsync(fileno)
+        with queue_lock:
+            synced_seq = max(synced_seq, written_seq)
+            queue_lock.notify_all()
+
+def read_batch(reader):
+    # Complete lines after the acknowledged offset, as (scan, end_offset) pairs
+    reader.seek(state['offset'])
+    batch = []
+    position = state['offset']
+    while len(batch) < BATCH_SIZE:
+        line = reader.readline()
+        if not line.endswith(b"\n"):
+            break  # nothing more, or a line still being written
+        position += len(line)
+        batch.append((json.loads(line), position))
+    return batch
+
+def forward_batch(scans):
+    # Returns the highest seq the register has taken from this relay
+    body = json.dumps({'relay_id': state['relay_id'], 'scans': scans}).encode("utf-8")
+    request = urllib.request.Request(REGISTER_URL, data=body, method="POST",
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())['acked']
+
+def forward_worker():
+    retry_delay = 0.5
+    with open(QUEUE_PATH, "rb") as reader:
+        while True:
+            with queue_lock:
+                batch = read_batch(reader)
+                if not batch:
+                    queue_lock.wait(timeout=1)
+                    continue
+            try:
+                acked = forward_batch([scan for scan, _ in batch])
+            except Exception as e:
+                print(f"Register not reachable ({e}), retrying...")
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, RETRY_MAX_SECONDS)
+                continue
+            retry_delay = 0.5
+
+            delivered = [end for scan, end in batch if scan['seq'] <= acked]
+            if not delivered:
+                continue
+            with queue_lock:
+                state['acked'] = acked
+                state['offset'] = delivered[-1]
+                rotate = state['offset'] >= ROTATE_BYTES and state['offset'] == queue_file.tell()
+                if rotate:
+                    # Everything written so far is acknowledged: start the file over. The
+                    # state is saved first; a crash before the truncate only means the
+                    # acknowledged lines are sent again, and the register skips them.
+                    state['offset'] = 0
+                save_state()
+                if rotate:
+                    queue_file.truncate(0)
 
 class BarcodeHandler(BaseHTTPRequestHandler):
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
         query = urllib.parse.urlparse(self.path).query
-        if("code="in query and "http" not in query):
-            print(f"Received Barcode: {query[5:]}")
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Barcode Received")
+        if "code=" in query and "http" not in query:
+            params = urllib.parse.parse_qs(query)
+            # "code=" also matches e.g. ?barcode=1, and parse_qs drops blank values
+            code = params.get("code", [""])[0]
+            if code:
+                append_scans([{
+                    'code': code,
+                    'scanner': params.get("scanner", [self.client_address[0]])[0],
+                    'scan_id': params.get("scan_id", [None])[0],
+                }])
+        self.reply(200, b"Barcode Received")
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != "/scans":
+            self.reply(404, b"Not Found")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            scans = [{'code': str(scan['code']),
+                      'scanner': scan.get('scanner') or self.client_address[0],
+                      'scan_id': scan.get('scan_id')}
+                     for scan in json.loads(self.rfile.read(length))]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.reply(400, b"Bad Request")
+            return
+        if scans:
+            append_scans(scans)
+        self.reply(200, f"{len(scans)} Barcodes Received".encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass  # one line per scan would cap throughput
 
-server = HTTPServer(("0.0.0.0", 8080), BarcodeHandler)
-print("Server started on port 8080...")
-server.serve_forever()
+if __name__ == "__main__":
+    open_queue()
+    threading.Thread(target=fsync_worker, daemon=True).start()
+    threading.Thread(target=forward_worker, daemon=True).start()
+    server = ThreadingHTTPServer(("0.0.0.0", RELAY_PORT), BarcodeHandler)
+    print(f"Scan relay started on port {RELAY_PORT}, forwarding to {REGISTER_URL}...")
+    server.serve_forever()
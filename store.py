@@ -1,23 +1,74 @@
 import sqlite3
 import tkinter as tk
 from tkinter import ttk, messagebox
-from datetime import datetime
+from datetime import datetime, timedelta
 from tkinter import simpledialog
 import csv
 from tkinter.ttk import Combobox
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import urllib.parse
 import queue
+import json
+import math
+import os
+import time
+import glob
+import re
+import sys
+import subprocess
+import tempfile
+import io
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from collections import OrderedDict
+from itertools import groupby
 
 from tkinter import filedialog  # for asking the user where to save the file
 import reportlab
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+# ------------------------------------------------------------------------------
+# Money
+# ------------------------------------------------------------------------------
+# Every amount is an int of cents, in the database and in memory. Text is turned
+# into cents once on input (to_cents) and cents into text only for display
+# (format_money / money_text), so sums are exact and can be left to SQLite.
+def to_cents(value):
+    # "12.5", 12.5 or Decimal -> 1250, rounding half away from zero; ValueError if not a number
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Not an amount: {value!r}")
+    if not amount.is_finite():
+        raise ValueError(f"Not an amount: {value!r}")
+    return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def money_text(cents):
+    # 1250 -> "12.50", for entry fields and CSV
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def format_money(cents):
+    # 1250 -> "$12.50", -1250 -> "-$12.50"
+    text = money_text(cents)
+    return f"-${text[1:]}" if text.startswith("-") else f"${text}"
+
+def scale_cents(cents, factor):
+    # Percentage changes and discounts, rounded back to whole cents
+    return int((Decimal(cents) * Decimal(str(factor))).quantize(Decimal(1), rounding=ROUND_HALF_UP))
 
 # Database setup
 conn = sqlite3.connect('inventory.db')
 c = conn.cursor()
+# Takes effect only while the file is still empty, so new databases get incremental
+# vacuum from the start; older ones are converted once by the maintenance worker
+c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+# WAL lets the background readers (reporting copy, schedulers) run alongside sales
+c.execute("PRAGMA journal_mode=WAL")
 
 # Create tables
 # Create table (or modify your table definition) to include wholesale_price
@@ -27,9 +78,9 @@ c.execute('''
         name TEXT NOT NULL,
         sku TEXT UNIQUE,
         stock INTEGER,
-        purchase_price REAL,
-        selling_price REAL,
-        wholesale_price REAL,
+        purchase_price INTEGER,
+        selling_price INTEGER,
+        wholesale_price INTEGER,
         company_id INTEGER,  -- Corrected to INTEGER
         FOREIGN KEY (company_id) REFERENCES companies(company_id)  -- Foreign key
     )
@@ -44,21 +95,370 @@ c.execute('''CREATE TABLE IF NOT EXISTS companies (
 c.execute('''CREATE TABLE IF NOT EXISTS invoices (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 date TEXT NOT NULL,
-                total REAL NOT NULL
+                total INTEGER NOT NULL
             )''')
 
 c.execute('''CREATE TABLE IF NOT EXISTS invoice_items (
                 invoice_id INTEGER,
                 product_id INTEGER,
                 quantity INTEGER,
-                unit_price REAL,
-                total_price REAL,
-                historical_purchase_price REAL,
-                historical_selling_price REAL,
+                unit_price INTEGER,
+                total_price INTEGER,
+                historical_purchase_price INTEGER,
+                historical_selling_price INTEGER,
                 FOREIGN KEY(invoice_id) REFERENCES invoices(id),
                 FOREIGN KEY(product_id) REFERENCES products(id)
             )''')
 
+# Indexes used by the date range reports
+c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date)")
+c.execute("CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id)")
+# Invoice search by product: invoice ids straight from the index
+c.execute("CREATE INDEX IF NOT EXISTS idx_invoice_items_product_invoice ON invoice_items(product_id, invoice_id)")
+
+def add_column_if_missing(table, column, definition):
+    # CREATE TABLE IF NOT EXISTS never alters an existing database, so new columns are added here
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# Reorder settings per company (days between ordering and delivery, plus safety cover)
+add_column_if_missing("companies", "lead_time_days", "INTEGER DEFAULT 7")
+add_column_if_missing("companies", "safety_days", "INTEGER DEFAULT 3")
+
+# Credit notes (returns) are invoices with a negative total pointing at the original sale
+add_column_if_missing("invoices", "refund_of", "INTEGER REFERENCES invoices(id)")
+
+# Promotions: 'quantity_break' (percent off from min_quantity units of a product),
+# 'bundle' (min_quantity units of a product for bundle_price) and 'company_percent'
+# (percent off every product of a company). starts_at/ends_at limit the time window.
+c.execute('''CREATE TABLE IF NOT EXISTS promotions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                product_id INTEGER,
+                company_id INTEGER,
+                min_quantity INTEGER NOT NULL DEFAULT 1,
+                percent REAL NOT NULL DEFAULT 0,
+                bundle_price INTEGER,
+                starts_at TEXT,
+                ends_at TEXT,
+                active INTEGER NOT NULL DEFAULT 1,
+                FOREIGN KEY(product_id) REFERENCES products(id),
+                FOREIGN KEY(company_id) REFERENCES companies(company_id)
+            )''')
+
+# Discount applied to each invoice line and the promotion that gave it
+add_column_if_missing("invoice_items", "discount", "INTEGER DEFAULT 0")
+add_column_if_missing("invoice_items", "promotion_id", "INTEGER")
+
+# Rolling sales velocity per product, kept up to date by submit_invoice
+c.execute('''CREATE TABLE IF NOT EXISTS product_velocity (
+                product_id INTEGER PRIMARY KEY,
+                daily_units REAL NOT NULL DEFAULT 0,
+                last_day TEXT NOT NULL,
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )''')
+
+# Seed the velocities once from the last 28 days of sales
+c.execute("SELECT COUNT(*) FROM product_velocity")
+if c.fetchone()[0] == 0:
+    c.execute('''INSERT INTO product_velocity (product_id, daily_units, last_day)
+                 SELECT ii.product_id, SUM(ii.quantity) / 28.0, DATE('now', 'localtime')
+                 FROM invoice_items ii
+                 JOIN invoices i ON ii.invoice_id = i.id
+                 WHERE i.date >= DATE('now', 'localtime', '-28 days')
+                 GROUP BY ii.product_id''')
+
+# Every change to stock or cost is appended here; snapshots hold the full
+# stock/cost state at a point in the ledger (last_movement_id)
+c.execute('''CREATE TABLE IF NOT EXISTS stock_movements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                moved_at TEXT NOT NULL,
+                quantity_change INTEGER NOT NULL,
+                unit_cost INTEGER,
+                reason TEXT NOT NULL,
+                reference_id INTEGER,
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_moved_at ON stock_movements(moved_at)")
+
+c.execute('''CREATE TABLE IF NOT EXISTS stock_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                taken_at TEXT NOT NULL,
+                last_movement_id INTEGER NOT NULL
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_taken_at ON stock_snapshots(taken_at)")
+
+c.execute('''CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+                snapshot_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                stock INTEGER,
+                purchase_price INTEGER,
+                PRIMARY KEY (snapshot_id, product_id),
+                FOREIGN KEY(snapshot_id) REFERENCES stock_snapshots(id)
+            )''')
+
+# Dated batches of stock. products.stock stays the total; stock that arrived without
+# an expiry is simply not in a lot. Lots without an expiry use '9999-12-31', so
+# ORDER BY expiry puts them last. Only lots with stock left are indexed.
+c.execute('''CREATE TABLE IF NOT EXISTS stock_lots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                expiry TEXT NOT NULL DEFAULT '9999-12-31',
+                quantity INTEGER NOT NULL,
+                unit_cost INTEGER,
+                received_at TEXT NOT NULL,
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_stock_lots_fefo ON stock_lots(product_id, expiry) WHERE quantity > 0")
+c.execute("CREATE INDEX IF NOT EXISTS idx_stock_lots_expiry ON stock_lots(expiry) WHERE quantity > 0")
+
+# Which lots each invoice line was taken from (negative for returns)
+c.execute('''CREATE TABLE IF NOT EXISTS invoice_item_lots (
+                invoice_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                lot_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                FOREIGN KEY(invoice_id) REFERENCES invoices(id),
+                FOREIGN KEY(lot_id) REFERENCES stock_lots(id)
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_invoice_item_lots_invoice ON invoice_item_lots(invoice_id)")
+
+# Append-only record of every price change (manual edits and company-wide percentages)
+c.execute('''CREATE TABLE IF NOT EXISTS price_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                changed_at TEXT NOT NULL,
+                source TEXT NOT NULL,
+                old_purchase_price INTEGER,
+                new_purchase_price INTEGER,
+                old_selling_price INTEGER,
+                new_selling_price INTEGER,
+                old_wholesale_price INTEGER,
+                new_wholesale_price INTEGER,
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_price_history_product_date ON price_history(product_id, changed_at)")
+
+# Physical counts committed from stocktake mode
+c.execute('''CREATE TABLE IF NOT EXISTS stocktakes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TEXT NOT NULL,
+                committed_at TEXT NOT NULL,
+                products_counted INTEGER NOT NULL,
+                net_variance INTEGER NOT NULL
+            )''')
+
+# Small key/value store for application state (e.g. the last daily price run)
+c.execute('''CREATE TABLE IF NOT EXISTS app_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )''')
+
+# Highest scan sequence number taken from each scan relay (server.py), so a relay
+# replaying its queue after a restart never delivers a scan twice
+c.execute('''CREATE TABLE IF NOT EXISTS relay_progress (
+                relay_id TEXT PRIMARY KEY,
+                last_seq INTEGER NOT NULL,
+                updated_at TEXT NOT NULL
+            )''')
+
+# One row per run of the daily company percentage scheduler
+c.execute('''CREATE TABLE IF NOT EXISTS daily_price_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_at TEXT NOT NULL,
+                from_date TEXT NOT NULL,
+                to_date TEXT NOT NULL,
+                days INTEGER NOT NULL,
+                companies INTEGER NOT NULL,
+                products INTEGER NOT NULL
+            )''')
+
+# Per-day sales rollup. It is kept up to date by every sale and also covers
+# the invoices that were moved into the yearly archive databases.
+c.execute('''CREATE TABLE IF NOT EXISTS daily_sales (
+                day TEXT PRIMARY KEY,
+                invoice_count INTEGER NOT NULL DEFAULT 0,
+                revenue INTEGER NOT NULL DEFAULT 0,
+                cost INTEGER NOT NULL DEFAULT 0
+            )''')
+
+c.execute('''CREATE TABLE IF NOT EXISTS purchase_orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                company_id INTEGER,
+                created_at TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'draft',
+                FOREIGN KEY(company_id) REFERENCES companies(company_id)
+            )''')
+
+c.execute('''CREATE TABLE IF NOT EXISTS purchase_order_items (
+                purchase_order_id INTEGER,
+                product_id INTEGER,
+                quantity INTEGER,
+                unit_cost INTEGER,
+                FOREIGN KEY(purchase_order_id) REFERENCES purchase_orders(id),
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )''')
+
+# Supplier deliveries booked in through goods receiving, one row per line as received
+c.execute('''CREATE TABLE IF NOT EXISTS goods_receipts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                received_at TEXT NOT NULL,
+                company_id INTEGER,
+                purchase_order_id INTEGER,
+                reference TEXT,
+                line_count INTEGER NOT NULL,
+                total_cost INTEGER NOT NULL,
+                FOREIGN KEY(company_id) REFERENCES companies(company_id),
+                FOREIGN KEY(purchase_order_id) REFERENCES purchase_orders(id)
+            )''')
+
+c.execute('''CREATE TABLE IF NOT EXISTS goods_receipt_items (
+                receipt_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                unit_cost INTEGER NOT NULL,
+                expiry TEXT,
+                FOREIGN KEY(receipt_id) REFERENCES goods_receipts(id),
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_goods_receipt_items_receipt ON goods_receipt_items(receipt_id)")
+
+# Results of the idle-time database maintenance, with the file size after each run
+c.execute('''CREATE TABLE IF NOT EXISTS maintenance_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_at TEXT NOT NULL,
+                task TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                file_bytes INTEGER NOT NULL,
+                page_count INTEGER NOT NULL,
+                freelist_count INTEGER NOT NULL,
+                result TEXT
+            )''')
+
+# Shop-to-shop sync (sync.py). Every shop has a random id; invoices imported from
+# another shop remember where they came from.
+c.execute("INSERT OR IGNORE INTO app_settings (key, value) VALUES ('shop_id', lower(hex(randomblob(16))))")
+add_column_if_missing("invoices", "origin_shop", "TEXT")
+add_column_if_missing("invoices", "origin_id", "INTEGER")
+c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_origin ON invoices(origin_shop, origin_id)")
+
+c.execute('''CREATE TABLE IF NOT EXISTS sync_peers (
+                peer_id TEXT PRIMARY KEY,
+                acked_seq INTEGER NOT NULL DEFAULT 0,
+                exported_seq INTEGER NOT NULL DEFAULT 0,
+                imported_seq INTEGER NOT NULL DEFAULT 0,
+                last_sync TEXT
+            )''')
+
+# Stock is never overwritten by a peer; their latest figures are kept here
+c.execute('''CREATE TABLE IF NOT EXISTS peer_stock (
+                peer_id TEXT NOT NULL,
+                sku TEXT NOT NULL,
+                stock INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (peer_id, sku)
+            )''')
+
+# Change log: one row per insert/update, numbered by seq. Only kept while there are
+# peers, and not while sync.py is applying a peer's changes (a row in sync_applying),
+# so imported changes are never sent back.
+c.execute('''CREATE TABLE IF NOT EXISTS change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                changed_at TEXT NOT NULL
+            )''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log(table_name, row_id)")
+c.execute("CREATE TABLE IF NOT EXISTS sync_applying (applying INTEGER)")
+
+# invoice_items changes are logged against their invoice, which is shipped whole
+for table, key, logged_as in (("products", "id", "products"), ("companies", "company_id", "companies"),
+                              ("invoices", "id", "invoices"), ("invoice_items", "invoice_id", "invoices")):
+    for op in ("insert", "update"):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS change_log_{table}_{op}
+                      AFTER {op.upper()} ON {table}
+                      WHEN EXISTS (SELECT 1 FROM sync_peers) AND NOT EXISTS (SELECT 1 FROM sync_applying)
+                      BEGIN
+                          INSERT INTO change_log (table_name, row_id, op, changed_at)
+                          VALUES ('{logged_as}', NEW.{key}, '{op}', datetime('now', 'localtime'));
+                      END''')
+
+# Money columns hold integer cents. Databases from before that have REAL columns:
+# each such table is rebuilt once with INTEGER columns and its amounts converted.
+MONEY_COLUMNS = {
+    'products': ('purchase_price', 'selling_price', 'wholesale_price'),
+    'invoices': ('total',),
+    'invoice_items': ('unit_price', 'total_price', 'historical_purchase_price',
+                      'historical_selling_price', 'discount'),
+    'promotions': ('bundle_price',),
+    'stock_movements': ('unit_cost',),
+    'stock_snapshot_items': ('purchase_price',),
+    'price_history': ('old_purchase_price', 'new_purchase_price', 'old_selling_price',
+                      'new_selling_price', 'old_wholesale_price', 'new_wholesale_price'),
+    'daily_sales': ('revenue', 'cost'),
+    'purchase_order_items': ('unit_cost',),
+}
+
+def migrate_money_columns(cur, schema='main'):
+    for table, money_columns in MONEY_COLUMNS.items():
+        cur.execute(f"PRAGMA {schema}.table_info({table})")
+        columns = [(row[1], row[2].upper()) for row in cur.fetchall()]
+        if not any(name in money_columns and declared_type == 'REAL' for name, declared_type in columns):
+            continue
+        # One transaction per table, so an interrupted migration leaves it untouched
+        cur.connection.commit()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            rebuild_money_table(cur, schema, table, money_columns, columns)
+            cur.connection.commit()
+        except Exception:
+            cur.connection.rollback()
+            raise
+
+def rebuild_money_table(cur, schema, table, money_columns, columns):
+    # Standard SQLite rebuild: new table, copy, drop, rename
+    cur.execute(f"SELECT sql FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    table_sql = cur.fetchone()[0]
+    for column in money_columns:
+        table_sql = re.sub(rf"(\b{column}\s+)REAL\b", r"\1INTEGER", table_sql, flags=re.IGNORECASE)
+    table_sql = re.sub(rf"^CREATE TABLE( IF NOT EXISTS)?\s+\"?{table}\"?", f"CREATE TABLE {schema}.{table}_cents",
+                       table_sql.strip(), flags=re.IGNORECASE)
+    # Indexes and triggers go with the old table and are created again afterwards
+    cur.execute(f"""SELECT sql FROM {schema}.sqlite_master
+                    WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL""", (table,))
+    dependents = [row[0] for row in cur.fetchall()]
+    # Keep the AUTOINCREMENT high-water mark, so ids of deleted rows are not reused
+    cur.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'sqlite_sequence'")
+    sequence = None
+    if cur.fetchone():
+        cur.execute(f"SELECT seq FROM {schema}.sqlite_sequence WHERE name = ?", (table,))
+        sequence = cur.fetchone()
+
+    names = ", ".join(name for name, _ in columns)
+    values = ", ".join(f"CAST(ROUND({name} * 100) AS INTEGER)" if name in money_columns else name
+                       for name, _ in columns)
+    cur.execute(table_sql)
+    cur.execute(f"INSERT INTO {schema}.{table}_cents ({names}) SELECT {values} FROM {schema}.{table}")
+    cur.execute(f"DROP TABLE {schema}.{table}")
+    cur.execute(f"ALTER TABLE {schema}.{table}_cents RENAME TO {table}")
+    for dependent_sql in dependents:
+        if schema != 'main':
+            dependent_sql = re.sub(r"^CREATE (UNIQUE )?(INDEX|TRIGGER) (IF NOT EXISTS )?",
+                                   lambda m: m.group(0) + f"{schema}.", dependent_sql, flags=re.IGNORECASE)
+        cur.execute(dependent_sql)
+    if sequence:
+        cur.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {schema}.sqlite_sequence WHERE name = ?", (table,))
+        current = cur.fetchone()[0]
+        cur.execute(f"DELETE FROM {schema}.sqlite_sequence WHERE name = ?", (table,))
+        cur.execute(f"INSERT INTO {schema}.sqlite_sequence (name, seq) VALUES (?, ?)",
+                    (table, max(current, sequence[0])))
+
+migrate_money_columns(c)
+
 conn.commit()
 
 # GUI setup
@@ -167,6 +567,8 @@ ttk.Button(button_frame, text="Update Product", command=lambda: update_product()
             style="Accent.TButton").pack(side=tk.LEFT, padx=5)
 ttk.Button(button_frame, text="Update Company Prices", command=lambda: update_company_prices(),
             style="Accent.TButton").pack(side=tk.LEFT, padx=5)
+ttk.Button(button_frame, text="Price History", command=lambda: show_price_history(),
+            style="Accent.TButton").pack(side=tk.LEFT, padx=5)
 
 # Search bar setup
 search_frame = ttk.Frame(inventory_frame)
@@ -210,9 +612,9 @@ def view_products(search_query=None):
 
     for row in c.fetchall():
         formatted_row = list(row)
-        formatted_row[4] = f"{row[4]:.2f}"  # Format Purchase Price
-        formatted_row[5] = f"{row[5]:.2f}"  # Format Selling Price
-        formatted_row[6] = f"{row[6]:.2f}"  # Format Wholesale Price
+        formatted_row[4] = money_text(row[4])  # Format Purchase Price
+        formatted_row[5] = money_text(row[5])  # Format Selling Price
+        formatted_row[6] = money_text(row[6])  # Format Wholesale Price
         inventory_tree.insert("", tk.END, values=formatted_row)
 
 def refresh_company_dropdown():
@@ -231,6 +633,12 @@ def add_product():
     if any(not value for value in entries_data.values()):
         messagebox.showwarning("Error", "Please fill all fields except Company (optional)!")
         return
+    try:
+        purchase_price, selling_price, wholesale_price = (
+            to_cents(entries_data[key]) for key in ('purchase_price', 'selling_price', 'wholesale_price'))
+    except ValueError:
+        messagebox.showwarning("Error", "Prices must be numbers!")
+        return
 
     try:
         if company_name:  # If user entered a company name
@@ -255,12 +663,16 @@ def add_product():
                     (entries_data['name'], 
                     entries_data['sku'], 
                     entries_data['stock'],
-                    entries_data['purchase_price'], 
-                    entries_data['selling_price'],
-                    entries_data['wholesale_price'],
+                    purchase_price, 
+                    selling_price,
+                    wholesale_price,
                     company_id))  # Can be NULL
+        product_id = c.lastrowid
+        record_stock_movements([(product_id, int(entries_data['stock']),
+                                 purchase_price, 'initial', None)])
         
         conn.commit()
+        invalidate_product_cache([product_id])
         messagebox.showinfo("Success", "Product added!")
         
         for entry in entries.values():
@@ -270,7 +682,7 @@ def add_product():
     except sqlite3.IntegrityError:
         messagebox.showwarning("Error", "SKU must be unique!")
 
-def add_to_invoice(sku=None):
+def add_to_invoice(sku=None, quantity=1):
     if sku is None:
         # Get product from Treeview selection
         selected_item = inventory_tree.selection()
@@ -279,12 +691,12 @@ def add_to_invoice(sku=None):
             return
         item_values = inventory_tree.item(selected_item, 'values')
         product_id = item_values[0]
-        c.execute("SELECT id, name, sku, stock, purchase_price, selling_price, wholesale_price FROM products WHERE id = ?", (product_id,))
+        c.execute("SELECT id, name, sku, stock, purchase_price, selling_price, wholesale_price, company_id FROM products WHERE id = ?", (product_id,))
         product = c.fetchone()
 
     else:
         # Get product by SKU
-        c.execute("SELECT id, name, sku, stock, purchase_price, selling_price, wholesale_price FROM products WHERE sku = ?", (sku,))
+        c.execute("SELECT id, name, sku, stock, purchase_price, selling_price, wholesale_price, company_id FROM products WHERE sku = ?", (sku,))
         product = c.fetchone()
         if not product:
             messagebox.showerror("Error", f"No product found with SKU: {sku}")
@@ -294,88 +706,111 @@ def add_to_invoice(sku=None):
     if not product: # this condition check if product came from sku, or inventory tree, without raise an error 
         return
     
-    product_id, name, sku, stock, p_price, s_price, w_price = product
+    product_id, name, sku, stock, p_price, s_price, w_price, company_id = product
 
     # Check if already in invoice
-    for item in invoice_items:
-        if item['product_id'] == product_id:
-            current_qty = item['quantity'].get()
-            item['quantity'].set(current_qty + 1)
-            update_invoice_item_total(item)
-            calculate_grand_total()  # Make sure to recalc the invoice total.
-            return
+    item = invoice_lines.get(product_id)
+    if item:
+        change_invoice_quantity(item, item['quantity'] + quantity)
+        return
 
+    # One Treeview row per line; the row id is the product id
+    item = {
+        'product_id': product_id,
+        'company_id': company_id,
+        'quantity': quantity,
+        'stock': int(stock),
+        'wholesale': False,
+        'name': name,
+        'sku': sku,
+        'selling_price': s_price,
+        'wholesale_price': w_price,
+        'line_total': 0,
+    }
+    invoice_items.append(item)
+    invoice_lines[product_id] = item
+    invoice_tree.insert("", tk.END, iid=str(product_id))
+    update_invoice_item_total(item)
+    calculate_grand_total()
+    invoice_tree.see(str(product_id))
 
+def change_invoice_quantity(item, quantity):
+    item['quantity'] = quantity
+    update_invoice_item_total(item)
+    calculate_grand_total()
 
+def delete_invoice_item(product_id):
+    item = invoice_lines.pop(product_id, None)
+    if item is None:
+        return
+    invoice_items.remove(item)
+    invoice_tree.delete(str(product_id))
+    calculate_grand_total()
 
-    # Create invoice item frame
-    item_frame = ttk.Frame(invoice_items_frame)
-    item_frame.pack(fill=tk.X, pady=2)
+def clear_invoice():
+    invoice_line_editor.place_forget()
+    invoice_tree.delete(*invoice_tree.get_children())
+    invoice_items.clear()
+    invoice_lines.clear()
+    calculate_grand_total()
 
-    # Product info
-    ttk.Label(item_frame, text=name, width=20).grid(row=0, column=0, padx=2)
-    ttk.Label(item_frame, text=sku, width=15).grid(row=0, column=1, padx=2)
+def selected_invoice_items():
+    return [invoice_lines[int(iid)] for iid in invoice_tree.selection() if int(iid) in invoice_lines]
 
-    # Wholesale option
-    wholesale_var = tk.BooleanVar(value=False)
-    ttk.Checkbutton(item_frame, text="Wholesale", variable=wholesale_var).grid(row=0, column=2, padx=2)
+def delete_selected_invoice_items(event=None):
+    for item in selected_invoice_items():
+        delete_invoice_item(item['product_id'])
 
-    # Quantity control
-    quantity = tk.IntVar(value=1)
-    total = tk.DoubleVar()
+invoice_line_editing = None  # product id of the line under the quantity editor
 
-    # Function to update price based on wholesale toggle
-    def update_total(*args):
-        if wholesale_var.get():
-            price = float(w_price)
-        else:
-            price = float(s_price)
-        total.set(quantity.get() * price)
-        price_label.config(text=f"${price:.2f}")  # Update price label
+def edit_invoice_line(event):
+    # Double-click: the Wholesale cell toggles, the Qty cell opens the line editor.
+    # The editor is a single Spinbox placed over whichever row is being edited.
+    global invoice_line_editing
+    iid = invoice_tree.identify_row(event.y)
+    column = invoice_tree.identify_column(event.x)
+    if not iid or int(iid) not in invoice_lines:
+        return
+    item = invoice_lines[int(iid)]
+    if column == INVOICE_WHOLESALE_COLUMN:
+        item['wholesale'] = not item['wholesale']
+        update_invoice_item_total(item)
         calculate_grand_total()
+    elif column == INVOICE_QUANTITY_COLUMN:
+        x, y, width, height = invoice_tree.bbox(iid, column)
+        invoice_line_editing = item['product_id']
+        invoice_line_editor.delete(0, tk.END)
+        invoice_line_editor.insert(0, str(item['quantity']))
+        invoice_line_editor.place(in_=invoice_tree, x=x, y=y, width=width, height=height)
+        invoice_line_editor.focus_set()
+        invoice_line_editor.selection_range(0, tk.END)
+
+def finish_invoice_line_edit(event=None):
+    global invoice_line_editing
+    item = invoice_lines.get(invoice_line_editing)
+    invoice_line_editing = None
+    if not invoice_line_editor.winfo_ismapped():
+        return
+    invoice_line_editor.place_forget()
+    if item is None:
+        return
+    try:
+        quantity = int(invoice_line_editor.get())
+    except ValueError:
+        return  # keep the old quantity
+    if quantity < 1:
+        messagebox.showwarning("Error", "Quantity must be at least 1!")
+        return
+    change_invoice_quantity(item, quantity)
 
-    price_label = ttk.Label(item_frame, text=f"${s_price:.2f}", width=10) #initialy price label
-    price_label.grid(row=0, column=3, padx=2)
-
-
-    # Set trace for quantity and wholesale option
-    quantity.trace_add("write", update_total)
-    wholesale_var.trace_add("write", update_total)
-    update_total()  # Initial call
-
-    spinbox = ttk.Spinbox(item_frame, from_=1, to=100, textvariable=quantity, width=5)
-    spinbox.grid(row=0, column=4, padx=2)
-
-    # Total price display
-    ttk.Label(item_frame, textvariable=total, width=10).grid(row=0, column=5, padx=2)
-
-    # Delete button
-    delete_btn = ttk.Button(item_frame, text="×", width=2,
-                           command=lambda f=item_frame, i=product_id: delete_invoice_item(f, i))
-    delete_btn.grid(row=0, column=6, padx=2)
-
-    # Store item data
-    invoice_items.append({
-        'product_id': product_id,
-        'frame': item_frame,
-        'quantity': quantity,
-        'total': total,
-        'stock': int(stock),
-        'wholesale': wholesale_var,
-        'name': name
-    })
-
-    calculate_grand_total()
-
-
-def delete_invoice_item(frame, product_id):
-    invoice_items[:] = [item for item in invoice_items if item['product_id'] != product_id]
-    frame.destroy()
-    calculate_grand_total()
+def cancel_invoice_line_edit(event=None):
+    global invoice_line_editing
+    invoice_line_editing = None
+    invoice_line_editor.place_forget()
 
 def calculate_grand_total():
-    grand_total = sum(item['total'].get() for item in invoice_items)
-    invoice_total.config(text=f"${grand_total:.2f}")
+    grand_total = sum(item['line_total'] for item in invoice_items)
+    invoice_total.config(text=format_money(grand_total))
 
 def submit_invoice():
     if not invoice_items:
@@ -383,65 +818,99 @@ def submit_invoice():
         return
     
     try:
-        # Check stock availability first
-        for item in invoice_items:
-            if item['quantity'].get() > item['stock']:
-                messagebox.showwarning("Error", 
-                    f"Not enough stock for ( {item['name']} ) !")
-                return
-        
         # Start transaction
         conn.execute("BEGIN TRANSACTION")
         
         invoice_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        grand_total = sum(item['total'].get() for item in invoice_items)
+        grand_total = 0
         c.execute("INSERT INTO invoices (date, total) VALUES (?, ?)",
                   (invoice_date, grand_total))
         invoice_id = c.lastrowid
+        sold_lines = []
+        sale_lines = []
+        movements = []
+        invoice_cost = 0
         
         # Insert invoice items and update stock
         for item in invoice_items:
             product_id = item['product_id']
-            quantity = item['quantity'].get()
+            quantity = item['quantity']
             
-            # Get current prices from products table including wholesale price
-            c.execute("SELECT purchase_price, selling_price, wholesale_price FROM products WHERE id = ?", (product_id,))
-            current_purchase_price, current_selling_price, current_wholesale_price = c.fetchone()
+            # Get current stock and prices from products table including wholesale price.
+            # Stock is checked here, inside the transaction: goods received while the
+            # invoice was open count, and the line's stock figure may be out of date.
+            c.execute("""SELECT COALESCE(stock, 0), purchase_price, selling_price, wholesale_price
+                         FROM products WHERE id = ?""", (product_id,))
+            current_stock, current_purchase_price, current_selling_price, current_wholesale_price = c.fetchone()
+            if quantity > current_stock:
+                conn.rollback()
+                messagebox.showwarning("Error", 
+                    f"Not enough stock for ( {item['name']} ) !")
+                return
             
             # Determine which price to use based on the wholesale flag
-            if item['wholesale'].get():
+            if item['wholesale']:
                 unit_price = current_wholesale_price
             else:
                 unit_price = current_selling_price
             
-            total_price = quantity * unit_price
+            # Promotions are evaluated again against the current prices
+            discount, promotion_id = best_promotion(product_id, item['company_id'], unit_price,
+                                                    quantity, item['wholesale'])
+            total_price = quantity * unit_price - discount
+            grand_total += total_price
             
             # Update stock
-            new_stock = item['stock'] - quantity
-            c.execute("UPDATE products SET stock = ? WHERE id = ?", (new_stock, product_id))
+            c.execute("UPDATE products SET stock = COALESCE(stock, 0) - ? WHERE id = ?", (quantity, product_id))
             
             # Insert invoice item with historical prices
             c.execute("""INSERT INTO invoice_items 
                          (invoice_id, product_id, quantity, unit_price, total_price,
-                          historical_purchase_price, historical_selling_price)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                          historical_purchase_price, historical_selling_price,
+                          discount, promotion_id)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                       (invoice_id, product_id, quantity, unit_price, total_price,
-                       current_purchase_price, unit_price))
+                       current_purchase_price, unit_price, discount, promotion_id))
+            sold_lines.append((product_id, quantity))
+            sale_lines.append((product_id, item['name'], quantity, total_price, quantity * current_purchase_price))
+            movements.append((product_id, -quantity, current_purchase_price, 'sale', invoice_id))
+            invoice_cost += quantity * current_purchase_price
         
+        c.execute("UPDATE invoices SET total = ? WHERE id = ?", (grand_total, invoice_id))
+        allocate_lots(c, sold_lines, invoice_id)
+        record_stock_movements(movements)
+        add_daily_sales(c, invoice_date[:10], 1, grand_total, invoice_cost)
+        record_sales_velocity(sold_lines, invoice_date[:10])
         conn.commit()
-        messagebox.showinfo("Success", "Invoice processed and stock updated!")
-        
-        # Clear invoice items
-        for item in invoice_items:
-            item['frame'].destroy()
-        invoice_items.clear()
-        calculate_grand_total()
-        view_products()
     except Exception as e:
         conn.rollback()
         messagebox.showerror("Error", f"An error occurred: {str(e)}")
+        return
+
+    # The sale is committed from here on: clear it first so it cannot be sold twice,
+    # and a failing follow-up step is reported as such, not as a failed sale
+    clear_invoice()
+    try:
+        publish_invoice(invoice_date, sale_lines)
+        queue_receipt(invoice_id)
+        request_report_refresh()
+        invalidate_product_cache([product_id for product_id, _ in sold_lines])
+        view_products()
+        refresh_low_stock_button()
+
+        # Warn about anything this sale pushed below its reorder point
+        low_stock = find_low_stock([product_id for product_id, _ in sold_lines])
+    except Exception as e:
+        messagebox.showwarning("Warning", f"Invoice #{invoice_id} was saved, but updating the screen failed: {str(e)}")
+        return
+    if low_stock:
+        names = "\n".join(f"{item['name']} ({item['stock']} left)" for item in low_stock)
+        messagebox.showinfo("Success", f"Invoice processed and stock updated!\n\nLow stock:\n{names}")
+    else:
+        messagebox.showinfo("Success", "Invoice processed and stock updated!")
 
 def show_invoice_history():
+    rc = get_report_cursor()
     history_window = tk.Toplevel(root)
     history_window.title("Invoice History")
     history_window.geometry("800x600")
@@ -456,6 +925,12 @@ def show_invoice_history():
     export_pdf_btn = ttk.Button(export_frame, text="Export to PDF", command=export_history_to_pdf)
     export_pdf_btn.pack(side=tk.LEFT, padx=5)
 
+    ttk.Button(export_frame, text="Search", command=show_invoice_search).pack(side=tk.LEFT, padx=5)
+    ttk.Button(export_frame, text="Archive", command=show_archive).pack(side=tk.LEFT, padx=5)
+    ttk.Button(export_frame, text="Maintenance", command=show_maintenance).pack(side=tk.LEFT, padx=5)
+
+    ttk.Label(export_frame, text=report_freshness_text()).pack(side=tk.RIGHT, padx=5)
+
     # Create canvas and scrollbar
     canvas = tk.Canvas(history_window, borderwidth=0)
     scrollbar = ttk.Scrollbar(history_window, orient="vertical", command=canvas.yview)
@@ -474,75 +949,48 @@ def show_invoice_history():
     canvas.pack(side="left", fill="both", expand=True)
     scrollbar.pack(side="right", fill="y")
     
-    # Get invoices grouped by date
-    c.execute('''SELECT DATE(date) as invoice_date, 
-                COUNT(*) as count, 
-                SUM(total) as total 
-                FROM invoices 
-                GROUP BY DATE(date) 
-                ORDER BY DATE(date) DESC''')
-    daily_invoices = c.fetchall()
-    
-    for date_data in daily_invoices:
-        date_str, count, daily_total = date_data
-        
-        # Calculate profit using historical prices
-        c.execute('''SELECT ii.quantity, ii.historical_purchase_price, ii.historical_selling_price
-                    FROM invoice_items ii
-                    JOIN invoices i ON ii.invoice_id = i.id
-                    WHERE DATE(i.date) = ?''', (date_str,))
-        items = c.fetchall()
-        print(        items[0][0])
-        total_cost = sum(item[0] * item[1] for item in items)  # quantity * historical_purchase_price
-        daily_profit = daily_total - total_cost
+    # Daily totals and profit (historical prices) and each day's invoices, from the report cache
+    for date_str, count, daily_total, daily_profit, invoices in load_history_days(rc):
         
         # Date header
         date_frame = ttk.Frame(scrollable_frame)
         date_frame.pack(fill=tk.X, padx=10, pady=5)
         
         ttk.Label(date_frame, text=date_str, font=('Helvetica', 12, 'bold')).pack(side=tk.LEFT)
-        ttk.Label(date_frame, text=f"{count} invoices - Total: ${daily_total:.2f} - Profit: ${daily_profit:.2f}", 
+        ttk.Label(date_frame, text=f"{count} invoices - Total: {format_money(daily_total)} - Profit: {format_money(daily_profit)}", 
                  font=('Helvetica', 10)).pack(side=tk.RIGHT)
         
-        # Get invoices for this date
-        c.execute('''SELECT id, date, total 
-                    FROM invoices 
-                    WHERE DATE(date) = ? 
-                    ORDER BY date DESC''', (date_str,))
-        invoices = c.fetchall()
-        
         # Create invoice list
         invoice_list = ttk.Frame(scrollable_frame)
         invoice_list.pack(fill=tk.X, padx=20, pady=5)
         
-        for invoice in invoices:
-            invoice_id, invoice_time, total = invoice
-            time_str = datetime.strptime(invoice_time, "%Y-%m-%d %H:%M:%S").strftime("%H:%M:%S")
-            
+        for invoice_id, title, time_str, total_text in invoices:
             invoice_frame = ttk.Frame(invoice_list)
             invoice_frame.pack(fill=tk.X, pady=2)
             
-            ttk.Label(invoice_frame, text=f"Invoice #{invoice_id}", width=15).pack(side=tk.LEFT)
+            ttk.Label(invoice_frame, text=title, width=25).pack(side=tk.LEFT)
             ttk.Label(invoice_frame, text=time_str, width=15).pack(side=tk.LEFT)
-            ttk.Label(invoice_frame, text=f"${total:.2f}", width=15).pack(side=tk.LEFT)
+            ttk.Label(invoice_frame, text=total_text, width=15).pack(side=tk.LEFT)
             
             # View details button
             ttk.Button(invoice_frame, text="Details",
                       command=lambda iid=invoice_id: show_invoice_details(iid)).pack(side=tk.RIGHT)
 
 def show_invoice_details(invoice_id):
+    rc = get_report_cursor()
     detail_window = tk.Toplevel(root)
     detail_window.title(f"Invoice Details - #{invoice_id}")
     detail_window.geometry("800x400")
     
     # Get the invoice details using historical prices
-    c.execute('''SELECT i.date, i.total, ii.product_id, p.name, ii.quantity, 
-                 ii.historical_selling_price, ii.historical_purchase_price 
-                FROM invoice_items ii
+    rc.execute(f'''SELECT i.date, i.total, ii.product_id, p.name, ii.quantity, 
+                 ii.historical_selling_price, {COST_AT_SALE_SQL},
+                 COALESCE(ii.total_price, ii.historical_selling_price * ii.quantity - COALESCE(ii.discount, 0))
+                FROM all_invoice_items ii
                 JOIN products p ON ii.product_id = p.id
-                JOIN invoices i ON ii.invoice_id = i.id
+                JOIN all_invoices i ON ii.invoice_id = i.id
                 WHERE ii.invoice_id = ?''', (invoice_id,))
-    items = c.fetchall()
+    items = rc.fetchall()
 
     # Create frame for showing invoice details
     invoice_frame = ttk.Frame(detail_window)
@@ -555,28 +1003,23 @@ def show_invoice_details(invoice_id):
     date_label = ttk.Label(invoice_frame, text=f"Date: {invoice_date}", font=('Helvetica', 12, 'bold'))
     date_label.pack(anchor=tk.W)
     
-    total_label = ttk.Label(invoice_frame, text=f"Total Revenue: ${total_revenue:.2f}", font=('Helvetica', 12, 'bold'))
+    total_label = ttk.Label(invoice_frame, text=f"Total Revenue: {format_money(total_revenue)}", font=('Helvetica', 12, 'bold'))
     total_label.pack(anchor=tk.W, pady=10)
 
-    # Calculate the profit using historical prices
-    total_revenue = 0.0
-    total_cost = 0.0
-    for item in items:
-        historical_selling_price = item[5]
-        quantity = item[4]
-        historical_purchase_price = item[6]
-        
-        # Accumulate totals using historical prices
-        total_revenue += historical_selling_price * quantity
-        total_cost += historical_purchase_price * quantity
-
-    # Calculate the profit
-    invoice_profit = total_revenue - total_cost
+    # Calculate the profit from what each line was sold for (after discounts) and its cost at the time
+    invoice_profit = sum(item[7] - item[6] * item[4] for item in items)
 
     # Display the profit before the table
-    profit_label = ttk.Label(invoice_frame, text=f"Profit: ${invoice_profit:.2f}", font=('Helvetica', 12, 'bold'))
+    profit_label = ttk.Label(invoice_frame, text=f"Profit: {format_money(invoice_profit)}", font=('Helvetica', 12, 'bold'))
     profit_label.pack(anchor=tk.W)
 
+    detail_buttons = ttk.Frame(invoice_frame)
+    detail_buttons.pack(anchor=tk.W, pady=5)
+    ttk.Button(detail_buttons, text="Print Receipt",
+               command=lambda: queue_receipt(invoice_id)).pack(side=tk.LEFT, padx=(0, 5))
+    ttk.Button(detail_buttons, text="Return Items",
+               command=lambda: show_return_dialog(invoice_id)).pack(side=tk.LEFT, padx=5)
+
     # Create Treeview for item details
     tree = ttk.Treeview(invoice_frame, columns=("Product ID", "Name", "Quantity", "Historical Selling Price", "Historical Purchase Price", "Total"), show="headings")
     
@@ -604,17 +1047,17 @@ def show_invoice_details(invoice_id):
         historical_selling_price = item[5]
         historical_purchase_price = item[6]
         
-        # Calculate the total for this item using historical selling price
-        item_total = historical_selling_price * quantity
+        # What the line was sold for, discounts included
+        item_total = item[7]
         
         # Insert item into the treeview
         tree.insert("", tk.END, values=(
             product_id, 
             product_name, 
             quantity, 
-            f"${historical_selling_price:.2f}", 
-            f"${historical_purchase_price:.2f}", 
-            f"${item_total:.2f}")
+            format_money(historical_selling_price), 
+            format_money(historical_purchase_price), 
+            format_money(item_total))
         )
     
     # Display the Treeview
@@ -629,14 +1072,13 @@ def update_product():
     item_values = inventory_tree.item(selected_item, 'values')
     product_id = item_values[0]
     current_stock = int(item_values[3])
-    current_purchase_price = float(item_values[4])
-    current_selling_price = float(item_values[5])
-    current_wholesale_price = float(item_values[6])  # Get current wholesale price
+    c.execute("SELECT purchase_price, selling_price, wholesale_price FROM products WHERE id = ?", (product_id,))
+    current_purchase_price, current_selling_price, current_wholesale_price = c.fetchone()
 
     # Create a custom dialog for updates
     update_window = tk.Toplevel(root)
     update_window.title(f"Update Product - {item_values[1]}")
-    update_window.geometry("300x500")  # Increased height for wholesale price
+    update_window.geometry("340x580")  # Increased height for wholesale price and expiry
     
     # Make the dialog modal
     update_window.transient(root)
@@ -648,34 +1090,41 @@ def update_product():
     stock_entry = ttk.Entry(update_window)
     stock_entry.pack(pady=5)
     stock_entry.insert(0, "0")  # Default value
+
+    ttk.Label(update_window, text="Expiry of Added Stock (YYYY-MM-DD, optional):").pack(pady=5)
+    expiry_entry = ttk.Entry(update_window)
+    expiry_entry.pack(pady=5)
     
-    ttk.Label(update_window, text=f"Current Purchase Price: ${current_purchase_price}").pack(pady=5)
+    ttk.Label(update_window, text=f"Current Purchase Price: {format_money(current_purchase_price)}").pack(pady=5)
     ttk.Label(update_window, text="New Purchase Price:").pack(pady=5)
     purchase_price_entry = ttk.Entry(update_window)
     purchase_price_entry.pack(pady=5)
-    purchase_price_entry.insert(0, str(current_purchase_price))
+    purchase_price_entry.insert(0, money_text(current_purchase_price))
     
-    ttk.Label(update_window, text=f"Current Selling Price: ${current_selling_price}").pack(pady=5)
+    ttk.Label(update_window, text=f"Current Selling Price: {format_money(current_selling_price)}").pack(pady=5)
     ttk.Label(update_window, text="New Selling Price:").pack(pady=5)
     selling_price_entry = ttk.Entry(update_window)
     selling_price_entry.pack(pady=5)
-    selling_price_entry.insert(0, str(current_selling_price))
+    selling_price_entry.insert(0, money_text(current_selling_price))
 
-    ttk.Label(update_window, text=f"Current Wholesale Price: ${current_wholesale_price}").pack(pady=5) #Current Wholesale Price
+    ttk.Label(update_window, text=f"Current Wholesale Price: {format_money(current_wholesale_price)}").pack(pady=5) #Current Wholesale Price
     ttk.Label(update_window, text="New Wholesale Price:").pack(pady=5) #Wholesale Price
     wholesale_price_entry = ttk.Entry(update_window)
     wholesale_price_entry.pack(pady=5)
-    wholesale_price_entry.insert(0, str(current_wholesale_price))
+    wholesale_price_entry.insert(0, money_text(current_wholesale_price))
 
     def validate_and_update():
         try:
             # Get and validate additional stock
             additional_stock = int(stock_entry.get() or "0")
+            expiry = expiry_entry.get().strip()
+            if expiry:
+                expiry = datetime.strptime(expiry, "%Y-%m-%d").strftime("%Y-%m-%d")
             
             # Get and validate prices
-            new_purchase_price = float(purchase_price_entry.get())
-            new_selling_price = float(selling_price_entry.get())
-            new_wholesale_price = float(wholesale_price_entry.get()) # Get new wholesale price
+            new_purchase_price = to_cents(purchase_price_entry.get())
+            new_selling_price = to_cents(selling_price_entry.get())
+            new_wholesale_price = to_cents(wholesale_price_entry.get()) # Get new wholesale price
 
             
             if new_purchase_price < 0 or new_selling_price < 0 or new_wholesale_price < 0:
@@ -689,6 +1138,11 @@ def update_product():
             # Calculate new stock
             updated_stock = current_stock + additional_stock
             
+            old_prices = (current_purchase_price, current_selling_price, current_wholesale_price)
+            new_prices = (new_purchase_price, new_selling_price, new_wholesale_price)
+            if tuple(old_prices) != new_prices:
+                record_price_change(product_id, 'manual', old_prices, new_prices)
+
             # Update database
             c.execute("""UPDATE products 
                         SET stock = ?, 
@@ -697,17 +1151,28 @@ def update_product():
                             wholesale_price = ?
                         WHERE id = ?""", 
                      (updated_stock, new_purchase_price, new_selling_price, new_wholesale_price, product_id)) # Update whoesale price
+            if additional_stock or new_purchase_price != old_prices[0]:
+                reason = 'restock' if additional_stock else 'price'
+                record_stock_movements([(product_id, additional_stock, new_purchase_price, reason, None)])
+            if additional_stock > 0 and expiry:
+                add_lot(c, product_id, additional_stock, new_purchase_price, expiry)
+            elif additional_stock < 0:
+                # Stock taken out by hand comes out of the lots too, as after a stocktake
+                trim_lots_to_stock(c)
             conn.commit()
             
             messagebox.showinfo("Success", 
                 f"""Product updated successfully!
                 Stock: {current_stock} → {updated_stock}
-                Purchase Price: ${current_purchase_price:.2f} → ${new_purchase_price:.2f}
-                Selling Price: ${current_selling_price:.2f} → ${new_selling_price:.2f}
-                Wholesale Price: ${current_wholesale_price:.2f} → ${new_wholesale_price:.2f}""")
+                Purchase Price: {format_money(current_purchase_price)} → {format_money(new_purchase_price)}
+                Selling Price: {format_money(current_selling_price)} → {format_money(new_selling_price)}
+                Wholesale Price: {format_money(current_wholesale_price)} → {format_money(new_wholesale_price)}""")
             
+            request_report_refresh()
+            invalidate_product_cache([int(product_id)])
             update_window.destroy()
             view_products()  # Refresh product list
+            refresh_low_stock_button()
             
         except ValueError as e:
             messagebox.showerror("Error", "Please enter valid numbers for all fields!")
@@ -725,6 +1190,15 @@ def update_product():
     y = (update_window.winfo_screenheight() // 2) - (height // 2)
     update_window.geometry(f'{width}x{height}+{x}+{y}')
 
+def render_history_csv(daily_rows):
+    output = io.StringIO(newline='')
+    writer = csv.writer(output)
+    # Write headers
+    writer.writerow(["Invoice Date", "Invoice Count", "Total Revenue", "Daily Profit"])
+    for date_str, count, daily_total, daily_profit in daily_rows:
+        writer.writerow([date_str, count, format_money(daily_total), format_money(daily_profit)])
+    return output.getvalue().encode('utf-8')
+
 def export_history_to_csv():
     # Ask the user for the filename to save CSV
     file_path = filedialog.asksaveasfilename(
@@ -735,49 +1209,17 @@ def export_history_to_csv():
     if not file_path:
         return
 
-    # Query daily invoices and calculate profit per day
-    c.execute('''SELECT DATE(date) as invoice_date, 
-                COUNT(*) as count, 
-                SUM(total) as total 
-                FROM invoices 
-                GROUP BY DATE(date) 
-                ORDER BY DATE(date) DESC''')
-    daily_invoices = c.fetchall()
-
-    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        # Write headers
-        writer.writerow(["Invoice Date", "Invoice Count", "Total Revenue", "Daily Profit"])
-        for date_data in daily_invoices:
-            date_str, count, daily_total = date_data
-            # Calculate profit for each date
-            total_cost = 0.0
-            c.execute('''SELECT ii.quantity, p.purchase_price 
-                        FROM invoice_items ii
-                        JOIN products p ON ii.product_id = p.id
-                        JOIN invoices i ON ii.invoice_id = i.id
-                        WHERE DATE(i.date) = ?''', (date_str,))
-            items = c.fetchall()
-            for item in items:
-                quantity, purchase_price = item
-                total_cost += purchase_price * quantity
-            daily_profit = daily_total - total_cost
-            writer.writerow([date_str, count, f"${daily_total:.2f}", f"${daily_profit:.2f}"])
+    # Rendered once per watermark; daily invoices and profit come from the daily rollup
+    data = cached_report_artifact(get_report_cursor(), 'history_csv', render_history_csv)
+    with open(file_path, 'wb') as csvfile:
+        csvfile.write(data)
     
     messagebox.showinfo("Export Successful", f"Invoice history exported to {file_path}")
 
-def export_history_to_pdf():
-    # Ask the user for the filename to save PDF
-    file_path = filedialog.asksaveasfilename(
-        defaultextension=".pdf",
-        filetypes=[("PDF files", "*.pdf")],
-        title="Save Invoice History as PDF"
-    )
-    if not file_path:
-        return
-
+def render_history_pdf(daily_rows):
     # Create a canvas using ReportLab
-    c_pdf = canvas.Canvas(file_path, pagesize=letter)
+    output = io.BytesIO()
+    c_pdf = canvas.Canvas(output, pagesize=letter)
     width, height = letter
     y = height - 50
 
@@ -795,31 +1237,9 @@ def export_history_to_pdf():
     y -= 20
 
     c_pdf.setFont("Helvetica", 10)
-    # Query daily invoices and calculate profit per day
-    c.execute('''SELECT DATE(date) as invoice_date, 
-                COUNT(*) as count, 
-                SUM(total) as total 
-                FROM invoices 
-                GROUP BY DATE(date) 
-                ORDER BY DATE(date) DESC''')
-    daily_invoices = c.fetchall()
-
-    for date_data in daily_invoices:
-        date_str, count, daily_total = date_data
-        total_cost = 0.0
-        c.execute('''SELECT ii.quantity, p.purchase_price 
-                    FROM invoice_items ii
-                    JOIN products p ON ii.product_id = p.id
-                    JOIN invoices i ON ii.invoice_id = i.id
-                    WHERE DATE(i.date) = ?''', (date_str,))
-        items = c.fetchall()
-        for item in items:
-            quantity, purchase_price = item
-            total_cost += purchase_price * quantity
-        daily_profit = daily_total - total_cost
-        
+    for date_str, count, daily_total, daily_profit in daily_rows:
         # Write row values
-        row_values = [date_str, str(count), f"${daily_total:.2f}", f"${daily_profit:.2f}"]
+        row_values = [date_str, str(count), format_money(daily_total), format_money(daily_profit)]
         for x, value in zip(x_positions, row_values):
             c_pdf.drawString(x, y, value)
         y -= 20
@@ -828,6 +1248,21 @@ def export_history_to_pdf():
             y = height - 50
 
     c_pdf.save()
+    return output.getvalue()
+
+def export_history_to_pdf():
+    # Ask the user for the filename to save PDF
+    file_path = filedialog.asksaveasfilename(
+        defaultextension=".pdf",
+        filetypes=[("PDF files", "*.pdf")],
+        title="Save Invoice History as PDF"
+    )
+    if not file_path:
+        return
+
+    data = cached_report_artifact(get_report_cursor(), 'history_pdf', render_history_pdf)
+    with open(file_path, 'wb') as pdf_file:
+        pdf_file.write(data)
     messagebox.showinfo("Export Successful", f"Invoice history exported to {file_path}")
 
 def draf():
@@ -843,7 +1278,7 @@ def update_company_prices():
     # Create a new modal window for updating company prices.
     update_win = tk.Toplevel(root)
     update_win.title("Update Company Prices")
-    update_win.geometry("400x500")
+    update_win.geometry("400x700")
     update_win.transient(root)
     update_win.grab_set()
     update_win.update_idletasks()
@@ -911,58 +1346,3125 @@ def update_company_prices():
             messagebox.showerror("Error", "Please enter valid percentage values (e.g., 10 or -5).")
             return
 
-        # Retrieve all products for the selected company.
-        c.execute("SELECT id, purchase_price, selling_price, wholesale_price FROM products WHERE company_id = ?", (company_id,))
-        products = c.fetchall()
-
-        # Update each product’s prices.
-        for prod in products:
-            prod_id, p_price, s_price, w_price = prod
-            # Calculate new prices. (For an increase, the factor is (1 + percentage/100). For a decrease, a negative percentage works correctly.)
-            new_p_price = p_price * (1 + purchase_pct / 100)
-            new_s_price = s_price * (1 + selling_pct / 100)
-            new_w_price = w_price * (1 + wholesale_pct / 100)
-            
+        # Calculate the factors. (For an increase, the factor is (1 + percentage/100). For a decrease, a negative percentage works correctly.)
+        purchase_factor = 1 + purchase_pct / 100
+        selling_factor = 1 + selling_pct / 100
+        wholesale_factor = 1 + wholesale_pct / 100
+        changed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            # Write the history for the whole company first, while the old prices are still there.
+            c.execute("""INSERT INTO price_history
+                         (product_id, changed_at, source,
+                          old_purchase_price, new_purchase_price,
+                          old_selling_price, new_selling_price,
+                          old_wholesale_price, new_wholesale_price)
+                         SELECT id, ?, 'company_percentage',
+                                purchase_price, CAST(ROUND(purchase_price * ?) AS INTEGER),
+                                selling_price, CAST(ROUND(selling_price * ?) AS INTEGER),
+                                wholesale_price, CAST(ROUND(wholesale_price * ?) AS INTEGER)
+                         FROM products WHERE company_id = ?""",
+                      (changed_at, purchase_factor, selling_factor, wholesale_factor, company_id))
+
+            # Update every product of the company in one statement.
             c.execute(
                 """UPDATE products 
-                   SET purchase_price = ?, selling_price = ?, wholesale_price = ? 
-                   WHERE id = ?""",
-                (new_p_price, new_s_price, new_w_price, prod_id)
+                   SET purchase_price = CAST(ROUND(purchase_price * ?) AS INTEGER),
+                       selling_price = CAST(ROUND(selling_price * ?) AS INTEGER),
+                       wholesale_price = CAST(ROUND(wholesale_price * ?) AS INTEGER)
+                   WHERE company_id = ?""",
+                (purchase_factor, selling_factor, wholesale_factor, company_id)
             )
-        conn.commit()
+            # Record the new costs in the stock ledger with one statement
+            c.execute("""INSERT INTO stock_movements
+                         (product_id, moved_at, quantity_change, unit_cost, reason)
+                         SELECT id, ?, 0, purchase_price, 'price' FROM products WHERE company_id = ?""",
+                      (changed_at, company_id))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            messagebox.showerror("Error", f"An error occurred: {str(e)}")
+            return
+        request_report_refresh()
+        invalidate_product_cache()
         messagebox.showinfo("Success", "Product prices updated successfully!")
         update_win.destroy()
         view_products()  # Refresh the product list display.
 
     ttk.Button(update_win, text="Apply Updates", command=apply_updates, style="Accent.TButton").pack(pady=20)
 
+    # --- Automatic daily percentage ---
+    ttk.Separator(update_win).pack(fill=tk.X, padx=10, pady=5)
+    ttk.Label(update_win, text="Daily Price Percentage (%), applied automatically:").pack(pady=5)
+    daily_pct_entry = ttk.Entry(update_win)
+    daily_pct_entry.pack(pady=5, padx=10, fill=tk.X)
+
+    def show_daily_pct(event=None):
+        try:
+            company_id = int(company_listbox.get(company_listbox.curselection()).split(":")[0])
+        except tk.TclError:
+            return
+        c.execute("SELECT daily_price_percentage FROM companies WHERE company_id = ?", (company_id,))
+        daily_pct_entry.delete(0, tk.END)
+        daily_pct_entry.insert(0, str(c.fetchone()[0] or 0))
+    company_listbox.bind("<<ListboxSelect>>", show_daily_pct)
+
+    def save_daily_pct():
+        try:
+            company_id = int(company_listbox.get(company_listbox.curselection()).split(":")[0])
+        except tk.TclError:
+            messagebox.showerror("Error", "Please select a company from the list.", parent=update_win)
+            return
+        try:
+            daily_pct = float(daily_pct_entry.get())
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a valid percentage (e.g., 0.5 or -1).", parent=update_win)
+            return
+        c.execute("UPDATE companies SET daily_price_percentage = ? WHERE company_id = ?", (daily_pct, company_id))
+        conn.commit()
+        messagebox.showinfo("Success", "Daily percentage saved!", parent=update_win)
+
+    daily_buttons = ttk.Frame(update_win)
+    daily_buttons.pack(pady=5)
+    ttk.Button(daily_buttons, text="Save Daily Percentage", command=save_daily_pct).pack(side=tk.LEFT, padx=5)
+    ttk.Button(daily_buttons, text="Daily Update Log", command=show_daily_price_runs).pack(side=tk.LEFT, padx=5)
+
 def update_invoice_item_total(item):
-    # Determine the appropriate price (for example, use selling_price)
-    # This sample assumes you want to use the selling price.
-    c.execute("SELECT selling_price FROM products WHERE id = ?", (item['product_id'],))
-    price = c.fetchone()[0]
-    total = price * item['quantity'].get()
-    item['total'].set(total)
+    # Price by the wholesale option, then the best promotion for this line only
+    quantity = item['quantity']
+    wholesale = item['wholesale']
+    price = item['wholesale_price'] if wholesale else item['selling_price']
+    discount, promotion_id = best_promotion(item['product_id'], item['company_id'], price, quantity, wholesale)
+
+    item['discount'] = discount
+    item['promotion_id'] = promotion_id
+    item['line_total'] = quantity * price - discount
+    invoice_tree.item(str(item['product_id']), values=(
+        item['name'], item['sku'], "Yes" if wholesale else "No", format_money(price), quantity,
+        format_money(-discount) if discount else "", format_money(item['line_total'])))
+
+# ------------------------------------------------------------------------------
+# Sales Analytics
+# ------------------------------------------------------------------------------
+# Per-product aggregates for a date range. Everything is summed inside SQLite and
+# the ABC class comes from a running revenue share (window function), so the
+# invoice lines never have to be pulled into Python. {cost} is COST_AT_SALE_SQL:
+# lines without a stored cost take it from the price history as of the sale.
+ANALYTICS_PRODUCT_QUERY = '''
+    WITH sold AS (
+        SELECT ii.product_id,
+               SUM(ii.quantity) AS units,
+               SUM(ii.total_price) AS revenue,
+               SUM(ii.quantity * {cost}) AS cost
+        FROM all_invoices i
+        JOIN all_invoice_items ii ON ii.invoice_id = i.id
+        JOIN products p ON p.id = ii.product_id
+        WHERE i.date >= ? AND i.date < DATE(?, '+1 day')
+        GROUP BY ii.product_id
+    ), ranked AS (
+        SELECT s.*,
+               SUM(s.revenue) OVER (ORDER BY s.revenue DESC, s.product_id
+                                    ROWS UNBOUNDED PRECEDING) - s.revenue AS revenue_before,
+               SUM(s.revenue) OVER () AS revenue_all
+        FROM sold s
+    )
+    SELECT p.id, p.name, p.sku, COALESCE(co.name, 'No Company'),
+           r.units,
+           r.units * 1.0 / ? AS velocity,
+           r.revenue,
+           r.revenue - r.cost AS margin,
+           CASE WHEN r.revenue > 0 THEN (r.revenue - r.cost) * 100.0 / r.revenue ELSE 0 END AS margin_pct,
+           COALESCE(r.units * 100.0 / NULLIF(r.units + MAX(COALESCE(p.stock, 0), 0), 0), 0) AS sell_through,
+           CASE WHEN r.revenue_all <= 0 THEN 'C'
+                WHEN r.revenue_before < 0.80 * r.revenue_all THEN 'A'
+                WHEN r.revenue_before < 0.95 * r.revenue_all THEN 'B'
+                ELSE 'C' END AS abc_class
+    FROM ranked r
+    JOIN products p ON p.id = r.product_id
+    LEFT JOIN companies co ON co.company_id = p.company_id
+    ORDER BY {order} DESC
+    LIMIT ?'''
+
+ANALYTICS_COMPANY_QUERY = '''
+    WITH sold AS (
+        SELECT ii.product_id,
+               SUM(ii.quantity) AS units,
+               SUM(ii.total_price) AS revenue,
+               SUM(ii.quantity * {cost}) AS cost
+        FROM all_invoices i
+        JOIN all_invoice_items ii ON ii.invoice_id = i.id
+        JOIN products p ON p.id = ii.product_id
+        WHERE i.date >= ? AND i.date < DATE(?, '+1 day')
+        GROUP BY ii.product_id
+    )
+    SELECT COALESCE(co.name, 'No Company'),
+           COUNT(*) AS products_sold,
+           SUM(s.units) AS units,
+           SUM(s.revenue) AS revenue,
+           SUM(s.revenue - s.cost) AS margin,
+           CASE WHEN SUM(s.revenue) > 0 THEN SUM(s.revenue - s.cost) * 100.0 / SUM(s.revenue) ELSE 0 END,
+           COALESCE(SUM(s.units) * 100.0 / NULLIF(SUM(s.units) + SUM(MAX(COALESCE(p.stock, 0), 0)), 0), 0)
+    FROM sold s
+    JOIN products p ON p.id = s.product_id
+    LEFT JOIN companies co ON co.company_id = p.company_id
+    GROUP BY p.company_id
+    ORDER BY revenue DESC'''
+
+# Sort options offered in the report window, mapped to the ORDER BY column
+ANALYTICS_SORT_COLUMNS = {
+    "Revenue": "r.revenue",
+    "Margin": "margin",
+    "Units Sold": "r.units",
+    "Sell-Through": "sell_through",
+}
+
+def load_sales_analytics(start_date, end_date, top_n=50, sort_by="Revenue"):
+    # Returns (product_rows, company_rows) for the inclusive date range
+    days = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    if days <= 0:
+        raise ValueError("End date must not be before start date")
+
+    rc = get_report_cursor()
+    order = ANALYTICS_SORT_COLUMNS.get(sort_by, "r.revenue")
+    rc.execute(ANALYTICS_PRODUCT_QUERY.format(order=order, cost=COST_AT_SALE_SQL), (start_date, end_date, days, top_n))
+    product_rows = rc.fetchall()
+
+    rc.execute(ANALYTICS_COMPANY_QUERY.format(cost=COST_AT_SALE_SQL), (start_date, end_date))
+    company_rows = rc.fetchall()
+    return product_rows, company_rows
+
+def show_sales_analytics():
+    analytics_window = tk.Toplevel(root)
+    analytics_window.title("Sales Analytics")
+    analytics_window.geometry("1100x700")
+
+    # --- Filters ---
+    filter_frame = ttk.Frame(analytics_window)
+    filter_frame.pack(fill=tk.X, padx=10, pady=10)
+
+    today = datetime.now()
+    ttk.Label(filter_frame, text="From (YYYY-MM-DD):").pack(side=tk.LEFT, padx=5)
+    start_entry = ttk.Entry(filter_frame, width=12)
+    start_entry.pack(side=tk.LEFT, padx=5)
+    start_entry.insert(0, (today - timedelta(days=29)).strftime("%Y-%m-%d"))
+
+    ttk.Label(filter_frame, text="To:").pack(side=tk.LEFT, padx=5)
+    end_entry = ttk.Entry(filter_frame, width=12)
+    end_entry.pack(side=tk.LEFT, padx=5)
+    end_entry.insert(0, today.strftime("%Y-%m-%d"))
+
+    ttk.Label(filter_frame, text="Top:").pack(side=tk.LEFT, padx=5)
+    top_var = tk.IntVar(value=50)
+    ttk.Spinbox(filter_frame, from_=5, to=10000, textvariable=top_var, width=6).pack(side=tk.LEFT, padx=5)
+
+    ttk.Label(filter_frame, text="Sort by:").pack(side=tk.LEFT, padx=5)
+    sort_var = tk.StringVar(value="Revenue")
+    Combobox(filter_frame, textvariable=sort_var, values=list(ANALYTICS_SORT_COLUMNS),
+             state="readonly", width=12).pack(side=tk.LEFT, padx=5)
+
+    # --- Per-product table ---
+    ttk.Label(analytics_window, text="Products", font=('Helvetica', 12, 'bold')).pack(anchor=tk.W, padx=10)
+    product_columns = ("Name", "SKU", "Company", "Units", "Units/Day", "Revenue", "Margin", "Margin %", "Sell-Through %", "ABC")
+    product_tree = ttk.Treeview(analytics_window, columns=product_columns, show="headings", height=15)
+    for col in product_columns:
+        product_tree.heading(col, text=col)
+        product_tree.column(col, width=100, anchor="center")
+    product_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    # --- Per-company table ---
+    ttk.Label(analytics_window, text="Companies", font=('Helvetica', 12, 'bold')).pack(anchor=tk.W, padx=10)
+    company_columns = ("Company", "Products Sold", "Units", "Revenue", "Margin", "Margin %", "Sell-Through %")
+    company_tree = ttk.Treeview(analytics_window, columns=company_columns, show="headings", height=8)
+    for col in company_columns:
+        company_tree.heading(col, text=col)
+        company_tree.column(col, width=120, anchor="center")
+    company_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    summary_label = ttk.Label(analytics_window, text="", font=('Helvetica', 10))
+    summary_label.pack(anchor=tk.W, padx=10, pady=5)
+
+    def run_report():
+        try:
+            product_rows, company_rows = load_sales_analytics(
+                start_entry.get().strip(), end_entry.get().strip(), top_var.get(), sort_var.get())
+        except (ValueError, tk.TclError):
+            messagebox.showerror("Error", "Please enter valid dates (YYYY-MM-DD) and a valid top count!")
+            return
+
+        product_tree.delete(*product_tree.get_children())
+        for row in product_rows:
+            _, name, sku, company, units, velocity, revenue, margin, margin_pct, sell_through, abc = row
+            product_tree.insert("", tk.END, values=(
+                name, sku, company, units, f"{velocity:.2f}", format_money(revenue), format_money(margin),
+                f"{margin_pct:.1f}", f"{sell_through:.1f}", abc))
+
+        company_tree.delete(*company_tree.get_children())
+        total_revenue = 0
+        total_margin = 0
+        for row in company_rows:
+            company, products_sold, units, revenue, margin, margin_pct, sell_through = row
+            total_revenue += revenue
+            total_margin += margin
+            company_tree.insert("", tk.END, values=(
+                company, products_sold, units, format_money(revenue), format_money(margin),
+                f"{margin_pct:.1f}", f"{sell_through:.1f}"))
+
+        summary_label.config(text=f"Total Revenue: {format_money(total_revenue)} - Total Margin: {format_money(total_margin)}")
+
+    ttk.Button(filter_frame, text="Run Report", command=run_report,
+               style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+    run_report()
+
+# ------------------------------------------------------------------------------
+# Reorder Points and Low-Stock Alerts
+# ------------------------------------------------------------------------------
+# Daily units sold are tracked as an exponentially weighted average (roughly a
+# two week window). Each invoice only touches the rows of the products it sold.
+VELOCITY_ALPHA = 2 / (14 + 1)
+# Suggested order quantities cover the lead time plus this many days of sales
+REORDER_COVER_DAYS = 14
+
+def decayed_velocity(daily_units, last_day, today):
+    # Days without sales since last_day pull the average towards zero
+    gap = (datetime.strptime(today, "%Y-%m-%d") - datetime.strptime(last_day, "%Y-%m-%d")).days
+    if gap > 0:
+        daily_units *= (1 - VELOCITY_ALPHA) ** gap
+    return daily_units
+
+def record_sales_velocity(sold_lines, sale_day):
+    # Called inside the invoice transaction with (product_id, quantity) pairs
+    for product_id, quantity in sold_lines:
+        c.execute("SELECT daily_units, last_day FROM product_velocity WHERE product_id = ?", (product_id,))
+        row = c.fetchone()
+        daily_units = decayed_velocity(row[0], row[1], sale_day) if row else 0.0
+        daily_units += VELOCITY_ALPHA * quantity
+        c.execute("""INSERT OR REPLACE INTO product_velocity (product_id, daily_units, last_day)
+                     VALUES (?, ?, ?)""", (product_id, daily_units, sale_day))
+
+def find_low_stock(product_ids=None):
+    # Returns dicts for products whose stock is at or below their reorder point
+    query = """SELECT p.id, p.name, p.sku, p.stock, p.purchase_price, p.company_id,
+                      COALESCE(co.name, 'No Company'),
+                      COALESCE(co.lead_time_days, 7), COALESCE(co.safety_days, 3),
+                      v.daily_units, v.last_day
+               FROM product_velocity v
+               JOIN products p ON p.id = v.product_id
+               LEFT JOIN companies co ON co.company_id = p.company_id
+               WHERE v.daily_units > 0"""
+    params = ()
+    if product_ids is not None:
+        if not product_ids:
+            return []
+        query += f" AND p.id IN ({','.join('?' * len(product_ids))})"
+        params = tuple(product_ids)
+    c.execute(query, params)
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    low_stock = []
+    for row in c.fetchall():
+        (product_id, name, sku, stock, purchase_price, company_id, company_name,
+         lead_days, safety_days, daily_units, last_day) = row
+        velocity = decayed_velocity(daily_units, last_day, today)
+        reorder_point = velocity * (lead_days + safety_days)
+        stock = stock or 0
+        if velocity <= 0 or stock > reorder_point:
+            continue
+        suggested = max(1, math.ceil(velocity * (lead_days + REORDER_COVER_DAYS) - stock))
+        low_stock.append({
+            'product_id': product_id,
+            'name': name,
+            'sku': sku,
+            'stock': stock,
+            'purchase_price': purchase_price,
+            'company_id': company_id,
+            'company_name': company_name,
+            'lead_days': lead_days,
+            'velocity': velocity,
+            'reorder_point': reorder_point,
+            'days_of_cover': stock / velocity,
+            'suggested': suggested,
+        })
+    low_stock.sort(key=lambda item: (item['company_name'], item['days_of_cover']))
+    return low_stock
+
+def refresh_low_stock_button():
+    low_stock_button.config(text=f"Low Stock ({len(find_low_stock())})")
+
+def create_purchase_order_drafts(low_stock):
+    # One draft purchase order per company, filled with the suggested quantities
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    by_company = {}
+    for item in low_stock:
+        by_company.setdefault(item['company_id'], []).append(item)
+
+    order_ids = []
+    try:
+        for company_id, items in by_company.items():
+            c.execute("INSERT INTO purchase_orders (company_id, created_at) VALUES (?, ?)",
+                      (company_id, created_at))
+            order_id = c.lastrowid
+            c.executemany("""INSERT INTO purchase_order_items
+                             (purchase_order_id, product_id, quantity, unit_cost)
+                             VALUES (?, ?, ?, ?)""",
+                          [(order_id, item['product_id'], item['suggested'], item['purchase_price'])
+                           for item in items])
+            order_ids.append(order_id)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return order_ids
+
+def show_low_stock():
+    low_stock_window = tk.Toplevel(root)
+    low_stock_window.title("Low Stock")
+    low_stock_window.geometry("1100x600")
+
+    button_row = ttk.Frame(low_stock_window)
+    button_row.pack(fill=tk.X, padx=10, pady=10)
+
+    columns = ("Company", "Name", "SKU", "Stock", "Units/Day", "Lead Days",
+               "Reorder Point", "Days of Cover", "Suggested Qty")
+    tree = ttk.Treeview(low_stock_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=110, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    low_stock = []
+
+    def load():
+        low_stock[:] = find_low_stock()
+        tree.delete(*tree.get_children())
+        for index, item in enumerate(low_stock):
+            tree.insert("", tk.END, iid=str(index), values=(
+                item['company_name'], item['name'], item['sku'], item['stock'],
+                f"{item['velocity']:.2f}", item['lead_days'], f"{item['reorder_point']:.1f}",
+                f"{item['days_of_cover']:.1f}", item['suggested']))
+        refresh_low_stock_button()
+
+    def set_lead_time():
+        selected = tree.selection()
+        if not selected:
+            messagebox.showwarning("Error", "Please select a product first!", parent=low_stock_window)
+            return
+        item = low_stock[int(selected[0])]
+        if item['company_id'] is None:
+            messagebox.showwarning("Error", "This product has no company!", parent=low_stock_window)
+            return
+        lead_days = simpledialog.askinteger(
+            "Lead Time", f"Delivery lead time in days for {item['company_name']}:",
+            initialvalue=item['lead_days'], minvalue=0, parent=low_stock_window)
+        if lead_days is None:
+            return
+        c.execute("UPDATE companies SET lead_time_days = ? WHERE company_id = ?", (lead_days, item['company_id']))
+        conn.commit()
+        load()
+
+    def create_drafts():
+        if not low_stock:
+            messagebox.showinfo("Low Stock", "Nothing needs reordering.", parent=low_stock_window)
+            return
+        try:
+            order_ids = create_purchase_order_drafts(low_stock)
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"An error occurred: {str(e)}", parent=low_stock_window)
+            return
+        messagebox.showinfo("Success", f"Created {len(order_ids)} purchase order draft(s).",
+                            parent=low_stock_window)
+
+    ttk.Button(button_row, text="Refresh", command=load).pack(side=tk.LEFT, padx=5)
+    ttk.Button(button_row, text="Set Company Lead Time", command=set_lead_time).pack(side=tk.LEFT, padx=5)
+    ttk.Button(button_row, text="Create Purchase Order Drafts", command=create_drafts,
+               style="Accent.TButton").pack(side=tk.LEFT, padx=5)
+    ttk.Button(button_row, text="View Purchase Orders", command=show_purchase_orders).pack(side=tk.LEFT, padx=5)
+    load()
+
+def show_purchase_orders():
+    orders_window = tk.Toplevel(root)
+    orders_window.title("Purchase Orders")
+    orders_window.geometry("900x500")
+
+    columns = ("SKU", "Quantity", "Unit Cost", "Total")
+    tree = ttk.Treeview(orders_window, columns=columns, show="tree headings")
+    tree.heading("#0", text="Order / Product")
+    tree.column("#0", width=300)
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=120, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+    c.execute("""SELECT po.id, po.created_at, po.status, COALESCE(co.name, 'No Company')
+                 FROM purchase_orders po
+                 LEFT JOIN companies co ON co.company_id = po.company_id
+                 ORDER BY po.id DESC""")
+    orders = c.fetchall()
+    for order_id, created_at, status, company_name in orders:
+        parent = tree.insert("", tk.END, text=f"PO #{order_id} - {company_name} ({status}, {created_at})")
+        c.execute("""SELECT p.name, p.sku, poi.quantity, poi.unit_cost
+                     FROM purchase_order_items poi
+                     JOIN products p ON p.id = poi.product_id
+                     WHERE poi.purchase_order_id = ?""", (order_id,))
+        for name, sku, quantity, unit_cost in c.fetchall():
+            unit_cost = unit_cost or 0
+            tree.insert(parent, tk.END, text=name, values=(
+                sku, quantity, format_money(unit_cost), format_money(unit_cost * quantity)))
+
+# ------------------------------------------------------------------------------
+# Receipt Printing
+# ------------------------------------------------------------------------------
+# "pdf" writes a thermal-width PDF per invoice into RECEIPT_DIR, "escpos" writes
+# raw ESC/POS bytes either to RECEIPT_DEVICE (e.g. /dev/usb/lp0) or into RECEIPT_DIR.
+RECEIPT_OUTPUT = "pdf"
+RECEIPT_DIR = "receipts"
+RECEIPT_DEVICE = None
+RECEIPT_STORE_NAME = "Hatem Store"
+RECEIPT_FONT_PATH = None  # optional .ttf for product names that Courier cannot draw
+RECEIPT_WIDTH_MM = 80
+RECEIPT_COLUMNS = 42  # characters per line for ESC/POS font A on 80mm paper
+
+# Rendered receipts are produced by a single background worker so the till can
+# keep scanning while the previous customer's receipt is still being written.
+receipt_queue = queue.Queue()
+# Callables queued by background threads and run on the Tk thread
+ui_callbacks = queue.Queue()
+receipt_template = None
+
+def get_receipt_template():
+    # Fonts, page geometry and the fixed header/footer are built once and reused
+    global receipt_template
+    if receipt_template is not None:
+        return receipt_template
+
+    font_name = "Courier"
+    bold_font_name = "Courier-Bold"
+    if RECEIPT_FONT_PATH:
+        pdfmetrics.registerFont(TTFont("ReceiptFont", RECEIPT_FONT_PATH))
+        font_name = bold_font_name = "ReceiptFont"
+
+    width = RECEIPT_WIDTH_MM * mm
+    margin = 4 * mm
+    escpos_init = b"\x1b@"  # reset printer
+    escpos_header = (b"\x1ba\x01" + b"\x1bE\x01" + b"\x1d!\x11"  # centered, bold, double size
+                     + RECEIPT_STORE_NAME.encode("cp437", "replace") + b"\n"
+                     + b"\x1d!\x00" + b"\x1bE\x00" + b"\x1ba\x00")  # back to normal, left aligned
+    escpos_footer = (b"\n" + b"\x1ba\x01" + b"Thank you!\n" + b"\x1ba\x00"
+                     + b"\n\n\n" + b"\x1dV\x41\x03")  # feed and partial cut
+
+    receipt_template = {
+        'font': font_name,
+        'bold_font': bold_font_name,
+        'font_size': 8,
+        'line_height': 10,
+        'width': width,
+        'margin': margin,
+        'text_width': width - 2 * margin,
+        'header_height': 40,
+        'footer_height': 40,
+        'escpos_prefix': escpos_init + escpos_header,
+        'escpos_footer': escpos_footer,
+        'separator': "-" * RECEIPT_COLUMNS,
+    }
+    return receipt_template
+
+def format_receipt_line(left, right, columns=RECEIPT_COLUMNS):
+    # Left text is cut so the amount always stays right aligned
+    space = columns - len(right) - 1
+    return f"{left[:space]:<{space}} {right}"
+
+def render_receipt_pdf(receipt, path):
+    template = get_receipt_template()
+    line_height = template['line_height']
+    body_lines = 4 + 2 * len(receipt['lines'])
+    height = template['header_height'] + body_lines * line_height + template['footer_height']
+
+    c_pdf = canvas.Canvas(path, pagesize=(template['width'], height))
+    left = template['margin']
+    right = template['width'] - template['margin']
+    y = height - 20
+
+    c_pdf.setFont(template['bold_font'], 12)
+    c_pdf.drawCentredString(template['width'] / 2, y, RECEIPT_STORE_NAME)
+    y -= 20
+
+    c_pdf.setFont(template['font'], template['font_size'])
+    c_pdf.drawString(left, y, f"Invoice #{receipt['invoice_id']}")
+    c_pdf.drawRightString(right, y, receipt['date'])
+    y -= line_height
+    c_pdf.line(left, y + 4, right, y + 4)
+    y -= line_height / 2
+
+    for name, quantity, unit_price, total_price in receipt['lines']:
+        c_pdf.drawString(left, y, name[:40])
+        y -= line_height
+        c_pdf.drawString(left + 10, y, f"{quantity} x {format_money(unit_price)}")
+        c_pdf.drawRightString(right, y, format_money(total_price))
+        y -= line_height
+
+    c_pdf.line(left, y + 4, right, y + 4)
+    y -= line_height
+    c_pdf.setFont(template['bold_font'], 10)
+    c_pdf.drawString(left, y, "TOTAL")
+    c_pdf.drawRightString(right, y, format_money(receipt['total']))
+    y -= 2 * line_height
+    c_pdf.setFont(template['font'], template['font_size'])
+    c_pdf.drawCentredString(template['width'] / 2, y, "Thank you!")
+    c_pdf.save()
+
+def render_receipt_escpos(receipt):
+    template = get_receipt_template()
+    text_lines = [
+        format_receipt_line(f"Invoice #{receipt['invoice_id']}", receipt['date']),
+        template['separator'],
+    ]
+    for name, quantity, unit_price, total_price in receipt['lines']:
+        text_lines.append(name[:RECEIPT_COLUMNS])
+        text_lines.append(format_receipt_line(f"  {quantity} x {format_money(unit_price)}", format_money(total_price)))
+    text_lines.append(template['separator'])
+    body = "\n".join(text_lines).encode("cp437", "replace") + b"\n"
+    total = (b"\x1bE\x01" + format_receipt_line("TOTAL", format_money(receipt['total'])).encode("cp437", "replace")
+             + b"\n\x1bE\x00")
+    return template['escpos_prefix'] + body + total + template['escpos_footer']
+
+def print_receipt(receipt):
+    if RECEIPT_OUTPUT == "escpos":
+        data = render_receipt_escpos(receipt)
+        if RECEIPT_DEVICE:
+            with open(RECEIPT_DEVICE, "ab") as device:
+                device.write(data)
+        else:
+            os.makedirs(RECEIPT_DIR, exist_ok=True)
+            with open(os.path.join(RECEIPT_DIR, f"receipt_{receipt['invoice_id']}.bin"), "wb") as spool_file:
+                spool_file.write(data)
+    else:
+        os.makedirs(RECEIPT_DIR, exist_ok=True)
+        render_receipt_pdf(receipt, os.path.join(RECEIPT_DIR, f"receipt_{receipt['invoice_id']}.pdf"))
+
+def receipt_worker():
+    while True:
+        receipt = receipt_queue.get()
+        try:
+            print_receipt(receipt)
+        except Exception as e:
+            # Report on the Tk thread; the worker keeps serving the next receipts
+            ui_callbacks.put(lambda invoice_id=receipt['invoice_id'], error=str(e): messagebox.showerror(
+                "Receipt Error", f"Could not print receipt for invoice #{invoice_id}: {error}"))
+        finally:
+            receipt_queue.task_done()
+
+def queue_receipt(invoice_id):
+    # Builds the receipt data on the Tk thread so the worker never touches the database
+    # Archived invoices (opened from history or search) are read through the all_* views
+    c.execute("SELECT date, total FROM all_invoices WHERE id = ?", (invoice_id,))
+    row = c.fetchone()
+    if row is None:
+        messagebox.showwarning("Error", f"Invoice #{invoice_id} was not found!")
+        return
+    invoice_date, total = row
+    c.execute("""SELECT p.name, ii.quantity, ii.unit_price, ii.total_price
+                 FROM all_invoice_items ii
+                 JOIN products p ON ii.product_id = p.id
+                 WHERE ii.invoice_id = ?""", (invoice_id,))
+    receipt_queue.put({
+        'invoice_id': invoice_id,
+        'date': invoice_date,
+        'lines': c.fetchall(),
+        'total': total,
+    })
+
+receipt_thread = threading.Thread(target=receipt_worker, daemon=True)
+receipt_thread.start()
+
+# ------------------------------------------------------------------------------
+# Stock Ledger, Snapshots and Inventory Valuation
+# ------------------------------------------------------------------------------
+# A new snapshot is taken when the last one is this old or this many movements behind
+SNAPSHOT_INTERVAL_DAYS = 7
+SNAPSHOT_MAX_MOVEMENTS = 20000
+# Snapshots older than this are thinned out to the first one of each month
+SNAPSHOT_KEEP_ALL_DAYS = 90
+
+def record_stock_movements(movements):
+    # movements are (product_id, quantity_change, unit_cost, reason, reference_id);
+    # the caller owns the transaction and commits
+    moved_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.executemany("""INSERT INTO stock_movements
+                     (product_id, moved_at, quantity_change, unit_cost, reason, reference_id)
+                     VALUES (?, ?, ?, ?, ?, ?)""",
+                  [(product_id, moved_at, quantity_change, unit_cost, reason, reference_id)
+                   for product_id, quantity_change, unit_cost, reason, reference_id in movements])
+
+def take_stock_snapshot():
+    taken_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements")
+    last_movement_id = c.fetchone()[0]
+    c.execute("INSERT INTO stock_snapshots (taken_at, last_movement_id) VALUES (?, ?)",
+              (taken_at, last_movement_id))
+    snapshot_id = c.lastrowid
+    c.execute("""INSERT INTO stock_snapshot_items (snapshot_id, product_id, stock, purchase_price)
+                 SELECT ?, id, COALESCE(stock, 0), purchase_price FROM products""", (snapshot_id,))
+    return snapshot_id
+
+def compact_stock_snapshots():
+    # Keep every recent snapshot, but only the first snapshot of each older month
+    cutoff = (datetime.now() - timedelta(days=SNAPSHOT_KEEP_ALL_DAYS)).strftime("%Y-%m-%d")
+    c.execute("""SELECT id FROM stock_snapshots
+                 WHERE taken_at < ?
+                   AND id NOT IN (SELECT MIN(id) FROM stock_snapshots GROUP BY SUBSTR(taken_at, 1, 7))""",
+              (cutoff,))
+    stale_ids = [(row[0],) for row in c.fetchall()]
+    c.executemany("DELETE FROM stock_snapshot_items WHERE snapshot_id = ?", stale_ids)
+    c.executemany("DELETE FROM stock_snapshots WHERE id = ?", stale_ids)
+
+def maybe_take_stock_snapshot():
+    c.execute("SELECT taken_at, last_movement_id FROM stock_snapshots ORDER BY id DESC LIMIT 1")
+    latest = c.fetchone()
+    due = latest is None
+    if latest:
+        taken_at, last_movement_id = latest
+        age = datetime.now() - datetime.strptime(taken_at, "%Y-%m-%d %H:%M:%S")
+        c.execute("SELECT COUNT(*) FROM stock_movements WHERE id > ?", (last_movement_id,))
+        due = age.days >= SNAPSHOT_INTERVAL_DAYS or c.fetchone()[0] >= SNAPSHOT_MAX_MOVEMENTS
+    if due:
+        try:
+            take_stock_snapshot()
+            compact_stock_snapshots()
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+    # Check again in an hour
+    root.after(60 * 60 * 1000, maybe_take_stock_snapshot)
+
+def load_inventory_valuation(as_of_date):
+    # Stock and cost at the end of as_of_date: nearest snapshot plus the ledger deltas in between
+    end = (datetime.strptime(as_of_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    c.execute("""SELECT id, last_movement_id FROM stock_snapshots
+                 WHERE taken_at < ? ORDER BY taken_at DESC, id DESC LIMIT 1""", (end,))
+    snapshot = c.fetchone()
+    if snapshot:
+        # Roll forward: movements recorded after the snapshot, up to the end of the day
+        snapshot_id, last_movement_id = snapshot
+        c.execute('''
+            WITH moves AS (
+                SELECT product_id,
+                       SUM(quantity_change) OVER (PARTITION BY product_id) AS quantity,
+                       unit_cost,
+                       ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY id DESC) AS rn
+                FROM stock_movements
+                WHERE id > ? AND moved_at < ?
+            ), latest AS (
+                SELECT product_id, quantity, unit_cost FROM moves WHERE rn = 1
+            ), base AS (
+                SELECT product_id, stock, purchase_price FROM stock_snapshot_items WHERE snapshot_id = ?
+            ), ids AS (
+                SELECT product_id FROM base UNION SELECT product_id FROM latest
+            )
+            SELECT p.name, p.sku, COALESCE(co.name, 'No Company'),
+                   COALESCE(b.stock, 0) + COALESCE(l.quantity, 0),
+                   COALESCE(l.unit_cost, b.purchase_price, 0)
+            FROM ids
+            JOIN products p ON p.id = ids.product_id
+            LEFT JOIN companies co ON co.company_id = p.company_id
+            LEFT JOIN base b ON b.product_id = ids.product_id
+            LEFT JOIN latest l ON l.product_id = ids.product_id
+            ORDER BY p.name''', (last_movement_id, end, snapshot_id))
+        return c.fetchall()
+
+    c.execute("SELECT id, last_movement_id FROM stock_snapshots ORDER BY id LIMIT 1")
+    snapshot = c.fetchone()
+    if not snapshot:
+        return []
+    # The date is before the first snapshot: roll back the movements after the date
+    snapshot_id, last_movement_id = snapshot
+    c.execute('''
+        WITH undo AS (
+            SELECT product_id, SUM(quantity_change) AS quantity
+            FROM stock_movements
+            WHERE id <= ? AND moved_at >= ?
+            GROUP BY product_id
+        ), cost AS (
+            SELECT product_id, unit_cost,
+                   ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY id DESC) AS rn
+            FROM stock_movements
+            WHERE moved_at < ?
+        )
+        SELECT p.name, p.sku, COALESCE(co.name, 'No Company'),
+               b.stock - COALESCE(u.quantity, 0),
+               COALESCE(k.unit_cost, b.purchase_price, 0)
+        FROM stock_snapshot_items b
+        JOIN products p ON p.id = b.product_id
+        LEFT JOIN companies co ON co.company_id = p.company_id
+        LEFT JOIN undo u ON u.product_id = b.product_id
+        LEFT JOIN cost k ON k.product_id = b.product_id AND k.rn = 1
+        WHERE b.snapshot_id = ?
+        ORDER BY p.name''', (last_movement_id, end, end, snapshot_id))
+    return c.fetchall()
+
+def show_inventory_valuation():
+    valuation_window = tk.Toplevel(root)
+    valuation_window.title("Inventory Valuation")
+    valuation_window.geometry("900x600")
+
+    filter_frame = ttk.Frame(valuation_window)
+    filter_frame.pack(fill=tk.X, padx=10, pady=10)
+
+    ttk.Label(filter_frame, text="As of (YYYY-MM-DD):").pack(side=tk.LEFT, padx=5)
+    date_entry = ttk.Entry(filter_frame, width=12)
+    date_entry.pack(side=tk.LEFT, padx=5)
+    date_entry.insert(0, datetime.now().strftime("%Y-%m-%d"))
+
+    columns = ("Name", "SKU", "Company", "Stock", "Unit Cost", "Value")
+    tree = ttk.Treeview(valuation_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=130, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    summary_label = ttk.Label(valuation_window, text="", font=('Helvetica', 12, 'bold'))
+    summary_label.pack(anchor=tk.W, padx=10, pady=10)
+
+    def run_valuation():
+        try:
+            rows = load_inventory_valuation(date_entry.get().strip())
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a valid date (YYYY-MM-DD)!", parent=valuation_window)
+            return
+
+        tree.delete(*tree.get_children())
+        total_units = 0
+        total_value = 0
+        for name, sku, company, stock, unit_cost in rows:
+            if not stock:
+                continue
+            value = stock * unit_cost
+            total_units += stock
+            total_value += value
+            tree.insert("", tk.END, values=(name, sku, company, stock, format_money(unit_cost), format_money(value)))
+        summary_label.config(text=f"Units: {total_units} - Inventory Value: {format_money(total_value)}")
+
+    ttk.Button(filter_frame, text="Run Report", command=run_valuation,
+               style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+    run_valuation()
+
+# ------------------------------------------------------------------------------
+# Price History
+# ------------------------------------------------------------------------------
+# Unit cost of an invoice line at the time of sale (needs the aliases ii, i and p).
+# Lines without a stored historical cost fall back to the price history.
+COST_AT_SALE_SQL = '''COALESCE(
+    ii.historical_purchase_price,
+    (SELECT ph.new_purchase_price FROM price_history ph
+     WHERE ph.product_id = ii.product_id AND ph.changed_at <= i.date
+     ORDER BY ph.changed_at DESC LIMIT 1),
+    (SELECT ph.old_purchase_price FROM price_history ph
+     WHERE ph.product_id = ii.product_id AND ph.changed_at > i.date
+     ORDER BY ph.changed_at LIMIT 1),
+    p.purchase_price)'''
+
+def record_price_change(product_id, source, old_prices, new_prices):
+    # Prices are (purchase, selling, wholesale); the caller commits
+    c.execute("""INSERT INTO price_history
+                 (product_id, changed_at, source,
+                  old_purchase_price, new_purchase_price,
+                  old_selling_price, new_selling_price,
+                  old_wholesale_price, new_wholesale_price)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+              (product_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), source,
+               old_prices[0], new_prices[0], old_prices[1], new_prices[1], old_prices[2], new_prices[2]))
+
+def show_price_history():
+    selected_item = inventory_tree.selection()
+    if not selected_item:
+        messagebox.showwarning("Error", "Please select a product first!")
+        return
+    item_values = inventory_tree.item(selected_item, 'values')
+    product_id = item_values[0]
+
+    history_window = tk.Toplevel(root)
+    history_window.title(f"Price History - {item_values[1]}")
+    history_window.geometry("900x400")
+
+    columns = ("Date", "Source", "Purchase", "Selling", "Wholesale")
+    tree = ttk.Treeview(history_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=170, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+    c.execute("""SELECT changed_at, source, old_purchase_price, new_purchase_price,
+                        old_selling_price, new_selling_price, old_wholesale_price, new_wholesale_price
+                 FROM price_history
+                 WHERE product_id = ?
+                 ORDER BY changed_at DESC, id DESC""", (product_id,))
+    for changed_at, source, old_p, new_p, old_s, new_s, old_w, new_w in c.fetchall():
+        tree.insert("", tk.END, values=(
+            changed_at, source,
+            f"{format_money(old_p)} → {format_money(new_p)}", f"{format_money(old_s)} → {format_money(new_s)}",
+            f"{format_money(old_w)} → {format_money(new_w)}"))
+
+# ------------------------------------------------------------------------------
+# Daily Company Price Percentage
+# ------------------------------------------------------------------------------
+DAILY_PRICE_CHECK_SECONDS = 15 * 60
+
+def apply_daily_price_percentages(db):
+    # Applies companies.daily_price_percentage for every day since the last run, for
+    # all companies in one transaction. A gap of N days uses (1 + pct/100) ** N once,
+    # so catching up is the same as having run every day. Returns the run summary or None.
+    cur = db.cursor()
+    today = datetime.now().strftime("%Y-%m-%d")
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT value FROM app_settings WHERE key = 'daily_price_last_applied'")
+        row = cur.fetchone()
+        if row is None:
+            # First start: begin counting from today instead of from the beginning of time
+            cur.execute("INSERT INTO app_settings (key, value) VALUES ('daily_price_last_applied', ?)", (today,))
+            db.commit()
+            return None
+        last_applied = row[0]
+        days = (datetime.strptime(today, "%Y-%m-%d") - datetime.strptime(last_applied, "%Y-%m-%d")).days
+        if days <= 0:
+            db.rollback()
+            return None
+
+        cur.execute("""SELECT company_id, daily_price_percentage FROM companies
+                       WHERE COALESCE(daily_price_percentage, 0) != 0""")
+        factors = [(company_id, (1 + pct / 100) ** days) for company_id, pct in cur.fetchall()]
+
+        changed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS daily_price_factors (company_id INTEGER PRIMARY KEY, factor REAL)")
+        cur.execute("DELETE FROM daily_price_factors")
+        cur.executemany("INSERT INTO daily_price_factors (company_id, factor) VALUES (?, ?)", factors)
+
+        cur.execute("""INSERT INTO price_history
+                       (product_id, changed_at, source,
+                        old_purchase_price, new_purchase_price,
+                        old_selling_price, new_selling_price,
+                        old_wholesale_price, new_wholesale_price)
+                       SELECT p.id, ?, 'daily_percentage',
+                              p.purchase_price, CAST(ROUND(p.purchase_price * f.factor) AS INTEGER),
+                              p.selling_price, CAST(ROUND(p.selling_price * f.factor) AS INTEGER),
+                              p.wholesale_price, CAST(ROUND(p.wholesale_price * f.factor) AS INTEGER)
+                       FROM products p
+                       JOIN daily_price_factors f ON f.company_id = p.company_id""", (changed_at,))
+        product_count = cur.rowcount
+
+        cur.execute("""UPDATE products
+                       SET purchase_price = CAST(ROUND(purchase_price * (SELECT factor FROM daily_price_factors f WHERE f.company_id = products.company_id)) AS INTEGER),
+                           selling_price = CAST(ROUND(selling_price * (SELECT factor FROM daily_price_factors f WHERE f.company_id = products.company_id)) AS INTEGER),
+                           wholesale_price = CAST(ROUND(wholesale_price * (SELECT factor FROM daily_price_factors f WHERE f.company_id = products.company_id)) AS INTEGER)
+                       WHERE company_id IN (SELECT company_id FROM daily_price_factors)""")
+
+        cur.execute("""INSERT INTO stock_movements
+                       (product_id, moved_at, quantity_change, unit_cost, reason)
+                       SELECT id, ?, 0, purchase_price, 'price' FROM products
+                       WHERE company_id IN (SELECT company_id FROM daily_price_factors)""", (changed_at,))
+
+        cur.execute("""INSERT INTO daily_price_runs (run_at, from_date, to_date, days, companies, products)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (changed_at, last_applied, today, days, len(factors), product_count))
+        cur.execute("UPDATE app_settings SET value = ? WHERE key = 'daily_price_last_applied'", (today,))
+        db.commit()
+        return {'days': days, 'companies': len(factors), 'products': product_count}
+    except Exception:
+        db.rollback()
+        raise
+
+def daily_price_worker():
+    # Runs off the Tk thread with its own connection
+    db = sqlite3.connect('inventory.db', timeout=30)
+    while True:
+        try:
+            summary = apply_daily_price_percentages(db)
+            if summary and summary['products']:
+                ui_callbacks.put(view_products)
+                request_report_refresh()
+                invalidate_product_cache()
+        except sqlite3.Error as e:
+            print(f"Daily price update failed: {e}")
+        time.sleep(DAILY_PRICE_CHECK_SECONDS)
+
+def show_daily_price_runs():
+    runs_window = tk.Toplevel(root)
+    runs_window.title("Daily Price Updates")
+    runs_window.geometry("800x400")
+
+    columns = ("Run At", "From", "To", "Days", "Companies", "Products")
+    tree = ttk.Treeview(runs_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=120, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+    c.execute("""SELECT run_at, from_date, to_date, days, companies, products
+                 FROM daily_price_runs ORDER BY id DESC""")
+    for row in c.fetchall():
+        tree.insert("", tk.END, values=row)
+
+# ------------------------------------------------------------------------------
+# Reporting Replica
+# ------------------------------------------------------------------------------
+# History, details, exports and analytics read from an in-memory copy of the
+# database made with the online backup API, so long reports never share the
+# connection (or the locks) that submit_invoice writes through.
+REPORT_REFRESH_SECONDS = 5 * 60  # refresh at least this often
+REPORT_MIN_REFRESH_SECONDS = 30  # and never more often than this
+REPORT_BACKUP_PAGES = 1024  # pages copied per backup step
+REPORT_BACKUP_SLEEP = 0.005  # pause between steps so writers get the file
+
+report_db = None
+report_refreshed_at = None
+report_db_lock = threading.Lock()
+report_refresh_event = threading.Event()
+
+def refresh_report_replica():
+    global report_db, report_refreshed_at
+    source = sqlite3.connect('inventory.db', timeout=30)
+    replica = sqlite3.connect(':memory:', check_same_thread=False)
+    try:
+        source.backup(replica, pages=REPORT_BACKUP_PAGES, sleep=REPORT_BACKUP_SLEEP)
+    finally:
+        source.close()
+    attach_archives(replica)
+    # Readers holding a cursor on the old copy keep it alive until they are done
+    with report_db_lock:
+        report_db = replica
+        report_refreshed_at = datetime.now()
+
+def request_report_refresh():
+    report_refresh_event.set()
+
+def report_replica_worker():
+    last_refresh = 0.0
+    while True:
+        report_refresh_event.wait(REPORT_REFRESH_SECONDS)
+        wait = REPORT_MIN_REFRESH_SECONDS - (time.monotonic() - last_refresh)
+        if wait > 0:
+            time.sleep(wait)
+        report_refresh_event.clear()
+        try:
+            refresh_report_replica()
+        except sqlite3.Error as e:
+            print(f"Reporting replica refresh failed: {e}")
+        last_refresh = time.monotonic()
+
+def get_report_cursor():
+    # Falls back to the live connection until the first copy is ready
+    with report_db_lock:
+        if report_db is not None:
+            return report_db.cursor()
+    return c
+
+def report_freshness_text():
+    if report_refreshed_at is None:
+        return "Live data"
+    return f"Data as of {report_refreshed_at.strftime('%H:%M:%S')}"
+
+# ------------------------------------------------------------------------------
+# Report Cache
+# ------------------------------------------------------------------------------
+# History figures and rendered exports are kept under a watermark: the highest
+# invoice id plus report_version, which sync.py bumps when it rewrites an invoice
+# that already exists. New invoices only raise the id, so an outdated entry is
+# brought up to date by reloading the days from the earliest new invoice on
+# (usually just today). Entries are dropped least recently used once they add up
+# to more than REPORT_CACHE_MAX_BYTES.
+REPORT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+REPORT_CACHE_ROW_BYTES = 200  # rough size of one cached row, for the size bound
+
+report_cache = OrderedDict()  # name -> (watermark, value, size)
+report_cache_bytes = 0
+
+def report_watermark(rc):
+    rc.execute("""SELECT COALESCE((SELECT MAX(id) FROM main.invoices), (SELECT MAX(id) FROM all_invoices), 0),
+                         COALESCE((SELECT CAST(value AS INTEGER) FROM app_settings
+                                   WHERE key = 'report_version'), 0)""")
+    return tuple(rc.fetchone())
+
+def report_cache_get(name):
+    entry = report_cache.get(name)
+    if entry is not None:
+        report_cache.move_to_end(name)
+    return entry
+
+def report_cache_put(name, watermark, value, size):
+    global report_cache_bytes
+    old_entry = report_cache.pop(name, None)
+    if old_entry is not None:
+        report_cache_bytes -= old_entry[2]
+    if size > REPORT_CACHE_MAX_BYTES:
+        return
+    report_cache[name] = (watermark, value, size)
+    report_cache_bytes += size
+    while report_cache_bytes > REPORT_CACHE_MAX_BYTES:
+        _, (_, _, evicted_size) = report_cache.popitem(last=False)
+        report_cache_bytes -= evicted_size
+
+def cached_report_days(rc, name, load_days, row_count=None):
+    # load_days(rc, from_day) returns (day, value) pairs for the days from from_day
+    # on (every day for None); row_count(value) sizes a day for eviction.
+    # Returns (watermark, {day: value}); the dict is shared, so do not change it.
+    watermark = report_watermark(rc)
+    entry = report_cache_get(name)
+    if entry is not None and entry[0] == watermark:
+        return watermark, entry[1]
+
+    first_day = None
+    if entry is not None and entry[0][1] == watermark[1] and entry[0][0] < watermark[0]:
+        rc.execute("SELECT MIN(date) FROM main.invoices WHERE id > ?", (entry[0][0],))
+        first_day = (rc.fetchone()[0] or "")[:10] or None
+    if first_day:
+        days = {day: value for day, value in entry[1].items() if day < first_day}
+        days.update(load_days(rc, first_day))
+    else:
+        days = dict(load_days(rc, None))
+
+    rows = sum(row_count(value) for value in days.values()) if row_count else len(days)
+    report_cache_put(name, watermark, days, rows * REPORT_CACHE_ROW_BYTES)
+    return watermark, days
+
+def load_daily_rows(rc, from_day):
+    rc.execute("""SELECT day, invoice_count, revenue, revenue - cost
+                  FROM daily_sales WHERE day >= ?""", (from_day or "",))
+    return [(day, (count, revenue, profit)) for day, count, revenue, profit in rc.fetchall()]
+
+def load_day_invoices(rc, from_day):
+    # Invoice rows ready for display: (id, title, time, total text), newest first
+    rc.execute("""SELECT id, date, total, refund_of FROM all_invoices
+                  WHERE date >= ? ORDER BY date DESC, id DESC""", (from_day or "",))
+    days = []
+    for day, invoices in groupby(rc.fetchall(), key=lambda row: row[1][:10]):
+        days.append((day, [(invoice_id,
+                            f"Refund #{invoice_id} (of #{refund_of})" if refund_of else f"Invoice #{invoice_id}",
+                            invoice_date[11:19], format_money(total))
+                           for invoice_id, invoice_date, total, refund_of in invoices]))
+    return days
+
+def load_daily_history(rc):
+    # [(day, invoice count, revenue, profit)], newest day first
+    _, daily = cached_report_days(rc, 'daily', load_daily_rows)
+    return [(day, *daily[day]) for day in sorted(daily, reverse=True)]
+
+def load_history_days(rc):
+    # load_daily_history rows with each day's invoices appended
+    _, day_invoices = cached_report_days(rc, 'day_invoices', load_day_invoices, len)
+    return [row + (day_invoices.get(row[0], []),) for row in load_daily_history(rc)]
+
+def cached_report_artifact(rc, name, render):
+    # render(daily history rows) -> bytes; rendered again only when the watermark moves
+    rows = load_daily_history(rc)
+    watermark = report_watermark(rc)
+    entry = report_cache_get(name)
+    if entry is not None and entry[0] == watermark:
+        return entry[1]
+    data = render(rows)
+    report_cache_put(name, watermark, data, len(data))
+    return data
+
+# ------------------------------------------------------------------------------
+# Invoice Archive
+# ------------------------------------------------------------------------------
+# Invoices older than the horizon are moved into one database per year
+# (archive/inventory_<year>.db). Reports read the all_invoices / all_invoice_items
+# views, which put the main tables and every attached archive together.
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 730  # default horizon, can be changed in the archive window
+ARCHIVED_TABLES = ("invoices", "invoice_items")
+# SQLite attaches at most 10 databases per connection (SQLITE_MAX_ATTACHED). The
+# newest years are attached first; older ones past the limit are left out of the
+# reports and listed in the archive window, instead of the app failing to start.
+ARCHIVE_ATTACH_LIMIT = 10
+unattached_archives = []  # file paths left out by the last attach_archives call
+
+def add_daily_sales(cur, day, invoice_count, revenue, cost):
+    cur.execute("""INSERT INTO daily_sales (day, invoice_count, revenue, cost)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(day) DO UPDATE SET
+                       invoice_count = invoice_count + excluded.invoice_count,
+                       revenue = revenue + excluded.revenue,
+                       cost = cost + excluded.cost""",
+                (day, invoice_count, revenue, cost))
+
+def backfill_daily_sales():
+    # One-off: build the rollup from the invoices that existed before it
+    c.execute("SELECT EXISTS (SELECT 1 FROM daily_sales)")
+    if c.fetchone()[0]:
+        return
+    c.execute(f'''INSERT INTO daily_sales (day, invoice_count, revenue, cost)
+                  SELECT DATE(i.date), COUNT(*), SUM(i.total),
+                         SUM((SELECT COALESCE(SUM(ii.quantity * {COST_AT_SALE_SQL}), 0)
+                              FROM invoice_items ii
+                              JOIN products p ON ii.product_id = p.id
+                              WHERE ii.invoice_id = i.id))
+                  FROM invoices i
+                  GROUP BY DATE(i.date)''')
+    conn.commit()
+
+def archive_path(year):
+    return os.path.join(ARCHIVE_DIR, f"inventory_{year}.db")
+
+def upgrade_archive_file(path):
+    # Archives written by older versions: the one-time switch to cents and the
+    # product index used by invoice search
+    if not os.path.exists(path):
+        return
+    archive_db = sqlite3.connect(path, timeout=30)
+    try:
+        migrate_money_columns(archive_db.cursor())
+        archive_db.execute("""CREATE INDEX IF NOT EXISTS idx_invoice_items_product_invoice
+                              ON invoice_items(product_id, invoice_id)""")
+        archive_db.commit()
+    finally:
+        archive_db.close()
+
+def attach_archives(db):
+    # Attaches the yearly archives to `db`, newest first and no more than the limit
+    # allows, and (re)creates the all_* temp views
+    cur = db.cursor()
+    cur.execute("PRAGMA database_list")
+    attached = {row[1] for row in cur.fetchall()}
+    schemas = ["main"]
+    skipped = []
+    for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, "inventory_*.db")), reverse=True):
+        schema = "archive_" + os.path.basename(path)[len("inventory_"):-len(".db")]
+        if schema not in attached:
+            if len(schemas) > ARCHIVE_ATTACH_LIMIT or skipped:
+                skipped.append(path)
+                continue
+            upgrade_archive_file(path)
+            try:
+                cur.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+            except sqlite3.OperationalError:
+                # This SQLite was built with a lower limit
+                skipped.append(path)
+                continue
+        schemas.append(schema)
+    unattached_archives[:] = skipped
+
+    for table in ARCHIVED_TABLES:
+        cur.execute(f"PRAGMA main.table_info({table})")
+        columns = [row[1] for row in cur.fetchall()]
+        selects = []
+        for schema in schemas:
+            cur.execute(f"PRAGMA {schema}.table_info({table})")
+            present = {row[1] for row in cur.fetchall()}
+            if not present:
+                continue
+            # Older archives may miss columns added later
+            select_list = ", ".join(col if col in present else f"NULL AS {col}" for col in columns)
+            selects.append(f"SELECT {select_list} FROM {schema}.{table}")
+        cur.execute(f"DROP VIEW IF EXISTS temp.all_{table}")
+        cur.execute(f"CREATE TEMP VIEW all_{table} AS " + " UNION ALL ".join(selects))
+
+def prepare_archive_tables(cur):
+    # Creates the attached "archive" tables and adds columns the main tables gained since
+    cur.execute("""CREATE TABLE IF NOT EXISTS archive.invoices (
+                       id INTEGER PRIMARY KEY,
+                       date TEXT NOT NULL,
+                       total INTEGER NOT NULL
+                   )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS archive.invoice_items (
+                       invoice_id INTEGER,
+                       product_id INTEGER,
+                       quantity INTEGER,
+                       unit_price INTEGER,
+                       total_price INTEGER,
+                       historical_purchase_price INTEGER,
+                       historical_selling_price INTEGER
+                   )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_invoices_date ON invoices(date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_invoice_items_invoice ON invoice_items(invoice_id)")
+    cur.execute("""CREATE INDEX IF NOT EXISTS archive.idx_invoice_items_product_invoice
+                   ON invoice_items(product_id, invoice_id)""")
+
+    columns = {}
+    for table in ARCHIVED_TABLES:
+        cur.execute(f"PRAGMA main.table_info({table})")
+        main_columns = [(row[1], row[2]) for row in cur.fetchall()]
+        cur.execute(f"PRAGMA archive.table_info({table})")
+        archive_columns = {row[1] for row in cur.fetchall()}
+        for name, declared_type in main_columns:
+            if name not in archive_columns:
+                cur.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {declared_type}")
+        columns[table] = ", ".join(name for name, _ in main_columns)
+    return columns
+
+def archive_old_invoices(horizon_days):
+    # Moves invoices older than the horizon one month at a time, so each write
+    # transaction stays short. Runs on its own connection. Returns the invoices moved.
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    cutoff = (datetime.now() - timedelta(days=horizon_days)).strftime("%Y-%m-%d")
+    db = sqlite3.connect('inventory.db', timeout=30)
+    cur = db.cursor()
+    moved = 0
+    try:
+        cur.execute("SELECT DISTINCT SUBSTR(date, 1, 7) FROM invoices WHERE date < ? ORDER BY 1", (cutoff,))
+        months = [row[0] for row in cur.fetchall()]
+        for month in months:
+            start = f"{month}-01"
+            end = min((datetime.strptime(start, "%Y-%m-%d") + timedelta(days=32)).strftime("%Y-%m-01"), cutoff)
+            upgrade_archive_file(archive_path(month[:4]))
+            cur.execute("ATTACH DATABASE ? AS archive", (archive_path(month[:4]),))
+            try:
+                columns = prepare_archive_tables(cur)
+                db.commit()
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute(f"""INSERT INTO archive.invoices ({columns['invoices']})
+                                SELECT {columns['invoices']} FROM main.invoices
+                                WHERE date >= ? AND date < ?""", (start, end))
+                moved += cur.rowcount
+                cur.execute(f"""INSERT INTO archive.invoice_items ({columns['invoice_items']})
+                                SELECT {columns['invoice_items']} FROM main.invoice_items
+                                WHERE invoice_id IN (SELECT id FROM main.invoices WHERE date >= ? AND date < ?)""",
+                            (start, end))
+                cur.execute("""DELETE FROM main.invoice_items
+                               WHERE invoice_id IN (SELECT id FROM main.invoices WHERE date >= ? AND date < ?)""",
+                            (start, end))
+                cur.execute("DELETE FROM main.invoices WHERE date >= ? AND date < ?", (start, end))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                cur.execute("DETACH DATABASE archive")
+    finally:
+        db.close()
+    return moved
+
+def show_archive():
+    archive_window = tk.Toplevel(root)
+    archive_window.title("Invoice Archive")
+    archive_window.geometry("600x400")
+
+    columns = ("Year", "File", "Invoices", "In Reports")
+    tree = ttk.Treeview(archive_window, columns=columns, show="headings", height=8)
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=140, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+    def load():
+        tree.delete(*tree.get_children())
+        for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, "inventory_*.db"))):
+            archive_db = sqlite3.connect(path)
+            try:
+                count = archive_db.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+            finally:
+                archive_db.close()
+            year = os.path.basename(path)[len("inventory_"):-len(".db")]
+            tree.insert("", tk.END, values=(year, path, count,
+                                            "No (attach limit)" if path in unattached_archives else "Yes"))
+
+    controls = ttk.Frame(archive_window)
+    controls.pack(fill=tk.X, padx=10, pady=10)
+
+    c.execute("SELECT value FROM app_settings WHERE key = 'archive_after_days'")
+    row = c.fetchone()
+    ttk.Label(controls, text="Archive invoices older than (days):").pack(side=tk.LEFT, padx=5)
+    horizon_entry = ttk.Entry(controls, width=8)
+    horizon_entry.pack(side=tk.LEFT, padx=5)
+    horizon_entry.insert(0, row[0] if row else str(ARCHIVE_AFTER_DAYS))
+
+    status_label = ttk.Label(archive_window, text="")
+    status_label.pack(anchor=tk.W, padx=10, pady=5)
+
+    def finished(moved, error=None):
+        archive_button.config(state=tk.NORMAL)
+        if error:
+            status_label.config(text="")
+            messagebox.showerror("Error", f"Archiving failed: {error}", parent=archive_window)
+            return
+        status_label.config(text=f"Moved {moved} invoices to the archive.")
+        attach_archives(conn)
+        request_report_refresh()
+        load()
+
+    def run_archive():
+        try:
+            horizon_days = int(horizon_entry.get())
+            if horizon_days < 1:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a positive number of days!", parent=archive_window)
+            return
+        c.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('archive_after_days', ?)",
+                  (str(horizon_days),))
+        conn.commit()
+
+        def work():
+            try:
+                moved = archive_old_invoices(horizon_days)
+                ui_callbacks.put(lambda: finished(moved))
+            except Exception as e:
+                ui_callbacks.put(lambda error=str(e): finished(0, error))
+
+        archive_button.config(state=tk.DISABLED)
+        status_label.config(text="Archiving...")
+        threading.Thread(target=work, daemon=True).start()
+
+    archive_button = ttk.Button(controls, text="Archive Now", command=run_archive, style="Accent.TButton")
+    archive_button.pack(side=tk.LEFT, padx=10)
+    load()
+
+# ------------------------------------------------------------------------------
+# Stocktake Mode
+# ------------------------------------------------------------------------------
+# While set, check_barcode_queue hands every (sku, quantity) to this callable
+# instead of adding it to the current invoice.
+active_scan_handler = None
+
+def commit_stocktake(started_at, counts):
+    # counts maps product_id -> counted units. Everything is written in one
+    # transaction; scanned products are set to their count, others are untouched.
+    committed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS stocktake_counts (product_id INTEGER PRIMARY KEY, counted INTEGER)")
+        c.execute("DELETE FROM stocktake_counts")
+        c.executemany("INSERT INTO stocktake_counts (product_id, counted) VALUES (?, ?)", list(counts.items()))
+
+        c.execute("""SELECT COALESCE(SUM(t.counted - COALESCE(p.stock, 0)), 0)
+                     FROM stocktake_counts t JOIN products p ON p.id = t.product_id""")
+        net_variance = c.fetchone()[0]
+        c.execute("""INSERT INTO stocktakes (started_at, committed_at, products_counted, net_variance)
+                     VALUES (?, ?, ?, ?)""", (started_at, committed_at, len(counts), net_variance))
+        stocktake_id = c.lastrowid
+
+        # One ledger row per SKU whose count differs from the books
+        c.execute("""INSERT INTO stock_movements
+                     (product_id, moved_at, quantity_change, unit_cost, reason, reference_id)
+                     SELECT p.id, ?, t.counted - COALESCE(p.stock, 0), p.purchase_price, 'stocktake', ?
+                     FROM stocktake_counts t JOIN products p ON p.id = t.product_id
+                     WHERE t.counted != COALESCE(p.stock, 0)""", (committed_at, stocktake_id))
+        c.execute("""UPDATE products
+                     SET stock = (SELECT counted FROM stocktake_counts t WHERE t.product_id = products.id)
+                     WHERE id IN (SELECT product_id FROM stocktake_counts)""")
+        trim_lots_to_stock(c)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return net_variance
+
+def show_stocktake():
+    global active_scan_handler
+    if active_scan_handler is not None:
+        messagebox.showwarning("Error", "Another scanning session is already open!")
+        return
+
+    stocktake_window = tk.Toplevel(root)
+    stocktake_window.title("Stocktake")
+    stocktake_window.geometry("900x650")
+
+    started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # One query up front; scans are then resolved from memory
+    c.execute("SELECT sku, id, name, COALESCE(stock, 0) FROM products WHERE sku IS NOT NULL")
+    catalog = {sku: (product_id, name, stock) for sku, product_id, name, stock in c.fetchall()}
+    catalog_stock = {product_id: stock for product_id, _, stock in catalog.values()}
+    counts = {}
+    unknown = {}
+
+    ttk.Label(stocktake_window, text="Scan items to count them. Products that are not scanned keep their stock.",
+              font=('Helvetica', 10)).pack(anchor=tk.W, padx=10, pady=5)
+
+    # Manual entry for keyboard wedge scanners or typed counts
+    entry_frame = ttk.Frame(stocktake_window)
+    entry_frame.pack(fill=tk.X, padx=10, pady=5)
+    ttk.Label(entry_frame, text="SKU:").pack(side=tk.LEFT, padx=5)
+    sku_entry = ttk.Entry(entry_frame)
+    sku_entry.pack(side=tk.LEFT, padx=5)
+    ttk.Label(entry_frame, text="Qty:").pack(side=tk.LEFT, padx=5)
+    qty_var = tk.IntVar(value=1)
+    ttk.Spinbox(entry_frame, from_=-9999, to=99999, textvariable=qty_var, width=6).pack(side=tk.LEFT, padx=5)
+
+    columns = ("SKU", "Name", "Expected", "Counted", "Variance")
+    tree = ttk.Treeview(stocktake_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=150, anchor="center")
+    tree.tag_configure("variance", foreground="orange")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    summary_label = ttk.Label(stocktake_window, text="", font=('Helvetica', 12, 'bold'))
+    summary_label.pack(anchor=tk.W, padx=10, pady=5)
+
+    def update_summary():
+        net = sum(counted - catalog_stock[product_id] for product_id, counted in counts.items())
+        summary_label.config(text=f"Products counted: {len(counts)} - Units: {sum(counts.values())} - "
+                                  f"Net variance: {net:+d} - Unknown SKUs: {len(unknown)}")
+
+    def show_row(product_id, sku, name):
+        counted = counts[product_id]
+        variance = counted - catalog_stock[product_id]
+        values = (sku, name, catalog_stock[product_id], counted, f"{variance:+d}")
+        tags = ("variance",) if variance else ()
+        iid = str(product_id)
+        if tree.exists(iid):
+            tree.item(iid, values=values, tags=tags)
+        else:
+            tree.insert("", 0, iid=iid, values=values, tags=tags)
+
+    def count_scan(sku, quantity):
+        product = catalog.get(sku)
+        if product is None:
+            unknown[sku] = unknown.get(sku, 0) + quantity
+            iid = f"unknown:{sku}"
+            values = (sku, "Unknown SKU", "-", unknown[sku], "-")
+            if tree.exists(iid):
+                tree.item(iid, values=values)
+            else:
+                tree.insert("", 0, iid=iid, values=values, tags=("variance",))
+        else:
+            product_id, name, _ = product
+            counts[product_id] = max(0, counts.get(product_id, 0) + quantity)
+            show_row(product_id, sku, name)
+        update_summary()
+
+    def add_manual(event=None):
+        sku = sku_entry.get().strip()
+        try:
+            quantity = qty_var.get()
+        except tk.TclError:
+            messagebox.showerror("Error", "Please enter a valid quantity!", parent=stocktake_window)
+            return
+        if sku:
+            count_scan(sku, quantity)
+        sku_entry.delete(0, tk.END)
+        qty_var.set(1)
+        sku_entry.focus_set()
+
+    sku_entry.bind("<Return>", add_manual)
+    ttk.Button(entry_frame, text="Add", command=add_manual).pack(side=tk.LEFT, padx=5)
+
+    def close_session():
+        global active_scan_handler
+        if counts and not messagebox.askyesno("Stocktake", "Discard the counts that were not committed?",
+                                              parent=stocktake_window):
+            return
+        active_scan_handler = None
+        stocktake_window.destroy()
+
+    def commit():
+        global active_scan_handler
+        if not counts:
+            messagebox.showwarning("Error", "Nothing has been counted yet!", parent=stocktake_window)
+            return
+        if not messagebox.askyesno("Stocktake", f"Set the stock of {len(counts)} products to the counted quantities?",
+                                   parent=stocktake_window):
+            return
+        try:
+            net_variance = commit_stocktake(started_at, counts)
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"An error occurred: {str(e)}", parent=stocktake_window)
+            return
+        invalidate_product_cache(list(counts))
+        request_report_refresh()
+        view_products()
+        refresh_low_stock_button()
+        messagebox.showinfo("Success", f"Stocktake committed. Net variance: {net_variance:+d} units.",
+                            parent=stocktake_window)
+        active_scan_handler = None
+        stocktake_window.destroy()
+
+    button_row = ttk.Frame(stocktake_window)
+    button_row.pack(fill=tk.X, padx=10, pady=10)
+    ttk.Button(button_row, text="Commit Count", command=commit, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
+    ttk.Button(button_row, text="Cancel", command=close_session).pack(side=tk.RIGHT, padx=5)
+
+    stocktake_window.protocol("WM_DELETE_WINDOW", close_session)
+    active_scan_handler = count_scan
+    update_summary()
+    sku_entry.focus_set()
+
+# ------------------------------------------------------------------------------
+# Returns and Refunds
+# ------------------------------------------------------------------------------
+def load_returnable_lines(invoice_id):
+    # Lines of a (non-archived) invoice with what was already returned against it
+    c.execute("SELECT refund_of FROM invoices WHERE id = ?", (invoice_id,))
+    row = c.fetchone()
+    if row is None:
+        raise ValueError("This invoice is archived or does not exist and cannot be returned.")
+    if row[0] is not None:
+        raise ValueError("This is already a refund.")
+    c.execute("""SELECT ii.product_id, p.name, ii.quantity,
+                        COALESCE((SELECT -SUM(ri.quantity)
+                                  FROM invoice_items ri
+                                  JOIN invoices r ON r.id = ri.invoice_id
+                                  WHERE r.refund_of = ii.invoice_id AND ri.product_id = ii.product_id), 0)
+                 FROM invoice_items ii
+                 JOIN products p ON p.id = ii.product_id
+                 WHERE ii.invoice_id = ?""", (invoice_id,))
+    return c.fetchall()
+
+def process_return(invoice_id, return_quantities):
+    # return_quantities maps product_id -> units coming back. Creates a credit
+    # invoice at the original historical prices and restores stock with one update.
+    # Returns the credit invoice id.
+    refund_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        c.execute("BEGIN TRANSACTION")
+        # Checked again inside the transaction, so a second return of the same lines
+        # cannot refund more than was sold
+        for product_id, name, sold, returned in load_returnable_lines(invoice_id):
+            if return_quantities.get(product_id, 0) > sold - returned:
+                raise ValueError(f"Only {sold - returned} of {name} can still be returned.")
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS return_lines (product_id INTEGER PRIMARY KEY, quantity INTEGER)")
+        c.execute("DELETE FROM return_lines")
+        c.executemany("INSERT INTO return_lines (product_id, quantity) VALUES (?, ?)",
+                      [(product_id, quantity) for product_id, quantity in return_quantities.items() if quantity > 0])
+
+        c.execute("""SELECT SUM(CAST(ROUND(r.quantity * ii.total_price * 1.0 / ii.quantity) AS INTEGER)),
+                            SUM(r.quantity * ii.historical_purchase_price)
+                     FROM return_lines r
+                     JOIN invoice_items ii ON ii.product_id = r.product_id AND ii.invoice_id = ?""",
+                  (invoice_id,))
+        refund_total, refund_cost = c.fetchone()
+        if refund_total is None:
+            raise ValueError("Nothing to return.")
+
+        c.execute("INSERT INTO invoices (date, total, refund_of) VALUES (?, ?, ?)",
+                  (refund_date, -refund_total, invoice_id))
+        credit_id = c.lastrowid
+
+        # Negative lines carry the original historical prices (and their share of any
+        # promotion discount), so profit reports stay exact
+        c.execute("""INSERT INTO invoice_items
+                     (invoice_id, product_id, quantity, unit_price, total_price,
+                      historical_purchase_price, historical_selling_price,
+                      discount, promotion_id)
+                     SELECT ?, ii.product_id, -r.quantity, ii.unit_price,
+                            -CAST(ROUND(r.quantity * ii.total_price * 1.0 / ii.quantity) AS INTEGER),
+                            ii.historical_purchase_price, ii.historical_selling_price,
+                            -CAST(ROUND(r.quantity * COALESCE(ii.discount, 0) * 1.0 / ii.quantity) AS INTEGER), ii.promotion_id
+                     FROM return_lines r
+                     JOIN invoice_items ii ON ii.product_id = r.product_id AND ii.invoice_id = ?""",
+                  (credit_id, invoice_id))
+
+        c.execute("""INSERT INTO stock_movements
+                     (product_id, moved_at, quantity_change, unit_cost, reason, reference_id)
+                     SELECT ii.product_id, ?, r.quantity, ii.historical_purchase_price, 'return', ?
+                     FROM return_lines r
+                     JOIN invoice_items ii ON ii.product_id = r.product_id AND ii.invoice_id = ?""",
+                  (refund_date, credit_id, invoice_id))
+
+        # Relative update, so sales made since the original invoice are kept
+        c.execute("""UPDATE products
+                     SET stock = COALESCE(stock, 0) + (SELECT quantity FROM return_lines r WHERE r.product_id = products.id)
+                     WHERE id IN (SELECT product_id FROM return_lines)""")
+        restore_returned_lots(c, invoice_id, credit_id)
+
+        add_daily_sales(c, refund_date[:10], 1, -refund_total, -refund_cost)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return credit_id
+
+def show_return_dialog(invoice_id):
+    try:
+        lines = load_returnable_lines(invoice_id)
+    except ValueError as e:
+        messagebox.showwarning("Error", str(e))
+        return
+
+    return_window = tk.Toplevel(root)
+    return_window.title(f"Return Items - Invoice #{invoice_id}")
+    return_window.geometry("600x400")
+    return_window.transient(root)
+    return_window.grab_set()
+
+    lines_frame = ttk.Frame(return_window)
+    lines_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+    for col, header in enumerate(["Product", "Sold", "Returned", "Return Now"]):
+        ttk.Label(lines_frame, text=header, font=('Helvetica', 10, 'bold')).grid(row=0, column=col, padx=5, pady=5)
+
+    return_vars = {}
+    for row, (product_id, name, sold, returned) in enumerate(lines, start=1):
+        returnable = sold - returned
+        ttk.Label(lines_frame, text=name, width=25).grid(row=row, column=0, padx=5, sticky=tk.W)
+        ttk.Label(lines_frame, text=str(sold)).grid(row=row, column=1, padx=5)
+        ttk.Label(lines_frame, text=str(returned)).grid(row=row, column=2, padx=5)
+        return_var = tk.IntVar(value=0)
+        spinbox = ttk.Spinbox(lines_frame, from_=0, to=max(returnable, 0), textvariable=return_var, width=6)
+        spinbox.grid(row=row, column=3, padx=5)
+        if returnable <= 0:
+            spinbox.config(state=tk.DISABLED)
+        return_vars[product_id] = (return_var, returnable)
+
+    def return_all():
+        for return_var, returnable in return_vars.values():
+            return_var.set(max(returnable, 0))
+
+    def confirm_return():
+        quantities = {}
+        try:
+            for product_id, (return_var, returnable) in return_vars.items():
+                quantity = return_var.get()
+                if quantity < 0 or quantity > returnable:
+                    raise ValueError
+                if quantity:
+                    quantities[product_id] = quantity
+        except (ValueError, tk.TclError):
+            messagebox.showerror("Error", "Return quantities must be between 0 and what is left to return!",
+                                 parent=return_window)
+            return
+        if not quantities:
+            messagebox.showwarning("Error", "Nothing selected to return!", parent=return_window)
+            return
+        try:
+            credit_id = process_return(invoice_id, quantities)
+        except Exception as e:
+            messagebox.showerror("Error", f"An error occurred: {str(e)}", parent=return_window)
+            return
+
+        publish_saved_invoice(credit_id)
+        queue_receipt(credit_id)
+        request_report_refresh()
+        invalidate_product_cache(list(quantities))
+        view_products()
+        refresh_low_stock_button()
+        messagebox.showinfo("Success", f"Refund #{credit_id} created and stock restored.", parent=return_window)
+        return_window.destroy()
+
+    button_row = ttk.Frame(return_window)
+    button_row.pack(fill=tk.X, padx=10, pady=10)
+    ttk.Button(button_row, text="Return All", command=return_all).pack(side=tk.LEFT, padx=5)
+    ttk.Button(button_row, text="Process Return", command=confirm_return,
+               style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
+
+# ------------------------------------------------------------------------------
+# Promotions
+# ------------------------------------------------------------------------------
+# Active rules are compiled into dicts keyed by product and by company, so pricing
+# a line is a couple of dict lookups. The compiled set is valid until the next
+# start/end time of a windowed promotion, then rebuilt on the next lookup.
+promotion_rules = {'product': {}, 'company': {}}
+promotion_rules_valid_until = None
+
+def compile_promotions():
+    global promotion_rules, promotion_rules_valid_until
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    by_product = {}
+    by_company = {}
+    valid_until = None
+    c.execute("""SELECT id, kind, product_id, company_id, min_quantity, percent, bundle_price, starts_at, ends_at
+                 FROM promotions WHERE active = 1""")
+    for promotion_id, kind, product_id, company_id, min_quantity, percent, bundle_price, starts_at, ends_at in c.fetchall():
+        if starts_at and starts_at > now:
+            valid_until = min(valid_until or starts_at, starts_at)
+            continue
+        if ends_at and ends_at <= now:
+            continue
+        if ends_at:
+            valid_until = min(valid_until or ends_at, ends_at)
+        rule = (promotion_id, kind, max(min_quantity or 1, 1), percent or 0, bundle_price)
+        if kind == 'company_percent':
+            by_company.setdefault(company_id, []).append(rule)
+        else:
+            by_product.setdefault(product_id, []).append(rule)
+    promotion_rules = {'product': by_product, 'company': by_company}
+    promotion_rules_valid_until = valid_until
+
+def best_promotion(product_id, company_id, price, quantity, wholesale=False):
+    # Returns (discount, promotion_id) for one line; the single best rule wins.
+    # Wholesale lines are already at a special price and get no promotion.
+    if promotion_rules_valid_until and datetime.now().strftime("%Y-%m-%d %H:%M:%S") >= promotion_rules_valid_until:
+        compile_promotions()
+    if wholesale or quantity <= 0:
+        return 0, None
+    best_discount, best_id = 0, None
+    rules = promotion_rules['product'].get(product_id, []) + promotion_rules['company'].get(company_id, [])
+    for promotion_id, kind, min_quantity, percent, bundle_price in rules:
+        if quantity < min_quantity:
+            continue
+        if kind == 'bundle':
+            discount = (quantity // min_quantity) * (min_quantity * price - (bundle_price or 0))
+        else:
+            discount = scale_cents(quantity * price, percent / 100)
+        if discount > best_discount:
+            best_discount, best_id = discount, promotion_id
+    return best_discount, best_id
+
+def reprice_invoice():
+    # After the rules change every line in the current invoice is priced again
+    for item in invoice_items:
+        update_invoice_item_total(item)
+    calculate_grand_total()
+
+def show_promotions():
+    promotions_window = tk.Toplevel(root)
+    promotions_window.title("Promotions")
+    promotions_window.geometry("950x550")
+
+    columns = ("ID", "Name", "Type", "Product", "Company", "Min Qty", "Percent", "Bundle Price", "Starts", "Ends", "Active")
+    tree = ttk.Treeview(promotions_window, columns=columns, show="headings", height=12)
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=80)
+    tree.column("Name", width=140)
+    tree.column("Starts", width=120)
+    tree.column("Ends", width=120)
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+    def load_promotions():
+        for row in tree.get_children():
+            tree.delete(row)
+        c.execute("""SELECT pr.id, pr.name, pr.kind, p.name, co.name, pr.min_quantity, pr.percent,
+                            pr.bundle_price, pr.starts_at, pr.ends_at, pr.active
+                     FROM promotions pr
+                     LEFT JOIN products p ON p.id = pr.product_id
+                     LEFT JOIN companies co ON co.company_id = pr.company_id
+                     ORDER BY pr.active DESC, pr.id DESC""")
+        for row in c.fetchall():
+            row = list(row)
+            row[7] = money_text(row[7]) if row[7] is not None else None
+            row[10] = "Yes" if row[10] else "No"
+            tree.insert("", tk.END, values=[value if value is not None else "" for value in row])
+
+    form = ttk.LabelFrame(promotions_window, text="New Promotion")
+    form.pack(fill=tk.X, padx=10, pady=5)
+
+    ttk.Label(form, text="Name:").grid(row=0, column=0, padx=5, pady=3, sticky=tk.W)
+    name_entry = ttk.Entry(form, width=20)
+    name_entry.grid(row=0, column=1, padx=5, pady=3)
+    ttk.Label(form, text="Type:").grid(row=0, column=2, padx=5, pady=3, sticky=tk.W)
+    kind_var = tk.StringVar(value='quantity_break')
+    ttk.Combobox(form, textvariable=kind_var, state="readonly", width=16,
+                 values=['quantity_break', 'bundle', 'company_percent']).grid(row=0, column=3, padx=5, pady=3)
+    ttk.Label(form, text="Product SKU:").grid(row=0, column=4, padx=5, pady=3, sticky=tk.W)
+    sku_entry = ttk.Entry(form, width=15)
+    sku_entry.grid(row=0, column=5, padx=5, pady=3)
+
+    ttk.Label(form, text="Company:").grid(row=1, column=0, padx=5, pady=3, sticky=tk.W)
+    c.execute("SELECT name FROM companies")
+    company_combo = ttk.Combobox(form, values=[row[0] for row in c.fetchall()], state="readonly", width=18)
+    company_combo.grid(row=1, column=1, padx=5, pady=3)
+    ttk.Label(form, text="Min Qty:").grid(row=1, column=2, padx=5, pady=3, sticky=tk.W)
+    min_quantity_entry = ttk.Entry(form, width=8)
+    min_quantity_entry.insert(0, "1")
+    min_quantity_entry.grid(row=1, column=3, padx=5, pady=3, sticky=tk.W)
+    ttk.Label(form, text="Percent / Bundle Price:").grid(row=1, column=4, padx=5, pady=3, sticky=tk.W)
+    amount_entry = ttk.Entry(form, width=10)
+    amount_entry.grid(row=1, column=5, padx=5, pady=3)
+
+    ttk.Label(form, text="Starts (YYYY-MM-DD):").grid(row=2, column=0, padx=5, pady=3, sticky=tk.W)
+    starts_entry = ttk.Entry(form, width=12)
+    starts_entry.grid(row=2, column=1, padx=5, pady=3, sticky=tk.W)
+    ttk.Label(form, text="Ends (YYYY-MM-DD):").grid(row=2, column=2, padx=5, pady=3, sticky=tk.W)
+    ends_entry = ttk.Entry(form, width=12)
+    ends_entry.grid(row=2, column=3, padx=5, pady=3, sticky=tk.W)
+
+    def rules_changed():
+        compile_promotions()
+        reprice_invoice()
+        load_promotions()
+
+    def add_promotion():
+        name = name_entry.get().strip()
+        kind = kind_var.get()
+        try:
+            min_quantity = int(min_quantity_entry.get())
+            # Bundle prices are money, percentages stay plain numbers
+            amount = to_cents(amount_entry.get()) if kind == 'bundle' else float(amount_entry.get())
+            starts_at = ends_at = None
+            if starts_entry.get().strip():
+                starts_at = datetime.strptime(starts_entry.get().strip(), "%Y-%m-%d").strftime("%Y-%m-%d 00:00:00")
+            if ends_entry.get().strip():
+                ends_at = datetime.strptime(ends_entry.get().strip(), "%Y-%m-%d").strftime("%Y-%m-%d 23:59:59")
+        except ValueError:
+            messagebox.showerror("Error", "Check the quantity, amount and dates!", parent=promotions_window)
+            return
+        if not name or min_quantity < 1 or amount < 0:
+            messagebox.showerror("Error", "Name is required and amounts must be positive!", parent=promotions_window)
+            return
+        if kind != 'bundle' and amount > 100:
+            messagebox.showerror("Error", "A percentage cannot be more than 100!", parent=promotions_window)
+            return
+
+        product_id = company_id = None
+        if kind == 'company_percent':
+            c.execute("SELECT company_id FROM companies WHERE name = ?", (company_combo.get(),))
+            row = c.fetchone()
+            if not row:
+                messagebox.showerror("Error", "Select a company!", parent=promotions_window)
+                return
+            company_id = row[0]
+        else:
+            c.execute("SELECT id FROM products WHERE sku = ?", (sku_entry.get().strip(),))
+            row = c.fetchone()
+            if not row:
+                messagebox.showerror("Error", "No product found with this SKU!", parent=promotions_window)
+                return
+            product_id = row[0]
+
+        percent, bundle_price = (0, amount) if kind == 'bundle' else (amount, None)
+        c.execute("""INSERT INTO promotions
+                     (name, kind, product_id, company_id, min_quantity, percent, bundle_price, starts_at, ends_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                  (name, kind, product_id, company_id, min_quantity, percent, bundle_price, starts_at, ends_at))
+        conn.commit()
+        rules_changed()
+
+    def toggle_active():
+        selected = tree.selection()
+        if not selected:
+            messagebox.showwarning("Error", "Select a promotion first!", parent=promotions_window)
+            return
+        promotion_id = tree.item(selected[0], 'values')[0]
+        c.execute("UPDATE promotions SET active = 1 - active WHERE id = ?", (promotion_id,))
+        conn.commit()
+        rules_changed()
+
+    ttk.Button(form, text="Add Promotion", command=add_promotion,
+               style="Accent.TButton").grid(row=2, column=5, padx=5, pady=5)
+    ttk.Button(promotions_window, text="Enable / Disable Selected",
+               command=toggle_active).pack(pady=5)
+
+    load_promotions()
+
+# ------------------------------------------------------------------------------
+# Label Sheets
+# ------------------------------------------------------------------------------
+# Rendering runs in labels.py as a separate process with its own worker pool, so
+# the pool never re-imports this module (and its window) when it spawns workers.
+LABELS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "labels.py")
+
+def select_label_products(mode, value, per_unit):
+    # Returns [sku, name, price text] rows; per_unit repeats a product once per unit in stock
+    if mode == 'company':
+        c.execute("""SELECT p.sku, p.name, p.selling_price, p.stock FROM products p
+                     JOIN companies co ON co.company_id = p.company_id
+                     WHERE co.name = ? ORDER BY p.name""", (value,))
+    elif mode == 'search':
+        c.execute("""SELECT sku, name, selling_price, stock FROM products
+                     WHERE name LIKE ? OR sku LIKE ? ORDER BY name""",
+                  ('%' + value + '%', '%' + value + '%'))
+    else:
+        # New arrivals: added or restocked within the last `value` days
+        since = (datetime.now() - timedelta(days=int(value))).strftime("%Y-%m-%d")
+        c.execute("""SELECT sku, name, selling_price, stock FROM products
+                     WHERE id IN (SELECT product_id FROM stock_movements
+                                  WHERE moved_at >= ? AND reason IN ('initial', 'restock'))
+                     ORDER BY name""", (since,))
+    labels = []
+    for sku, name, price, stock in c.fetchall():
+        labels.extend([[sku, name, money_text(price)]] * (max(stock, 0) if per_unit else 1))
+    return labels
+
+def generate_label_sheets(output, labels, on_done):
+    # Runs on a background thread; on_done(files, error) is called on the Tk thread
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf-8") as job:
+            json.dump({'output': output, 'labels': labels}, job)
+        try:
+            result = subprocess.run([sys.executable, LABELS_SCRIPT, job.name],
+                                    capture_output=True, text=True)
+        finally:
+            os.remove(job.name)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "Label rendering failed")
+        files = json.loads(result.stdout)['files']
+        ui_callbacks.put(lambda: on_done(files, None))
+    except Exception as e:
+        ui_callbacks.put(lambda error=str(e): on_done([], error))
+
+def show_label_sheets():
+    labels_window = tk.Toplevel(root)
+    labels_window.title("Print Labels")
+    labels_window.geometry("420x330")
+
+    mode_var = tk.StringVar(value='company')
+    options = ttk.Frame(labels_window)
+    options.pack(fill=tk.X, padx=10, pady=10)
+
+    ttk.Radiobutton(options, text="Company:", variable=mode_var, value='company').grid(row=0, column=0, sticky=tk.W, pady=3)
+    c.execute("SELECT name FROM companies")
+    company_combo = ttk.Combobox(options, values=[row[0] for row in c.fetchall()], state="readonly", width=22)
+    company_combo.grid(row=0, column=1, padx=5, pady=3)
+
+    ttk.Radiobutton(options, text="Search:", variable=mode_var, value='search').grid(row=1, column=0, sticky=tk.W, pady=3)
+    search_entry = ttk.Entry(options, width=25)
+    search_entry.grid(row=1, column=1, padx=5, pady=3)
+
+    ttk.Radiobutton(options, text="New arrivals (days):", variable=mode_var, value='new').grid(row=2, column=0, sticky=tk.W, pady=3)
+    days_entry = ttk.Entry(options, width=8)
+    days_entry.insert(0, "7")
+    days_entry.grid(row=2, column=1, padx=5, pady=3, sticky=tk.W)
+
+    per_unit_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(options, text="One label per unit in stock", variable=per_unit_var).grid(
+        row=3, column=0, columnspan=2, sticky=tk.W, pady=8)
+
+    status_label = ttk.Label(labels_window, text="")
+    status_label.pack(pady=5)
+
+    def finished(files, error):
+        if not labels_window.winfo_exists():
+            return
+        generate_button.config(state=tk.NORMAL)
+        if error:
+            status_label.config(text="")
+            messagebox.showerror("Error", f"Could not print labels: {error}", parent=labels_window)
+        else:
+            status_label.config(text=f"Saved {len(files)} file(s)")
+            messagebox.showinfo("Labels Ready", "Labels saved to:\n" + "\n".join(files), parent=labels_window)
+
+    def generate():
+        mode = mode_var.get()
+        value = {'company': company_combo.get(), 'search': search_entry.get().strip(), 'new': days_entry.get()}[mode]
+        try:
+            if not value:
+                raise ValueError
+            labels = select_label_products(mode, value, per_unit_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Choose a company, enter a search or a number of days!", parent=labels_window)
+            return
+        if not labels:
+            messagebox.showinfo("Print Labels", "No products match this selection.", parent=labels_window)
+            return
+
+        output = filedialog.asksaveasfilename(defaultextension=".pdf", filetypes=[("PDF files", "*.pdf")],
+                                              title="Save Labels as PDF", parent=labels_window)
+        if not output:
+            return
+        generate_button.config(state=tk.DISABLED)
+        status_label.config(text=f"Rendering {len(labels)} labels...")
+        threading.Thread(target=generate_label_sheets, args=(output, labels, finished), daemon=True).start()
+
+    generate_button = ttk.Button(labels_window, text="Generate PDF", command=generate, style="Accent.TButton")
+    generate_button.pack(pady=10)
+
+# ------------------------------------------------------------------------------
+# Live Sales Dashboard
+# ------------------------------------------------------------------------------
+# Today's figures are kept in memory. One query seeds them at startup; after that
+# submit_invoice and returns publish each committed invoice and the accumulators
+# (and any open dashboard) are updated from the event alone.
+DASHBOARD_TOP_SELLERS = 10
+
+sales_listeners = []
+today_stats = None
+
+def new_today_stats(day):
+    return {'day': day, 'revenue': 0, 'cost': 0, 'count': 0,
+            'products': {},  # product_id -> [name, quantity, revenue]
+            'hours': [0] * 24}
+
+def apply_invoice_to_stats(stats, invoice_date, lines):
+    # lines are (product_id, name, quantity, total_price, cost)
+    stats['count'] += 1
+    hour = int(invoice_date[11:13])
+    for product_id, name, quantity, total_price, cost in lines:
+        stats['revenue'] += total_price
+        stats['cost'] += cost
+        stats['hours'][hour] += total_price
+        product = stats['products'].setdefault(product_id, [name, 0, 0])
+        product[1] += quantity
+        product[2] += total_price
+
+def seed_today_stats():
+    global today_stats
+    today = datetime.now().strftime("%Y-%m-%d")
+    stats = new_today_stats(today)
+    c.execute("""SELECT i.id, i.date, ii.product_id, p.name, ii.quantity, ii.total_price,
+                        ii.quantity * ii.historical_purchase_price
+                 FROM invoices i
+                 JOIN invoice_items ii ON ii.invoice_id = i.id
+                 JOIN products p ON p.id = ii.product_id
+                 WHERE i.date >= ?
+                 ORDER BY i.id""", (today,))
+    for (invoice_id, invoice_date), rows in groupby(c.fetchall(), key=lambda row: (row[0], row[1])):
+        apply_invoice_to_stats(stats, invoice_date, [row[2:] for row in rows])
+    today_stats = stats
+
+def publish_invoice(invoice_date, lines):
+    # Called after commit with the invoice's lines; rolls over at midnight
+    global today_stats
+    if today_stats is None or today_stats['day'] != invoice_date[:10]:
+        today_stats = new_today_stats(invoice_date[:10])
+    apply_invoice_to_stats(today_stats, invoice_date, lines)
+    for listener in list(sales_listeners):
+        listener(today_stats)
+
+def publish_saved_invoice(invoice_id):
+    # For invoices written set-based (returns), read back just that invoice's lines
+    c.execute("""SELECT i.date, ii.product_id, p.name, ii.quantity, ii.total_price,
+                        ii.quantity * ii.historical_purchase_price
+                 FROM invoices i
+                 JOIN invoice_items ii ON ii.invoice_id = i.id
+                 JOIN products p ON p.id = ii.product_id
+                 WHERE i.id = ?""", (invoice_id,))
+    rows = c.fetchall()
+    if rows:
+        publish_invoice(rows[0][0], [row[1:] for row in rows])
+
+def show_sales_dashboard():
+    dashboard_window = tk.Toplevel(root)
+    dashboard_window.title("Today's Sales")
+    dashboard_window.geometry("700x600")
+
+    figures = ttk.Frame(dashboard_window)
+    figures.pack(fill=tk.X, padx=10, pady=10)
+    figure_labels = {}
+    for col, key in enumerate(["Revenue", "Profit", "Invoices"]):
+        box = ttk.LabelFrame(figures, text=key)
+        box.grid(row=0, column=col, padx=10, sticky="nsew")
+        figures.columnconfigure(col, weight=1)
+        figure_labels[key] = ttk.Label(box, text="", font=('Helvetica', 16, 'bold'))
+        figure_labels[key].pack(padx=10, pady=10)
+
+    ttk.Label(dashboard_window, text="Revenue by Hour", font=('Helvetica', 11, 'bold')).pack(anchor=tk.W, padx=10)
+    histogram = tk.Canvas(dashboard_window, height=160, background="white", highlightthickness=0)
+    histogram.pack(fill=tk.X, padx=10, pady=5)
+
+    ttk.Label(dashboard_window, text="Top Sellers", font=('Helvetica', 11, 'bold')).pack(anchor=tk.W, padx=10)
+    columns = ("Product", "Quantity", "Revenue")
+    top_tree = ttk.Treeview(dashboard_window, columns=columns, show="headings", height=DASHBOARD_TOP_SELLERS)
+    for col in columns:
+        top_tree.heading(col, text=col)
+    top_tree.column("Product", width=300)
+    top_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    def draw_histogram(hours):
+        histogram.delete("all")
+        width = max(histogram.winfo_width(), 480)
+        height = int(histogram.cget("height"))
+        bar_width = width / 24
+        peak = max(max(hours), 1)
+        for hour, revenue in enumerate(hours):
+            bar_height = max(revenue, 0) / peak * (height - 30)
+            x = hour * bar_width
+            histogram.create_rectangle(x + 2, height - 15 - bar_height, x + bar_width - 2, height - 15,
+                                       fill="#0078d4", outline="")
+            histogram.create_text(x + bar_width / 2, height - 7, text=str(hour), font=('Helvetica', 7))
+
+    def render(stats):
+        figure_labels["Revenue"].config(text=format_money(stats['revenue']))
+        figure_labels["Profit"].config(text=format_money(stats['revenue'] - stats['cost']))
+        figure_labels["Invoices"].config(text=str(stats['count']))
+        draw_histogram(stats['hours'])
+        for row in top_tree.get_children():
+            top_tree.delete(row)
+        top = sorted(stats['products'].values(), key=lambda product: product[1], reverse=True)
+        for name, quantity, revenue in top[:DASHBOARD_TOP_SELLERS]:
+            if quantity > 0:
+                top_tree.insert("", tk.END, values=(name, quantity, format_money(revenue)))
+
+    def close_dashboard():
+        sales_listeners.remove(render)
+        dashboard_window.destroy()
+
+    dashboard_window.protocol("WM_DELETE_WINDOW", close_dashboard)
+    sales_listeners.append(render)
+    if today_stats is None or today_stats['day'] != datetime.now().strftime("%Y-%m-%d"):
+        seed_today_stats()
+    dashboard_window.update_idletasks()
+    render(today_stats)
+
+# ------------------------------------------------------------------------------
+# Database Maintenance
+# ------------------------------------------------------------------------------
+# Runs on its own connection while the till is idle (empty invoice, no input for a
+# while). Every step is short: ANALYZE is bounded by analysis_limit, free pages are
+# returned a few hundred at a time, and quick_check/checkpoint only read, so a
+# sale never waits on maintenance for more than a few milliseconds. The one
+# exception is the one-off switch of an older file to incremental vacuum: that is
+# a full VACUUM, so it only runs when asked for and the till is idle.
+MAINTENANCE_IDLE_SECONDS = 120
+MAINTENANCE_CHECK_SECONDS = 30
+VACUUM_STEP_PAGES = 256
+MAINTENANCE_INTERVALS = {  # seconds between runs of each task
+    'optimize': 3600,
+    'checkpoint': 3600,
+    'analyze': 86400,
+    'quick_check': 86400,
+    'incremental_vacuum': 3600,
+}
+
+last_activity = time.monotonic()
+maintenance_requested = threading.Event()
+vacuum_conversion_requested = threading.Event()
+
+def mark_activity(event=None):
+    global last_activity
+    last_activity = time.monotonic()
+
+def till_is_idle():
+    return not invoice_items and time.monotonic() - last_activity >= MAINTENANCE_IDLE_SECONDS
+
+def database_stats(db):
+    # (file bytes, page count, free pages); the WAL file is counted with the database
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+    file_bytes = sum(os.path.getsize(path) for path in ('inventory.db', 'inventory.db-wal') if os.path.exists(path))
+    return file_bytes, page_count, freelist_count
+
+def run_maintenance_task(db, task, forced=False):
+    # Returns a short result text for the log
+    if task == 'optimize':
+        db.execute("PRAGMA analysis_limit = 400")
+        db.execute("PRAGMA optimize")
+        return "ok"
+    if task == 'analyze':
+        db.execute("PRAGMA analysis_limit = 1000")
+        db.execute("ANALYZE")
+        return "ok"
+    if task == 'checkpoint':
+        busy, log_frames, checkpointed = db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        return f"{checkpointed}/{log_frames} frames"
+    if task == 'quick_check':
+        problems = [row[0] for row in db.execute("PRAGMA quick_check(20)").fetchall()]
+        if problems == ['ok']:
+            return "ok"
+        ui_callbacks.put(lambda: messagebox.showwarning(
+            "Database Check", "The database integrity check found problems. "
+            "See Database Maintenance and restore a backup if needed."))
+        return "; ".join(problems)[:500]
+    if task == 'convert_auto_vacuum':
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return "already enabled"
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
+        return "incremental vacuum enabled"
+    if task == 'incremental_vacuum':
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return "skipped (incremental vacuum not enabled)"
+        freed = 0
+        while (forced or till_is_idle()) and db.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            before = db.execute("PRAGMA freelist_count").fetchone()[0]
+            # executescript steps the pragma to completion; execute() frees a single page
+            db.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+            freed += before - db.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(0.05)  # let a waiting sale in between steps
+        return f"{freed} pages freed"
+
+def maintenance_worker():
+    # isolation_level=None: every statement is its own short transaction
+    db = sqlite3.connect('inventory.db', timeout=0.5, isolation_level=None)
+    last_run = dict(db.execute("SELECT task, MAX(run_at) FROM maintenance_log GROUP BY task").fetchall())
+    while True:
+        forced = maintenance_requested.wait(timeout=MAINTENANCE_CHECK_SECONDS)
+        maintenance_requested.clear()
+        tasks = list(MAINTENANCE_INTERVALS.items())
+        if vacuum_conversion_requested.is_set() and till_is_idle():
+            # Never forced: the rewrite holds the write lock until it is done
+            vacuum_conversion_requested.clear()
+            tasks.insert(0, ('convert_auto_vacuum', 0))
+        for task, interval in tasks:
+            if invoice_items or not (forced or till_is_idle()):
+                break
+            now = datetime.now()
+            if not forced and last_run.get(task) and \
+                    (now - datetime.strptime(last_run[task], "%Y-%m-%d %H:%M:%S")).total_seconds() < interval:
+                continue
+            started = time.monotonic()
+            try:
+                result = run_maintenance_task(db, task, forced)
+            except sqlite3.OperationalError as e:
+                result = f"skipped ({e})"  # the till is writing; try again next time
+                if task == 'convert_auto_vacuum':
+                    vacuum_conversion_requested.set()
+            file_bytes, page_count, freelist_count = database_stats(db)
+            last_run[task] = now.strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                db.execute("""INSERT INTO maintenance_log
+                              (run_at, task, duration_ms, file_bytes, page_count, freelist_count, result)
+                              VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                           (last_run[task], task, int((time.monotonic() - started) * 1000),
+                            file_bytes, page_count, freelist_count, result))
+            except sqlite3.OperationalError:
+                pass
+
+def enable_incremental_vacuum():
+    # Asks the maintenance worker for the one-off full VACUUM that switches an older
+    # file to auto_vacuum=INCREMENTAL; it runs on the worker's connection once idle
+    if not messagebox.askyesno("Compact Database",
+                               "The database will be rewritten once, the next time the till is idle. "
+                               "Sales cannot be saved until it finishes. Continue?"):
+        return False
+    vacuum_conversion_requested.set()
+    return True
+
+def show_maintenance():
+    maintenance_window = tk.Toplevel(root)
+    maintenance_window.title("Database Maintenance")
+    maintenance_window.geometry("900x500")
+
+    summary_label = ttk.Label(maintenance_window, text="", font=('Helvetica', 11, 'bold'))
+    summary_label.pack(anchor=tk.W, padx=10, pady=10)
+
+    columns = ("Time", "Task", "Duration (ms)", "File Size (MB)", "Fragmentation", "Result")
+    tree = ttk.Treeview(maintenance_window, columns=columns, show="headings", height=15)
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=120, anchor="center")
+    tree.column("Result", width=240, anchor=tk.W)
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    def load():
+        file_bytes, page_count, freelist_count = database_stats(conn)
+        auto_vacuum = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+        summary_label.config(text=f"Size: {file_bytes / 1048576:.1f} MB    "
+                                  f"Free pages: {freelist_count} of {page_count} "
+                                  f"({freelist_count / max(page_count, 1):.1%})    "
+                                  f"Incremental vacuum: {'on' if auto_vacuum == 2 else 'off'}")
+        compact_button.config(state=tk.DISABLED if auto_vacuum == 2 else tk.NORMAL)
+        tree.delete(*tree.get_children())
+        c.execute("""SELECT run_at, task, duration_ms, file_bytes, page_count, freelist_count, result
+                     FROM maintenance_log ORDER BY id DESC LIMIT 200""")
+        for run_at, task, duration_ms, file_bytes, page_count, freelist_count, result in c.fetchall():
+            tree.insert("", tk.END, values=(run_at, task, duration_ms, f"{file_bytes / 1048576:.1f}",
+                                            f"{freelist_count / max(page_count, 1):.1%}", result))
+
+    def run_now():
+        if invoice_items:
+            messagebox.showwarning("Error", "Finish or clear the current invoice first!", parent=maintenance_window)
+            return
+        maintenance_requested.set()
+        messagebox.showinfo("Database Maintenance", "Maintenance started in the background.", parent=maintenance_window)
+
+    def compact():
+        if enable_incremental_vacuum():
+            compact_button.config(state=tk.DISABLED)
+            messagebox.showinfo("Database Maintenance", "The database will be compacted when the till is idle.",
+                                parent=maintenance_window)
+
+    buttons = ttk.Frame(maintenance_window)
+    buttons.pack(fill=tk.X, padx=10, pady=10)
+    ttk.Button(buttons, text="Run Now", command=run_now).pack(side=tk.LEFT, padx=5)
+    compact_button = ttk.Button(buttons, text="Enable Incremental Vacuum", command=compact)
+    compact_button.pack(side=tk.LEFT, padx=5)
+    ttk.Button(buttons, text="Refresh", command=load).pack(side=tk.RIGHT, padx=5)
+    load()
+
+# ------------------------------------------------------------------------------
+# Invoice Search
+# ------------------------------------------------------------------------------
+# Filters run on main and on each attached yearly archive separately: a UNION ALL
+# view would have to be sorted whole before LIMIT. Each database returns its own
+# newest matches through idx_invoices_date (or idx_invoice_items_product_invoice
+# when a product narrows things down) and the pages are merged here. Pages are
+# keyset-paginated on (date, id), so page 100 costs the same as page 1.
+INVOICE_SEARCH_PAGE_SIZE = 50
+
+def search_invoices(cur, filters, after=None, limit=INVOICE_SEARCH_PAGE_SIZE):
+    # filters: start/end (YYYY-MM-DD), product (exact SKU or part of a name), company
+    # (name), min_total/max_total (cents); missing or empty means no filter.
+    # after: (date, id) of the last row of the previous page.
+    # Returns (id, date, total, refund_of, line count) rows, newest first.
+    conditions = []
+    params = []
+    if filters.get('start'):
+        conditions.append("i.date >= ?")
+        params.append(filters['start'])
+    if filters.get('end'):
+        conditions.append("i.date < DATE(?, '+1 day')")
+        params.append(filters['end'])
+    if filters.get('min_total') is not None:
+        conditions.append("i.total >= ?")
+        params.append(filters['min_total'])
+    if filters.get('max_total') is not None:
+        conditions.append("i.total <= ?")
+        params.append(filters['max_total'])
+    if after:
+        # Spelled out instead of a row value so the date index gives the range
+        conditions.append("i.date <= ? AND (i.date < ? OR i.id < ?)")
+        params.extend([after[0], after[0], after[1]])
+
+    product_conditions = []
+    product_params = []
+    if filters.get('product'):
+        product_conditions.append("(sku = ? OR name LIKE ?)")
+        product_params.extend([filters['product'], f"%{filters['product']}%"])
+    if filters.get('company'):
+        product_conditions.append("company_id IN (SELECT company_id FROM companies WHERE name = ?)")
+        product_params.append(filters['company'])
+
+    cur.execute("PRAGMA database_list")
+    schemas = [row[1] for row in cur.fetchall() if row[1] == 'main' or row[1].startswith('archive_')]
+    rows = []
+    for schema in schemas:
+        # Yearly archives outside the date range are skipped without a query
+        year = schema[len('archive_'):]
+        if year.isdigit() and ((filters.get('start') and filters['start'][:4] > year)
+                               or (filters.get('end') and filters['end'][:4] < year)):
+            continue
+        schema_conditions = list(conditions)
+        schema_params = list(params)
+        if product_conditions:
+            # Inlined rather than kept in a temp table: the cursor may be the live
+            # connection's, and a read path must not open a write transaction on it
+            schema_conditions.append(f"""i.id IN (SELECT ii.invoice_id FROM {schema}.invoice_items ii
+                                                  WHERE ii.product_id IN (SELECT id FROM main.products
+                                                                          WHERE {' AND '.join(product_conditions)}))""")
+            schema_params.extend(product_params)
+        where = " AND ".join(schema_conditions) or "1 = 1"
+        # Archives made before returns existed have no refund_of column
+        cur.execute(f"PRAGMA {schema}.table_info(invoices)")
+        refund_of = "i.refund_of" if any(row[1] == 'refund_of' for row in cur.fetchall()) else "NULL AS refund_of"
+        cur.execute(f"""SELECT i.id, i.date, i.total, {refund_of},
+                               (SELECT COUNT(*) FROM {schema}.invoice_items ii WHERE ii.invoice_id = i.id)
+                        FROM {schema}.invoices i
+                        WHERE {where}
+                        ORDER BY i.date DESC, i.id DESC
+                        LIMIT ?""", schema_params + [limit])
+        rows.extend(cur.fetchall())
+    rows.sort(key=lambda row: (row[1], row[0]), reverse=True)
+    return rows[:limit]
+
+def show_invoice_search():
+    search_window = tk.Toplevel(root)
+    search_window.title("Search Invoices")
+    search_window.geometry("900x600")
+
+    filter_frame = ttk.Frame(search_window)
+    filter_frame.pack(fill=tk.X, padx=10, pady=10)
+
+    ttk.Label(filter_frame, text="From (YYYY-MM-DD):").grid(row=0, column=0, padx=5, pady=3, sticky=tk.W)
+    start_entry = ttk.Entry(filter_frame, width=12)
+    start_entry.grid(row=0, column=1, padx=5, pady=3, sticky=tk.W)
+    start_entry.insert(0, (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d"))
+    ttk.Label(filter_frame, text="To (YYYY-MM-DD):").grid(row=0, column=2, padx=5, pady=3, sticky=tk.W)
+    end_entry = ttk.Entry(filter_frame, width=12)
+    end_entry.grid(row=0, column=3, padx=5, pady=3, sticky=tk.W)
+    end_entry.insert(0, datetime.now().strftime("%Y-%m-%d"))
+    ttk.Label(filter_frame, text="Product / SKU:").grid(row=0, column=4, padx=5, pady=3, sticky=tk.W)
+    product_entry = ttk.Entry(filter_frame, width=18)
+    product_entry.grid(row=0, column=5, padx=5, pady=3, sticky=tk.W)
+
+    ttk.Label(filter_frame, text="Company:").grid(row=1, column=0, padx=5, pady=3, sticky=tk.W)
+    c.execute("SELECT name FROM companies ORDER BY name")
+    company_combo = ttk.Combobox(filter_frame, values=[""] + [row[0] for row in c.fetchall()],
+                                 state="readonly", width=16)
+    company_combo.grid(row=1, column=1, columnspan=2, padx=5, pady=3, sticky=tk.W)
+    ttk.Label(filter_frame, text="Total from:").grid(row=1, column=3, padx=5, pady=3, sticky=tk.W)
+    min_total_entry = ttk.Entry(filter_frame, width=10)
+    min_total_entry.grid(row=1, column=4, padx=5, pady=3, sticky=tk.W)
+    ttk.Label(filter_frame, text="to:").grid(row=1, column=5, padx=5, pady=3, sticky=tk.W)
+    max_total_entry = ttk.Entry(filter_frame, width=10)
+    max_total_entry.grid(row=1, column=6, padx=5, pady=3, sticky=tk.W)
+
+    columns = ("Invoice", "Date", "Lines", "Total")
+    tree = ttk.Treeview(search_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=180, anchor="center")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+    tree.bind("<Double-1>", lambda event: tree.selection() and show_invoice_details(int(tree.selection()[0])))
+
+    nav_frame = ttk.Frame(search_window)
+    nav_frame.pack(fill=tk.X, padx=10, pady=10)
+    status_label = ttk.Label(nav_frame, text="")
+    status_label.pack(side=tk.LEFT, padx=5)
+
+    # Keyset pagination: pages[n] is the (date, id) the nth page starts after
+    pages = [None]
+    state = {'filters': None, 'last': None}
+
+    def show_page():
+        rc = get_report_cursor()
+        rows = search_invoices(rc, state['filters'], pages[-1], INVOICE_SEARCH_PAGE_SIZE + 1)
+        more = len(rows) > INVOICE_SEARCH_PAGE_SIZE
+        rows = rows[:INVOICE_SEARCH_PAGE_SIZE]
+        tree.delete(*tree.get_children())
+        for invoice_id, invoice_date, total, refund_of, line_count in rows:
+            title = f"Refund #{invoice_id} (of #{refund_of})" if refund_of else f"Invoice #{invoice_id}"
+            tree.insert("", tk.END, iid=str(invoice_id), values=(title, invoice_date, line_count, format_money(total)))
+        state['last'] = (rows[-1][1], rows[-1][0]) if rows and more else None
+        previous_button.config(state=tk.NORMAL if len(pages) > 1 else tk.DISABLED)
+        next_button.config(state=tk.NORMAL if state['last'] else tk.DISABLED)
+        status_label.config(text=f"Page {len(pages)} - {len(rows)} invoices - {report_freshness_text()}")
+
+    def run_search():
+        try:
+            for entry in (start_entry, end_entry):
+                if entry.get().strip():
+                    datetime.strptime(entry.get().strip(), "%Y-%m-%d")
+            min_total = to_cents(min_total_entry.get()) if min_total_entry.get().strip() else None
+            max_total = to_cents(max_total_entry.get()) if max_total_entry.get().strip() else None
+        except ValueError:
+            messagebox.showerror("Error", "Please enter valid dates (YYYY-MM-DD) and amounts!", parent=search_window)
+            return
+        state['filters'] = {
+            'start': start_entry.get().strip(),
+            'end': end_entry.get().strip(),
+            'product': product_entry.get().strip(),
+            'company': company_combo.get(),
+            'min_total': min_total,
+            'max_total': max_total,
+        }
+        pages[:] = [None]
+        show_page()
+
+    def next_page():
+        if state['last']:
+            pages.append(state['last'])
+            show_page()
+
+    def previous_page():
+        if len(pages) > 1:
+            pages.pop()
+            show_page()
+
+    ttk.Button(filter_frame, text="Search", command=run_search,
+               style="Accent.TButton").grid(row=0, column=7, rowspan=2, padx=10)
+    next_button = ttk.Button(nav_frame, text="Next Page", command=next_page)
+    next_button.pack(side=tk.RIGHT, padx=5)
+    previous_button = ttk.Button(nav_frame, text="Previous Page", command=previous_page)
+    previous_button.pack(side=tk.RIGHT, padx=5)
+    search_window.bind("<Return>", lambda event: run_search())
+    run_search()
+
+# ------------------------------------------------------------------------------
+# Stock Lots and Expiry
+# ------------------------------------------------------------------------------
+# Sales take stock first-expired-first-out. Allocation is one windowed query for
+# the whole invoice: a running total per product over its lots in expiry order
+# (read from idx_stock_lots_fefo) says how much each lot gives, however many
+# lines the invoice has. CROSS JOIN keeps the invoice lines as the outer loop, so
+# the cost follows the invoice and not the size of the lot table. Whatever the lots cannot cover comes from stock without
+# a lot.
+LOT_NO_EXPIRY = '9999-12-31'
+EXPIRING_SOON_DAYS = 30
+
+FEFO_ALLOCATION_SQL = '''
+    SELECT id, product_id, MIN(quantity, wanted - taken_before) AS take
+    FROM (SELECT l.id, l.product_id, l.quantity, r.quantity AS wanted,
+                 SUM(l.quantity) OVER (PARTITION BY l.product_id ORDER BY l.expiry, l.id
+                                       ROWS UNBOUNDED PRECEDING) - l.quantity AS taken_before
+          FROM lot_requests r
+          CROSS JOIN stock_lots l ON l.product_id = r.product_id AND l.quantity > 0)
+    WHERE taken_before < wanted'''
+
+def add_lot(cur, product_id, quantity, unit_cost, expiry=None, received_at=None):
+    received_at = received_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cur.execute("""INSERT INTO stock_lots (product_id, expiry, quantity, unit_cost, received_at)
+                   VALUES (?, ?, ?, ?, ?)""", (product_id, expiry or LOT_NO_EXPIRY, quantity, unit_cost, received_at))
+    return cur.lastrowid
+
+def allocate_lots(cur, lines, invoice_id=None):
+    # lines are (product_id, quantity) with quantity > 0. Takes the units out of the
+    # earliest-expiring lots and, with an invoice_id, records where they came from.
+    # Runs inside the caller's transaction. Returns (lot_id, product_id, quantity) taken.
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS lot_requests (product_id INTEGER PRIMARY KEY, quantity INTEGER)")
+    cur.execute("DELETE FROM lot_requests")
+    cur.executemany("""INSERT INTO lot_requests (product_id, quantity) VALUES (?, ?)
+                       ON CONFLICT(product_id) DO UPDATE SET quantity = quantity + excluded.quantity""",
+                    [(product_id, quantity) for product_id, quantity in lines if quantity > 0])
+    cur.execute(FEFO_ALLOCATION_SQL)
+    taken = cur.fetchall()
+    cur.executemany("UPDATE stock_lots SET quantity = quantity - ? WHERE id = ?",
+                    [(quantity, lot_id) for lot_id, _, quantity in taken])
+    if invoice_id is not None:
+        cur.executemany("""INSERT INTO invoice_item_lots (invoice_id, product_id, lot_id, quantity)
+                           VALUES (?, ?, ?, ?)""",
+                        [(invoice_id, product_id, lot_id, quantity) for lot_id, product_id, quantity in taken])
+    return taken
+
+def restore_returned_lots(cur, invoice_id, credit_id):
+    # Puts returned units (the return_lines temp table) back into the lots the
+    # original invoice took them from, net of earlier returns. The earliest-expiring
+    # units are assumed to come back, so the expiry report errs on the early side.
+    cur.execute("""WITH sold AS (
+                       SELECT il.lot_id, il.product_id, SUM(il.quantity) AS quantity
+                       FROM invoice_item_lots il
+                       WHERE il.invoice_id = ?
+                          OR il.invoice_id IN (SELECT id FROM invoices WHERE refund_of = ? AND id != ?)
+                       GROUP BY il.lot_id, il.product_id
+                       HAVING SUM(il.quantity) > 0
+                   ), ordered AS (
+                       SELECT s.lot_id, s.product_id, s.quantity, r.quantity AS wanted,
+                              SUM(s.quantity) OVER (PARTITION BY s.product_id ORDER BY l.expiry, l.id
+                                                    ROWS UNBOUNDED PRECEDING) - s.quantity AS given_before
+                       FROM sold s
+                       JOIN stock_lots l ON l.id = s.lot_id
+                       JOIN return_lines r ON r.product_id = s.product_id
+                   )
+                   SELECT lot_id, product_id, MIN(quantity, wanted - given_before)
+                   FROM ordered WHERE given_before < wanted""", (invoice_id, invoice_id, credit_id))
+    restored = cur.fetchall()
+    cur.executemany("UPDATE stock_lots SET quantity = quantity + ? WHERE id = ?",
+                    [(quantity, lot_id) for lot_id, _, quantity in restored])
+    cur.executemany("""INSERT INTO invoice_item_lots (invoice_id, product_id, lot_id, quantity)
+                       VALUES (?, ?, ?, ?)""",
+                    [(credit_id, product_id, lot_id, -quantity) for lot_id, product_id, quantity in restored])
+
+def trim_lots_to_stock(cur):
+    # After a count lowers stock below what the lots hold, the difference is taken
+    # out of the earliest-expiring lots (what is most likely to have been thrown away)
+    cur.execute("""SELECT p.id, SUM(l.quantity) - MAX(COALESCE(p.stock, 0), 0)
+                   FROM stock_lots l
+                   JOIN products p ON p.id = l.product_id
+                   WHERE l.quantity > 0
+                   GROUP BY p.id
+                   HAVING SUM(l.quantity) > MAX(COALESCE(p.stock, 0), 0)""")
+    excess = cur.fetchall()
+    if excess:
+        allocate_lots(cur, excess)
+
+def load_expiring_lots(days):
+    # Lots with stock left that expire within `days` (already expired included)
+    c.execute("""SELECT p.name, p.sku, COALESCE(co.name, 'No Company'), l.id, l.expiry,
+                        CAST(JULIANDAY(l.expiry) - JULIANDAY(DATE('now', 'localtime')) AS INTEGER),
+                        l.quantity, l.quantity * COALESCE(l.unit_cost, 0)
+                 FROM stock_lots l
+                 JOIN products p ON p.id = l.product_id
+                 LEFT JOIN companies co ON co.company_id = p.company_id
+                 WHERE l.quantity > 0 AND l.expiry < DATE('now', 'localtime', ?)
+                 ORDER BY l.expiry, p.name""", (f"+{days + 1} days",))
+    return c.fetchall()
+
+def show_expiring_lots():
+    expiring_window = tk.Toplevel(root)
+    expiring_window.title("Expiring Soon")
+    expiring_window.geometry("950x550")
+
+    filter_frame = ttk.Frame(expiring_window)
+    filter_frame.pack(fill=tk.X, padx=10, pady=10)
+    ttk.Label(filter_frame, text="Expiring within (days):").pack(side=tk.LEFT, padx=5)
+    days_entry = ttk.Entry(filter_frame, width=6)
+    days_entry.pack(side=tk.LEFT, padx=5)
+    days_entry.insert(0, str(EXPIRING_SOON_DAYS))
+
+    columns = ("Name", "SKU", "Company", "Lot", "Expiry", "Days Left", "Quantity", "Value")
+    tree = ttk.Treeview(expiring_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=110, anchor="center")
+    tree.column("Name", width=180)
+    tree.tag_configure("expired", foreground="red")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    summary_label = ttk.Label(expiring_window, text="", font=('Helvetica', 12, 'bold'))
+    summary_label.pack(anchor=tk.W, padx=10, pady=10)
+
+    def run_report():
+        try:
+            days = int(days_entry.get())
+            if days < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a number of days!", parent=expiring_window)
+            return
+        tree.delete(*tree.get_children())
+        total_units = 0
+        total_value = 0
+        for name, sku, company, lot_id, expiry, days_left, quantity, value in load_expiring_lots(days):
+            total_units += quantity
+            total_value += value
+            tree.insert("", tk.END, values=(name, sku, company, lot_id, expiry,
+                                            days_left if days_left >= 0 else "Expired",
+                                            quantity, format_money(value)),
+                        tags=("expired",) if days_left < 0 else ())
+        summary_label.config(text=f"Units: {total_units} - Value: {format_money(total_value)}")
+
+    ttk.Button(filter_frame, text="Run Report", command=run_report,
+               style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+    run_report()
+
+# ------------------------------------------------------------------------------
+# Goods Receiving
+# ------------------------------------------------------------------------------
+# A supplier delivery is booked in as one document, typed or scanned line by line,
+# and committed in one transaction. The lines go into a temp table and every
+# product is updated by set-based statements, so a delivery of hundreds of lines
+# costs a handful of queries. The purchase price becomes the weighted moving
+# average of the stock on hand and the units received:
+#   (stock * purchase_price + received units * their cost) / (stock + received units)
+# Negative stock counts as none, so the cost then comes from the delivery alone.
+RECEIVING_AVERAGE_COST_SQL = '''
+    SELECT p.id, r.quantity, p.purchase_price, p.selling_price, p.wholesale_price,
+           CAST(ROUND((MAX(COALESCE(p.stock, 0), 0) * COALESCE(p.purchase_price, 0) + r.cost) * 1.0
+                      / (MAX(COALESCE(p.stock, 0), 0) + r.quantity)) AS INTEGER)
+    FROM (SELECT product_id, SUM(quantity) AS quantity, SUM(quantity * unit_cost) AS cost
+          FROM receipt_lines GROUP BY product_id) r
+    JOIN products p ON p.id = r.product_id'''
+
+def commit_goods_receipt(lines, company_id=None, purchase_order_id=None, reference=None):
+    # lines are (product_id, quantity, unit_cost, expiry or None) with quantity > 0;
+    # a product may appear on several lines (e.g. two expiry dates). Returns the receipt id.
+    received_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        c.execute("""CREATE TEMP TABLE IF NOT EXISTS receipt_lines
+                     (product_id INTEGER, quantity INTEGER, unit_cost INTEGER, expiry TEXT)""")
+        c.execute("""CREATE TEMP TABLE IF NOT EXISTS receipt_costs
+                     (product_id INTEGER PRIMARY KEY, quantity INTEGER, old_purchase_price INTEGER,
+                      selling_price INTEGER, wholesale_price INTEGER, new_purchase_price INTEGER)""")
+        c.execute("DELETE FROM receipt_lines")
+        c.execute("DELETE FROM receipt_costs")
+        c.executemany("INSERT INTO receipt_lines (product_id, quantity, unit_cost, expiry) VALUES (?, ?, ?, ?)",
+                      lines)
+        # New costs are worked out once, before stock and prices change
+        c.execute("INSERT INTO receipt_costs " + RECEIVING_AVERAGE_COST_SQL)
+
+        c.execute("""INSERT INTO goods_receipts
+                     (received_at, company_id, purchase_order_id, reference, line_count, total_cost)
+                     SELECT ?, ?, ?, ?, COUNT(*), COALESCE(SUM(quantity * unit_cost), 0) FROM receipt_lines""",
+                  (received_at, company_id, purchase_order_id, reference or None))
+        receipt_id = c.lastrowid
+        c.execute("""INSERT INTO goods_receipt_items (receipt_id, product_id, quantity, unit_cost, expiry)
+                     SELECT ?, product_id, quantity, unit_cost, expiry FROM receipt_lines""", (receipt_id,))
+
+        c.execute("""INSERT INTO price_history
+                     (product_id, changed_at, source,
+                      old_purchase_price, new_purchase_price,
+                      old_selling_price, new_selling_price,
+                      old_wholesale_price, new_wholesale_price)
+                     SELECT product_id, ?, 'receiving', old_purchase_price, new_purchase_price,
+                            selling_price, selling_price, wholesale_price, wholesale_price
+                     FROM receipt_costs WHERE new_purchase_price IS NOT old_purchase_price""", (received_at,))
+        c.execute("""UPDATE products
+                     SET stock = COALESCE(stock, 0) + (SELECT quantity FROM receipt_costs r WHERE r.product_id = products.id),
+                         purchase_price = (SELECT new_purchase_price FROM receipt_costs r WHERE r.product_id = products.id)
+                     WHERE id IN (SELECT product_id FROM receipt_costs)""")
+        # One ledger row per product, at its new average cost
+        c.execute("""INSERT INTO stock_movements
+                     (product_id, moved_at, quantity_change, unit_cost, reason, reference_id)
+                     SELECT product_id, ?, quantity, new_purchase_price, 'receiving', ?
+                     FROM receipt_costs""", (received_at, receipt_id))
+        # Only dated stock goes into lots, as with add_lot
+        c.execute("""INSERT INTO stock_lots (product_id, expiry, quantity, unit_cost, received_at)
+                     SELECT product_id, expiry, quantity, unit_cost, ? FROM receipt_lines
+                     WHERE expiry IS NOT NULL""", (received_at,))
+        if purchase_order_id is not None:
+            c.execute("UPDATE purchase_orders SET status = 'received' WHERE id = ?", (purchase_order_id,))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return receipt_id
+
+def show_goods_receiving():
+    global active_scan_handler
+    if active_scan_handler is not None:
+        messagebox.showwarning("Error", "Another scanning session is already open!")
+        return
+
+    receiving_window = tk.Toplevel(root)
+    receiving_window.title("Receive Goods")
+    receiving_window.geometry("1000x650")
+
+    # One query up front; scans are then resolved from memory
+    c.execute("SELECT sku, id, name, COALESCE(purchase_price, 0) FROM products WHERE sku IS NOT NULL")
+    catalog = {sku: (product_id, name, cost) for sku, product_id, name, cost in c.fetchall()}
+    # One line per product, cost and expiry, so batches at different costs or dates stay
+    # apart: tree iid -> {'product_id', 'sku', 'name', 'quantity', 'unit_cost', 'expiry'}
+    lines = {}
+    unknown = {}
+    loaded_order = [None]
+
+    # Delivery header: supplier, delivery note number and an optional purchase order
+    header_frame = ttk.Frame(receiving_window)
+    header_frame.pack(fill=tk.X, padx=10, pady=5)
+    ttk.Label(header_frame, text="Company:").pack(side=tk.LEFT, padx=5)
+    company_var = tk.StringVar()
+    ttk.Combobox(header_frame, textvariable=company_var, values=get_company_names(),
+                 width=20).pack(side=tk.LEFT, padx=5)
+    ttk.Label(header_frame, text="Delivery Note:").pack(side=tk.LEFT, padx=5)
+    reference_entry = ttk.Entry(header_frame, width=15)
+    reference_entry.pack(side=tk.LEFT, padx=5)
+
+    c.execute("""SELECT po.id, COALESCE(co.name, 'No Company'), po.created_at
+                 FROM purchase_orders po
+                 LEFT JOIN companies co ON co.company_id = po.company_id
+                 WHERE po.status = 'draft'
+                 ORDER BY po.id DESC""")
+    draft_orders = {f"PO #{order_id} - {company_name} ({created_at})": order_id
+                    for order_id, company_name, created_at in c.fetchall()}
+    ttk.Label(header_frame, text="Purchase Order:").pack(side=tk.LEFT, padx=5)
+    order_var = tk.StringVar()
+    ttk.Combobox(header_frame, textvariable=order_var, values=list(draft_orders), state="readonly",
+                 width=30).pack(side=tk.LEFT, padx=5)
+
+    # Manual entry for keyboard wedge scanners and typed lines. The cost and expiry
+    # stay filled in and apply to every following line, scanned ones included.
+    entry_frame = ttk.Frame(receiving_window)
+    entry_frame.pack(fill=tk.X, padx=10, pady=5)
+    ttk.Label(entry_frame, text="SKU:").pack(side=tk.LEFT, padx=5)
+    sku_entry = ttk.Entry(entry_frame)
+    sku_entry.pack(side=tk.LEFT, padx=5)
+    ttk.Label(entry_frame, text="Qty:").pack(side=tk.LEFT, padx=5)
+    qty_var = tk.IntVar(value=1)
+    ttk.Spinbox(entry_frame, from_=-9999, to=99999, textvariable=qty_var, width=6).pack(side=tk.LEFT, padx=5)
+    ttk.Label(entry_frame, text="Unit Cost:").pack(side=tk.LEFT, padx=5)
+    cost_entry = ttk.Entry(entry_frame, width=10)
+    cost_entry.pack(side=tk.LEFT, padx=5)
+    ttk.Label(entry_frame, text="Expiry (YYYY-MM-DD):").pack(side=tk.LEFT, padx=5)
+    expiry_entry = ttk.Entry(entry_frame, width=12)
+    expiry_entry.pack(side=tk.LEFT, padx=5)
+
+    columns = ("SKU", "Name", "Quantity", "Unit Cost", "Expiry", "Total")
+    tree = ttk.Treeview(receiving_window, columns=columns, show="headings")
+    for col in columns:
+        tree.heading(col, text=col)
+        tree.column(col, width=130, anchor="center")
+    tree.column("Name", width=220)
+    tree.tag_configure("unknown", foreground="orange")
+    tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+    summary_label = ttk.Label(receiving_window, text="", font=('Helvetica', 12, 'bold'))
+    summary_label.pack(anchor=tk.W, padx=10, pady=5)
+
+    def update_summary():
+        units = sum(line['quantity'] for line in lines.values())
+        total = sum(line['quantity'] * line['unit_cost'] for line in lines.values())
+        summary_label.config(text=f"Lines: {len(lines)} - Units: {units} - Cost: {format_money(total)} - "
+                                  f"Unknown SKUs: {len(unknown)}")
+
+    def show_line(iid):
+        line = lines[iid]
+        values = (line['sku'], line['name'], line['quantity'], format_money(line['unit_cost']),
+                  line['expiry'] or "", format_money(line['quantity'] * line['unit_cost']))
+        if tree.exists(iid):
+            tree.item(iid, values=values)
+        else:
+            tree.insert("", 0, iid=iid, values=values)
+
+    def entry_cost_and_expiry():
+        # Raises ValueError for a bad cost or date; None for a blank field
+        unit_cost = to_cents(cost_entry.get()) if cost_entry.get().strip() else None
+        if unit_cost is not None and unit_cost < 0:
+            raise ValueError("Cost cannot be negative")
+        expiry = expiry_entry.get().strip()
+        if expiry:
+            expiry = datetime.strptime(expiry, "%Y-%m-%d").strftime("%Y-%m-%d")
+        return unit_cost, expiry or None
+
+    def receive_line(sku, quantity, unit_cost=None, expiry=None):
+        product = catalog.get(sku)
+        if product is None:
+            unknown[sku] = unknown.get(sku, 0) + quantity
+            iid = f"unknown:{sku}"
+            values = (sku, "Unknown SKU", unknown[sku], "-", "", "-")
+            if tree.exists(iid):
+                tree.item(iid, values=values)
+            else:
+                tree.insert("", 0, iid=iid, values=values, tags=("unknown",))
+        else:
+            product_id, name, current_cost = product
+            if unit_cost is None:
+                unit_cost = current_cost
+            iid = f"{product_id}|{unit_cost}|{expiry or ''}"
+            line = lines.setdefault(iid, {'product_id': product_id, 'sku': sku, 'name': name,
+                                          'quantity': 0, 'unit_cost': unit_cost, 'expiry': expiry})
+            line['quantity'] = max(0, line['quantity'] + quantity)
+            show_line(iid)
+        update_summary()
+
+    def receive_scan(sku, quantity):
+        # Scans from barcode_queue take the cost and expiry currently filled in
+        try:
+            unit_cost, expiry = entry_cost_and_expiry()
+        except ValueError:
+            messagebox.showerror("Error", f"Scan of {sku} not booked: please fix the cost or expiry first!",
+                                 parent=receiving_window)
+            return
+        receive_line(sku, quantity, unit_cost, expiry)
+
+    def add_manual(event=None):
+        sku = sku_entry.get().strip()
+        try:
+            quantity = qty_var.get()
+            unit_cost, expiry = entry_cost_and_expiry()
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Error", "Please enter a valid quantity, cost and expiry!", parent=receiving_window)
+            return
+        if sku:
+            receive_line(sku, quantity, unit_cost, expiry)
+        sku_entry.delete(0, tk.END)
+        qty_var.set(1)
+        sku_entry.focus_set()
+
+    sku_entry.bind("<Return>", add_manual)
+    ttk.Button(entry_frame, text="Add", command=add_manual).pack(side=tk.LEFT, padx=5)
+
+    def load_order(event=None):
+        order_id = draft_orders.get(order_var.get())
+        if order_id is None:
+            return
+        c.execute("""SELECT p.sku, poi.quantity, poi.unit_cost, co.name
+                     FROM purchase_order_items poi
+                     JOIN products p ON p.id = poi.product_id
+                     LEFT JOIN purchase_orders po ON po.id = poi.purchase_order_id
+                     LEFT JOIN companies co ON co.company_id = po.company_id
+                     WHERE poi.purchase_order_id = ?""", (order_id,))
+        for sku, quantity, unit_cost, company_name in c.fetchall():
+            receive_line(sku, quantity or 0, unit_cost)
+            if company_name:
+                company_var.set(company_name)
+        loaded_order[0] = order_id
+
+    def remove_selected(event=None):
+        for iid in tree.selection():
+            if iid.startswith("unknown:"):
+                unknown.pop(iid[len("unknown:"):], None)
+            else:
+                lines.pop(iid, None)
+            tree.delete(iid)
+        update_summary()
+
+    tree.bind("<Delete>", remove_selected)
+
+    def close_session():
+        global active_scan_handler
+        if lines and not messagebox.askyesno("Receive Goods", "Discard the lines that were not committed?",
+                                             parent=receiving_window):
+            return
+        active_scan_handler = None
+        receiving_window.destroy()
+
+    def commit():
+        global active_scan_handler
+        received = [(line['product_id'], line['quantity'], line['unit_cost'], line['expiry'])
+                    for line in lines.values() if line['quantity'] > 0]
+        if not received:
+            messagebox.showwarning("Error", "Nothing has been received yet!", parent=receiving_window)
+            return
+        if unknown and not messagebox.askyesno(
+                "Receive Goods", f"{len(unknown)} unknown SKU(s) will be left out. Continue?",
+                parent=receiving_window):
+            return
+        company_id = None
+        if company_var.get().strip():
+            c.execute("SELECT company_id FROM companies WHERE name = ?", (company_var.get().strip(),))
+            company = c.fetchone()
+            company_id = company[0] if company else None
+        try:
+            receipt_id = commit_goods_receipt(received, company_id, loaded_order[0], reference_entry.get().strip())
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"An error occurred: {str(e)}", parent=receiving_window)
+            return
+        invalidate_product_cache(list({product_id for product_id, _, _, _ in received}))
+        request_report_refresh()
+        view_products()
+        refresh_low_stock_button()
+        messagebox.showinfo("Success", f"Goods receipt #{receipt_id} committed: {len(received)} lines.",
+                            parent=receiving_window)
+        active_scan_handler = None
+        receiving_window.destroy()
+
+    ttk.Button(header_frame, text="Load Order", command=load_order).pack(side=tk.LEFT, padx=5)
+
+    button_row = ttk.Frame(receiving_window)
+    button_row.pack(fill=tk.X, padx=10, pady=10)
+    ttk.Button(button_row, text="Remove Line", command=remove_selected).pack(side=tk.LEFT, padx=5)
+    ttk.Button(button_row, text="Commit Receipt", command=commit, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
+    ttk.Button(button_row, text="Cancel", command=close_session).pack(side=tk.RIGHT, padx=5)
+
+    receiving_window.protocol("WM_DELETE_WINDOW", close_session)
+    active_scan_handler = receive_scan
+    update_summary()
+    sku_entry.focus_set()
 
 barcode_queue = queue.Queue()
 
+# ------------------------------------------------------------------------------
+# Scan De-duplication
+# ------------------------------------------------------------------------------
+# Scanner apps retry on flaky Wi-Fi. A scan sent with a scan_id is accepted once;
+# the same id from the same scanner within the window is answered but not queued.
+SCAN_ID_TTL_SECONDS = 120
+SCAN_ID_CACHE_SIZE = 1000  # per scanner
+
+recent_scan_ids = {}
+recent_scan_ids_lock = threading.Lock()
+
+def is_duplicate_scan(scanner, scan_id):
+    now = time.monotonic()
+    with recent_scan_ids_lock:
+        seen = recent_scan_ids.setdefault(scanner, OrderedDict())
+        # Entries are in arrival order, so expired ones are at the front
+        while seen and next(iter(seen.values())) < now - SCAN_ID_TTL_SECONDS:
+            seen.popitem(last=False)
+        if scan_id in seen:
+            return True
+        seen[scan_id] = now
+        if len(seen) > SCAN_ID_CACHE_SIZE:
+            seen.popitem(last=False)
+        return False
+
+# ------------------------------------------------------------------------------
+# Product Lookup Cache (price-check API)
+# ------------------------------------------------------------------------------
+# The whole catalog is held in memory for GET /product and read through its own
+# connection, never the GUI cursor. The Tk thread marks changed products dirty
+# and only those rows are re-read on the next lookup.
+product_cache = None  # sku -> product dict, None until first use
+product_cache_skus = {}  # product id -> sku, to drop renamed/removed entries
+product_cache_dirty = set()
+product_cache_full_reload = False
+product_cache_lock = threading.Lock()
+product_cache_db = None
+
+PRODUCT_CACHE_QUERY = """SELECT p.id, p.name, p.sku, p.stock, p.selling_price, p.wholesale_price,
+                                 COALESCE(co.name, '')
+                          FROM products p
+                          LEFT JOIN companies co ON co.company_id = p.company_id"""
+
+def invalidate_product_cache(product_ids=None):
+    # Called after commits; None means everything may have changed
+    global product_cache_full_reload
+    with product_cache_lock:
+        if product_ids is None:
+            product_cache_full_reload = True
+        else:
+            product_cache_dirty.update(product_ids)
+
+def cache_product_rows(rows):
+    for product_id, name, sku, stock, selling_price, wholesale_price, company in rows:
+        old_sku = product_cache_skus.pop(product_id, None)
+        if old_sku is not None:
+            product_cache.pop(old_sku, None)
+        if sku is None:
+            continue
+        product_cache_skus[product_id] = sku
+        product_cache[sku] = {
+            'id': product_id,
+            'name': name,
+            'sku': sku,
+            'stock': stock,
+            # Decimal strings, so scanner apps never see float rounding
+            'price': money_text(selling_price),
+            'wholesale_price': money_text(wholesale_price),
+            'company': company,
+        }
+
+def lookup_product(sku):
+    global product_cache, product_cache_db, product_cache_full_reload
+    with product_cache_lock:
+        if product_cache_db is None:
+            product_cache_db = sqlite3.connect('inventory.db', timeout=5, check_same_thread=False)
+        if product_cache is None or product_cache_full_reload:
+            product_cache = {}
+            product_cache_skus.clear()
+            product_cache_dirty.clear()
+            product_cache_full_reload = False
+            cache_product_rows(product_cache_db.execute(PRODUCT_CACHE_QUERY).fetchall())
+        elif product_cache_dirty:
+            dirty_ids = list(product_cache_dirty)
+            product_cache_dirty.clear()
+            rows = product_cache_db.execute(
+                PRODUCT_CACHE_QUERY + f" WHERE p.id IN ({','.join('?' * len(dirty_ids))})", dirty_ids).fetchall()
+            # Ids that no longer exist only need their old entry removed
+            found = {row[0] for row in rows}
+            for product_id in dirty_ids:
+                if product_id not in found:
+                    product_cache.pop(product_cache_skus.pop(product_id, None), None)
+            cache_product_rows(rows)
+        return product_cache.get(sku)
+
 # ------------------------------------------------------------------------------
 # Barcode HTTP Server Handler
 # ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Scan Relay Intake
+# ------------------------------------------------------------------------------
+# server.py queues scans on disk and POSTs them here in batches of
+# {"relay_id": ..., "scans": [{"seq": ..., "code": ..., "scanner": ..., "scan_id": ...}]}.
+# Progress is committed before the scans are queued; the reply tells the relay
+# how far it may advance its queue.
+relay_lock = threading.Lock()
+relay_db = None
+
+def accept_relay_batch(relay_id, scans):
+    # Returns (number of new scans, highest seq taken from this relay)
+    global relay_db
+    with relay_lock:
+        if relay_db is None:
+            relay_db = sqlite3.connect('inventory.db', timeout=5, check_same_thread=False)
+        row = relay_db.execute("SELECT last_seq FROM relay_progress WHERE relay_id = ?", (relay_id,)).fetchone()
+        last_seq = row[0] if row else 0
+        fresh = [scan for scan in scans if scan['seq'] > last_seq]
+        if not fresh:
+            return 0, last_seq
+
+        last_seq = max(scan['seq'] for scan in fresh)
+        with relay_db:
+            relay_db.execute("""INSERT INTO relay_progress (relay_id, last_seq, updated_at)
+                                VALUES (?, ?, ?)
+                                ON CONFLICT(relay_id) DO UPDATE SET
+                                    last_seq = excluded.last_seq,
+                                    updated_at = excluded.updated_at""",
+                             (relay_id, last_seq, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        for scan in fresh:
+            if scan.get('scan_id') and is_duplicate_scan(scan.get('scanner'), scan['scan_id']):
+                continue
+            barcode_queue.put(str(scan['code']))
+        return len(fresh), last_seq
+
 class BarcodeHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
-        query = urllib.parse.urlparse(self.path).query
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path == "/product":
+            # Read-only price check for scanner apps
+            sku = urllib.parse.parse_qs(parsed.query).get("sku", [""])[0]
+            if not sku:
+                self.send_json(400, {'error': "missing sku"})
+                return
+            try:
+                product = lookup_product(sku)
+            except sqlite3.Error as e:
+                self.send_json(503, {'error': str(e)})
+                return
+            if product is None:
+                self.send_json(404, {'error': "not found", 'sku': sku})
+            else:
+                self.send_json(200, product)
+            return
+
+        query = parsed.query
+        reply = b"Barcode Received"
         if "code=" in query and "http" not in query:
-            sku = query[5:]  # assumes the query is exactly like "code=..."
-            print(f"Received Barcode: {sku}")
-            # Put the SKU into the queue for the Tkinter thread to process
-            barcode_queue.put(sku)
+            params = urllib.parse.parse_qs(query)
+            # "code=" also matches e.g. ?barcode=1, and parse_qs drops blank values
+            sku = params.get("code", [""])[0]
+            # Optional: scan_id makes retries idempotent, scanner names the device
+            scan_id = params.get("scan_id", [None])[0]
+            scanner = params.get("scanner", [self.client_address[0]])[0]
+            if not sku:
+                reply = b"No Barcode"
+            elif scan_id and is_duplicate_scan(scanner, scan_id):
+                reply = b"Duplicate Ignored"
+            else:
+                print(f"Received Barcode: {sku}")
+                # Put the SKU into the queue for the Tkinter thread to process
+                barcode_queue.put(sku)
         self.send_response(200)
         self.end_headers()
-        self.wfile.write(b"Barcode Received")
+        self.wfile.write(reply)
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != "/relay":
+            self.send_json(404, {'error': "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            batch = json.loads(self.rfile.read(length))
+            relay_id = str(batch['relay_id'])
+            scans = [scan for scan in batch['scans'] if isinstance(scan['seq'], int)]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': "bad batch"})
+            return
+        try:
+            accepted, acked = accept_relay_batch(relay_id, scans)
+        except sqlite3.Error as e:
+            self.send_json(503, {'error': str(e)})
+            return
+        self.send_json(200, {'accepted': accepted, 'acked': acked})
 
 def run_barcode_server():
-    server = HTTPServer(("0.0.0.0", 8080), BarcodeHandler)
+    # One thread per request so price checks never wait behind each other
+    server = ThreadingHTTPServer(("0.0.0.0", 8080), BarcodeHandler)
     print("Barcode server started on port 8080...")
     server.serve_forever()
 
@@ -973,7 +4475,7 @@ barcode_thread.start()
 # ------------------------------------------------------------------------------
 
 # ------------------------------------------------------------------------------
-def process_barcode(sku):
+def process_barcode(sku, quantity=1):
     # Query the database for a product with this SKU.
     c.execute("SELECT id, name, sku, stock, purchase_price, selling_price, wholesale_price FROM products WHERE sku = ?", (sku,))
     product = c.fetchone()
@@ -981,23 +4483,20 @@ def process_barcode(sku):
     if product:
         product_id, name, sku, stock, p_price, s_price, w_price = product
         # Check if product already exists in the current invoice.
-        for item in invoice_items:
-            if item['product_id'] == product_id:
-                # Increase the quantity by 1.
-                current_qty = item['quantity'].get()
-                item['quantity'].set(current_qty + 1)
-                update_invoice_item_total(item)
-                calculate_grand_total()  # Make sure to recalc the invoice total.
-                return
+        item = invoice_lines.get(product_id)
+        if item:
+            # Increase the quantity by the number of scans.
+            change_invoice_quantity(item, item['quantity'] + quantity)
+            return
         
         # Otherwise, add this product as a new invoice item.
-        add_to_invoice(sku)
+        add_to_invoice(sku, quantity)
     else:
         # Product not found: open a small window to add a new product.
-        open_new_product_window(sku)
+        open_new_product_window(sku, quantity)
 
 
-def open_new_product_window(sku):
+def open_new_product_window(sku, quantity=1):
     # This window will allow the user to enter details for a new product.
     new_product_win = tk.Toplevel(root)
     new_product_win.title("New Product")
@@ -1066,9 +4565,9 @@ def open_new_product_window(sku):
 
         try:
             stock = int(stock_entry.get())
-            purchase_price = float(purchase_entry.get())
-            selling_price = float(selling_entry.get())
-            wholesale_price = float(wholesale_entry.get())
+            purchase_price = to_cents(purchase_entry.get())
+            selling_price = to_cents(selling_entry.get())
+            wholesale_price = to_cents(wholesale_entry.get())
         except ValueError:
             messagebox.showerror("Error", "Please enter valid numbers for stock and prices!")
             return
@@ -1096,10 +4595,13 @@ def open_new_product_window(sku):
             c.execute("""INSERT INTO products (name, sku, stock, purchase_price, selling_price, wholesale_price, company_id)
                          VALUES (?, ?, ?, ?, ?, ?, ?)""",
                       (name, sku, stock, purchase_price, selling_price, wholesale_price, company_id)) # Include company_id
+            product_id = c.lastrowid
+            record_stock_movements([(product_id, stock, purchase_price, 'initial', None)])
             conn.commit()
+            invalidate_product_cache([product_id])
             messagebox.showinfo("Success", "Product added!")
             new_product_win.destroy()
-            add_to_invoice(sku)  # Add the new product to the invoice
+            add_to_invoice(sku, quantity)  # Add the new product to the invoice
             view_products()
         except sqlite3.IntegrityError:
             messagebox.showerror("Error", "A product with this SKU already exists!")
@@ -1110,10 +4612,25 @@ def open_new_product_window(sku):
 # Function to Periodically Check the Barcode Queue
 # ------------------------------------------------------------------------------
 def check_barcode_queue():
+    scanned = []
+    try:
+        while True:
+            scanned.append(barcode_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if scanned:
+        mark_activity()
+    # Rapid-fire scans of the same SKU become one quantity increment
+    for sku, group in groupby(scanned):
+        if active_scan_handler is not None:
+            # A stocktake (or similar) session takes the scans instead of the invoice
+            active_scan_handler(sku, sum(1 for _ in group))
+        else:
+            process_barcode(sku, sum(1 for _ in group))
+    # Run anything the background workers asked the Tk thread to do
     try:
         while True:
-            sku = barcode_queue.get_nowait()
-            process_barcode(sku)
+            ui_callbacks.get_nowait()()
     except queue.Empty:
         pass
     # Schedule the next check after 100 milliseconds.
@@ -1122,6 +4639,10 @@ def check_barcode_queue():
 # Start checking the barcode queue.
 check_barcode_queue()
 
+# Keyboard and mouse use keeps idle-time maintenance away
+root.bind_all("<KeyPress>", mark_activity, add="+")
+root.bind_all("<ButtonPress>", mark_activity, add="+")
+
 
 
 
@@ -1162,23 +4683,64 @@ ttk.Label(invoice_header, text="Current Invoice",
          font=('Helvetica', 14, 'bold'), foreground="white", 
          background="#0078d4",style="Accent.TButton").pack(pady=10)
 
-# Invoice Items Canvas
-invoice_canvas = tk.Canvas(invoice_frame, borderwidth=0)
-invoice_scrollbar = ttk.Scrollbar(invoice_frame, orient="vertical", command=invoice_canvas.yview)
-invoice_items_frame = ttk.Frame(invoice_canvas)
-
-invoice_items_frame.bind(
-    "<Configure>",
-    lambda e: invoice_canvas.configure(
-        scrollregion=invoice_canvas.bbox("all")
-    )
-)
+# Reports and tools
+tools_frame = ttk.Frame(invoice_frame)
+tools_frame.pack(fill=tk.X, pady=(0, 10))
+
+ttk.Button(tools_frame, text="Today's Sales",
+          command=show_sales_dashboard).pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Sales Analytics",
+          command=show_sales_analytics).pack(side=tk.LEFT, padx=5)
+low_stock_button = ttk.Button(tools_frame, text="Low Stock",
+                              command=show_low_stock)
+low_stock_button.pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Inventory Valuation",
+          command=show_inventory_valuation).pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Stocktake",
+          command=show_stocktake).pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Receive Goods",
+          command=show_goods_receiving).pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Expiring Soon",
+          command=show_expiring_lots).pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Promotions",
+          command=show_promotions).pack(side=tk.LEFT, padx=5)
+ttk.Button(tools_frame, text="Print Labels",
+          command=show_label_sheets).pack(side=tk.LEFT, padx=5)
+
+# Invoice Lines
+# One Treeview row per line and a single reusable quantity editor, so the widget
+# count stays the same however long the invoice gets. Double-click Wholesale to
+# toggle it or Qty to edit it; Delete removes the selected lines.
+invoice_list_frame = ttk.Frame(invoice_frame)
+invoice_list_frame.pack(fill=tk.BOTH, expand=True)
+
+invoice_columns = ("Name", "SKU", "Wholesale", "Price", "Qty", "Discount", "Total")
+INVOICE_WHOLESALE_COLUMN = f"#{invoice_columns.index('Wholesale') + 1}"
+INVOICE_QUANTITY_COLUMN = f"#{invoice_columns.index('Qty') + 1}"
+invoice_tree = ttk.Treeview(invoice_list_frame, columns=invoice_columns, show="headings")
+for col in invoice_columns:
+    invoice_tree.heading(col, text=col)
+    invoice_tree.column(col, width=80, anchor="center")
+invoice_tree.column("Name", width=160, anchor="w")
+invoice_tree.column("SKU", width=110)
+invoice_tree.column("Qty", width=60)
+
+invoice_scrollbar = ttk.Scrollbar(invoice_list_frame, orient="vertical", command=invoice_tree.yview)
+invoice_tree.configure(yscrollcommand=invoice_scrollbar.set)
+invoice_tree.pack(side="left", fill="both", expand=True)
+invoice_scrollbar.pack(side="right", fill="y")
 
-invoice_canvas.create_window((0, 0), window=invoice_items_frame, anchor="nw")
-invoice_canvas.configure(yscrollcommand=invoice_scrollbar.set)
+invoice_line_editor = ttk.Spinbox(invoice_tree, from_=1, to=100000)
+invoice_line_editor.bind("<Return>", finish_invoice_line_edit)
+invoice_line_editor.bind("<FocusOut>", finish_invoice_line_edit)
+invoice_line_editor.bind("<Escape>", cancel_invoice_line_edit)
 
-invoice_canvas.pack(side="left", fill="both", expand=True)
-invoice_scrollbar.pack(side="right", fill="y")
+invoice_tree.bind("<Double-1>", edit_invoice_line)
+invoice_tree.bind("<Delete>", delete_selected_invoice_items)
+# Scrolling would leave the editor over the wrong row
+invoice_tree.bind("<MouseWheel>", cancel_invoice_line_edit, add="+")
+invoice_tree.bind("<Button-4>", cancel_invoice_line_edit, add="+")
+invoice_tree.bind("<Button-5>", cancel_invoice_line_edit, add="+")
 
 
 
@@ -1189,6 +4751,8 @@ invoice_controls.pack(fill=tk.X, pady=10)
 
 ttk.Button(invoice_controls, text="Add Selected Item", 
           command=lambda: add_to_invoice()).pack(side=tk.LEFT, padx=5)
+ttk.Button(invoice_controls, text="Remove Line",
+          command=delete_selected_invoice_items).pack(side=tk.LEFT, padx=5)
 ttk.Button(invoice_controls, text="Submit Invoice", 
           command=submit_invoice, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
 
@@ -1200,15 +4764,31 @@ ttk.Label(total_frame, text="Total:", font=('Helvetica', 12, 'bold')).pack(side=
 invoice_total = ttk.Label(total_frame, text="$0.00", font=('Helvetica', 12, 'bold'))
 invoice_total.pack(side=tk.RIGHT)
 
-# Invoice items storage
+# Invoice items storage, in display order and by product id
 invoice_items = []
+invoice_lines = {}
 
 
 # Add history button to main UI
 history_button = ttk.Button(main_frame, text="View History", command=show_invoice_history)
 history_button.grid(row=0, column=1, sticky="ne", padx=10, pady=10)
 
+backfill_daily_sales()
+compile_promotions()
+seed_today_stats()
+attach_archives(conn)
 view_products()
+refresh_low_stock_button()
+maybe_take_stock_snapshot()
+
+# Background workers
+daily_price_thread = threading.Thread(target=daily_price_worker, daemon=True)
+daily_price_thread.start()
+report_replica_thread = threading.Thread(target=report_replica_worker, daemon=True)
+report_replica_thread.start()
+maintenance_thread = threading.Thread(target=maintenance_worker, daemon=True)
+maintenance_thread.start()
+request_report_refresh()
 
 # Run the app
 root.mainloop()
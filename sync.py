@@ -0,0 +1,288 @@
+import sqlite3
+import sys
+import gzip
+import json
+import argparse
+from datetime import datetime
+
+# Shop-to-shop sync through small files instead of whole database copies.
+#
+#   python sync.py export <peer_id> <file.json.gz>   changes the peer has not acknowledged
+#   python sync.py import <file.json.gz>             apply a peer's file
+#   python sync.py status                            this shop's id and its peers
+#
+# store.py logs every insert/update of products, companies, invoices and
+# invoice_items in change_log. An export carries the current state of the rows
+# changed since the peer's last acknowledged seq (everything on the first export),
+# plus the highest seq this shop has imported from that peer as its acknowledgement.
+#
+# Conflict rules:
+#   - companies and product names/companies: created when missing, local edits win
+#   - prices: the newest change wins (by price_history time); applied changes are
+#     written to price_history with source 'sync'
+#   - stock: each shop owns its stock; a peer's stock only goes into peer_stock and
+#     new products start at 0 locally
+#   - invoices: the peer's own invoices are copied (keyed by origin shop and id) and
+#     added to daily_sales; they never touch local stock
+#
+# Amounts in the file are integer cents, like the database; files from before
+# the switch to cents (no 'money' in the header) are refused.
+DB_PATH = 'inventory.db'
+
+def now_text():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def shop_id(db):
+    return db.execute("SELECT value FROM app_settings WHERE key = 'shop_id'").fetchone()[0]
+
+def changed_filter(column, table, since):
+    # SQL fragment limiting `column` to rows logged after `since`; nothing on a
+    # first export (since = 0), which sends every row
+    if since == 0:
+        return "", []
+    return (f" AND {column} IN (SELECT row_id FROM change_log WHERE table_name = ? AND seq > ?)",
+            [table, since])
+
+def export_changes(db, peer_id, path):
+    db.execute("INSERT OR IGNORE INTO sync_peers (peer_id) VALUES (?)", (peer_id,))
+    db.commit()
+    db.execute("BEGIN")  # one consistent read of the log and the rows
+    acked_seq, imported_seq = db.execute(
+        "SELECT acked_seq, imported_seq FROM sync_peers WHERE peer_id = ?", (peer_id,)).fetchone()
+    # The AUTOINCREMENT counter, which survives pruning of the log
+    to_seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'change_log'").fetchone()[0]
+
+    records = []
+    where, params = changed_filter("company_id", 'companies', acked_seq)
+    for name, percentage, lead_time_days, safety_days in db.execute(
+            f"""SELECT name, daily_price_percentage, lead_time_days, safety_days
+                FROM companies WHERE 1 = 1{where}""", params):
+        records.append({'type': 'company', 'name': name, 'daily_price_percentage': percentage,
+                        'lead_time_days': lead_time_days, 'safety_days': safety_days})
+
+    where, params = changed_filter("p.id", 'products', acked_seq)
+    for row in db.execute(f"""SELECT p.sku, p.name, co.name, p.purchase_price, p.selling_price,
+                                     p.wholesale_price, p.stock,
+                                     (SELECT MAX(changed_at) FROM price_history ph WHERE ph.product_id = p.id)
+                              FROM products p
+                              LEFT JOIN companies co ON co.company_id = p.company_id
+                              WHERE 1 = 1{where}""", params):
+        records.append(dict(zip(('sku', 'name', 'company', 'purchase_price', 'selling_price',
+                                 'wholesale_price', 'stock', 'price_changed_at'), row), type='product'))
+
+    # Only this shop's own invoices; imported ones belong to their origin shop
+    where, params = changed_filter("i.id", 'invoices', acked_seq)
+    invoices = db.execute(f"""SELECT i.id, i.date, i.total, i.refund_of
+                              FROM invoices i
+                              WHERE i.origin_shop IS NULL{where}""", params).fetchall()
+    items = {}
+    where, params = changed_filter("ii.invoice_id", 'invoices', acked_seq)
+    for row in db.execute(f"""SELECT ii.invoice_id, p.sku, ii.quantity, ii.unit_price, ii.total_price,
+                                     ii.historical_purchase_price, ii.historical_selling_price, ii.discount
+                              FROM invoice_items ii
+                              JOIN invoices i ON i.id = ii.invoice_id
+                              JOIN products p ON p.id = ii.product_id
+                              WHERE i.origin_shop IS NULL{where}""", params):
+        items.setdefault(row[0], []).append(list(row[1:]))
+    for invoice_id, date, total, refund_of in invoices:
+        records.append({'type': 'invoice', 'id': invoice_id, 'date': date, 'total': total,
+                        'refund_of': refund_of, 'items': items.get(invoice_id, [])})
+    db.rollback()
+
+    header = {'shop_id': shop_id(db), 'peer_id': peer_id, 'from_seq': acked_seq, 'to_seq': to_seq,
+              'ack': imported_seq, 'created_at': now_text(), 'records': len(records), 'money': 'cents'}
+    # One JSON object per line keeps the file streamable; gzip does the rest
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header, separators=(",", ":")) + "\n")
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    db.execute("UPDATE sync_peers SET exported_seq = ?, last_sync = ? WHERE peer_id = ?",
+               (to_seq, now_text(), peer_id))
+    db.commit()
+    return header
+
+def import_company(db, record):
+    db.execute("""INSERT OR IGNORE INTO companies (name, daily_price_percentage, lead_time_days, safety_days)
+                  VALUES (?, ?, ?, ?)""",
+               (record['name'], record['daily_price_percentage'], record['lead_time_days'], record['safety_days']))
+
+def import_product(db, peer_id, record, changed_at):
+    # Prices never changed on the peer carry no time and never beat a local price
+    new_prices = (record['purchase_price'], record['selling_price'], record['wholesale_price'])
+    price_changed_at = record['price_changed_at'] or ""
+    row = db.execute("""SELECT p.id, p.purchase_price, p.selling_price, p.wholesale_price,
+                               (SELECT MAX(changed_at) FROM price_history ph WHERE ph.product_id = p.id)
+                        FROM products p WHERE p.sku = ?""", (record['sku'],)).fetchone()
+    if row is None:
+        company = db.execute("SELECT company_id FROM companies WHERE name = ?", (record['company'],)).fetchone()
+        cur = db.execute("""INSERT INTO products (name, sku, stock, purchase_price, selling_price,
+                                                  wholesale_price, company_id)
+                            VALUES (?, ?, 0, ?, ?, ?, ?)""",
+                         (record['name'], record['sku'], *new_prices, company[0] if company else None))
+        record_sync_price(db, cur.lastrowid, price_changed_at or changed_at, new_prices, new_prices)
+    else:
+        product_id, old_prices, local_changed_at = row[0], row[1:4], row[4]
+        if tuple(old_prices) != new_prices and price_changed_at > (local_changed_at or ""):
+            db.execute("""UPDATE products SET purchase_price = ?, selling_price = ?, wholesale_price = ?
+                          WHERE id = ?""", (*new_prices, product_id))
+            record_sync_price(db, product_id, price_changed_at, old_prices, new_prices)
+
+    db.execute("""INSERT INTO peer_stock (peer_id, sku, stock, updated_at) VALUES (?, ?, ?, ?)
+                  ON CONFLICT(peer_id, sku) DO UPDATE SET
+                      stock = excluded.stock, updated_at = excluded.updated_at""",
+               (peer_id, record['sku'], record['stock'], changed_at))
+
+def record_sync_price(db, product_id, changed_at, old_prices, new_prices):
+    db.execute("""INSERT INTO price_history
+                  (product_id, changed_at, source,
+                   old_purchase_price, new_purchase_price,
+                   old_selling_price, new_selling_price,
+                   old_wholesale_price, new_wholesale_price)
+                  VALUES (?, ?, 'sync', ?, ?, ?, ?, ?, ?)""",
+               (product_id, changed_at, old_prices[0], new_prices[0], old_prices[1], new_prices[1],
+                old_prices[2], new_prices[2]))
+
+def add_daily_sales(db, day, invoice_count, revenue, cost):
+    # Same rollup update as store.py
+    db.execute("""INSERT INTO daily_sales (day, invoice_count, revenue, cost)
+                  VALUES (?, ?, ?, ?)
+                  ON CONFLICT(day) DO UPDATE SET
+                      invoice_count = invoice_count + excluded.invoice_count,
+                      revenue = revenue + excluded.revenue,
+                      cost = cost + excluded.cost""",
+               (day, invoice_count, revenue, cost))
+
+def import_invoice(db, peer_id, record):
+    # Re-importing an invoice replaces it, backing its old figures out of daily_sales first.
+    # Returns the number of lines skipped because their product is unknown here.
+    existing = db.execute("SELECT id, date, total FROM invoices WHERE origin_shop = ? AND origin_id = ?",
+                          (peer_id, record['id'])).fetchone()
+    refund_of = None
+    if record['refund_of'] is not None:
+        original = db.execute("SELECT id FROM invoices WHERE origin_shop = ? AND origin_id = ?",
+                              (peer_id, record['refund_of'])).fetchone()
+        refund_of = original[0] if original else None
+
+    if existing:
+        invoice_id, old_date, old_total = existing
+        old_cost = db.execute("""SELECT COALESCE(SUM(quantity * historical_purchase_price), 0)
+                                 FROM invoice_items WHERE invoice_id = ?""", (invoice_id,)).fetchone()[0]
+        add_daily_sales(db, old_date[:10], -1, -old_total, -old_cost)
+        db.execute("DELETE FROM invoice_items WHERE invoice_id = ?", (invoice_id,))
+        db.execute("UPDATE invoices SET date = ?, total = ?, refund_of = ? WHERE id = ?",
+                   (record['date'], record['total'], refund_of, invoice_id))
+        # The invoice id stays the same, so tell the register's report cache to start over
+        db.execute("""INSERT INTO app_settings (key, value) VALUES ('report_version', 1)
+                      ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1""")
+    else:
+        invoice_id = db.execute("""INSERT INTO invoices (date, total, refund_of, origin_shop, origin_id)
+                                   VALUES (?, ?, ?, ?, ?)""",
+                                (record['date'], record['total'], refund_of, peer_id, record['id'])).lastrowid
+
+    skipped = 0
+    cost = 0
+    for sku, quantity, unit_price, total_price, purchase_price, selling_price, discount in record['items']:
+        product = db.execute("SELECT id FROM products WHERE sku = ?", (sku,)).fetchone()
+        if product is None:
+            skipped += 1
+            continue
+        db.execute("""INSERT INTO invoice_items
+                      (invoice_id, product_id, quantity, unit_price, total_price,
+                       historical_purchase_price, historical_selling_price, discount)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                   (invoice_id, product[0], quantity, unit_price, total_price, purchase_price, selling_price,
+                    discount or 0))
+        cost += quantity * purchase_price
+    add_daily_sales(db, record['date'][:10], 1, record['total'], cost)
+    return skipped
+
+def import_changes(db, path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        records = [json.loads(line) for line in f]
+    peer_id = header['shop_id']
+    if peer_id == shop_id(db):
+        raise ValueError("This file was exported by this shop.")
+    if header['peer_id'] != shop_id(db):
+        raise ValueError(f"This file was exported for shop {header['peer_id']}.")
+    if header.get('money') != 'cents':
+        raise ValueError("This file has amounts in dollars; update the other shop and export again.")
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("INSERT OR IGNORE INTO sync_peers (peer_id) VALUES (?)", (peer_id,))
+        imported_seq = db.execute("SELECT imported_seq FROM sync_peers WHERE peer_id = ?", (peer_id,)).fetchone()[0]
+        if header['from_seq'] > imported_seq:
+            raise ValueError(f"Changes {imported_seq + 1}-{header['from_seq']} from this shop are missing; "
+                             "import the earlier file first.")
+
+        # Rows written below are not logged, so they are never sent back
+        db.execute("INSERT INTO sync_applying (applying) VALUES (1)")
+        skipped = 0
+        applied = header['to_seq'] > imported_seq or header['from_seq'] == 0
+        if applied:
+            for record in records:
+                if record['type'] == 'company':
+                    import_company(db, record)
+            for record in records:
+                if record['type'] == 'product':
+                    import_product(db, peer_id, record, header['created_at'])
+            for record in records:
+                if record['type'] == 'invoice':
+                    skipped += import_invoice(db, peer_id, record)
+
+        db.execute("""UPDATE sync_peers SET imported_seq = MAX(imported_seq, ?), acked_seq = MAX(acked_seq, ?),
+                      last_sync = ? WHERE peer_id = ?""",
+                   (header['to_seq'], header['ack'], now_text(), peer_id))
+        # Changes every peer has acknowledged are no longer needed
+        db.execute("DELETE FROM change_log WHERE seq <= (SELECT MIN(acked_seq) FROM sync_peers)")
+        db.execute("DELETE FROM sync_applying")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return header, applied, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync inventory databases between shops")
+    parser.add_argument("--db", default=DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("peer_id")
+    export_parser.add_argument("path")
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("path")
+    commands.add_parser("status")
+    args = parser.parse_args()
+
+    # isolation_level=None: transactions are opened explicitly above
+    db = sqlite3.connect(args.db, timeout=30, isolation_level=None)
+    # store.py converts the money columns to cents when it starts
+    price_type = db.execute("SELECT type FROM pragma_table_info('products') WHERE name = 'selling_price'").fetchone()
+    if price_type and price_type[0].upper() == 'REAL':
+        print("This database still has amounts in dollars; start store.py once to convert it.")
+        sys.exit(1)
+    if args.command == "export":
+        header = export_changes(db, args.peer_id, args.path)
+        print(f"Exported {header['records']} records (changes after {header['from_seq']} up to {header['to_seq']}) to {args.path}")
+    elif args.command == "import":
+        try:
+            header, applied, skipped = import_changes(db, args.path)
+        except ValueError as e:
+            print(f"Import failed: {e}")
+            sys.exit(1)
+        if not applied:
+            print(f"Already imported (changes up to {header['to_seq']} from shop {header['shop_id']})")
+            return
+        print(f"Imported {header['records']} records from shop {header['shop_id']}")
+        if skipped:
+            print(f"Skipped {skipped} invoice lines for products unknown here")
+    else:
+        print(f"Shop id: {shop_id(db)}")
+        for peer_id, acked_seq, exported_seq, imported_seq, last_sync in db.execute(
+                "SELECT peer_id, acked_seq, exported_seq, imported_seq, last_sync FROM sync_peers"):
+            print(f"  {peer_id}: acknowledged {acked_seq}/{exported_seq}, imported {imported_seq}, last sync {last_sync}")
+
+if __name__ == "__main__":
+    main()
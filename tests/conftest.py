@@ -0,0 +1,24 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+GUI_IMPORTS = ("import tkinter", "from tkinter", "import reportlab", "from reportlab")
+
+def load_store_database(directory):
+    # store.py opens its window at import time, so only the database part (everything
+    # before "# GUI setup": schema, migrations, helpers) is run, against
+    # directory/inventory.db. Returns the module namespace (conn, c, functions).
+    with open(os.path.join(ROOT, "store.py"), encoding="utf-8") as f:
+        source = f.read()
+    source = source[:source.index("\n# GUI setup")]
+    source = "\n".join(line for line in source.splitlines() if not line.startswith(GUI_IMPORTS))
+    namespace = {}
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        exec(compile(source, os.path.join(ROOT, "store.py"), "exec"), namespace)
+    finally:
+        os.chdir(cwd)
+    return namespace
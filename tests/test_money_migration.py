@@ -0,0 +1,115 @@
+import sqlite3
+
+from conftest import load_store_database
+
+# The tables as they were before amounts moved to integer cents
+LEGACY_SCHEMA = '''
+    CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        sku TEXT UNIQUE,
+        stock INTEGER,
+        purchase_price REAL,
+        selling_price REAL,
+        wholesale_price REAL,
+        company_id INTEGER,
+        FOREIGN KEY (company_id) REFERENCES companies(company_id)
+    );
+    CREATE TABLE companies (
+        company_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        daily_price_percentage REAL DEFAULT 0
+    );
+    CREATE TABLE invoices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        total REAL NOT NULL
+    );
+    CREATE TABLE invoice_items (
+        invoice_id INTEGER,
+        product_id INTEGER,
+        quantity INTEGER,
+        unit_price REAL,
+        total_price REAL,
+        historical_purchase_price REAL,
+        historical_selling_price REAL,
+        FOREIGN KEY(invoice_id) REFERENCES invoices(id),
+        FOREIGN KEY(product_id) REFERENCES products(id)
+    );
+'''
+
+def make_legacy_database(directory):
+    db = sqlite3.connect(str(directory / "inventory.db"))
+    db.executescript(LEGACY_SCHEMA)
+    db.executemany("INSERT INTO products (name, sku, stock, purchase_price, selling_price, wholesale_price) "
+                   "VALUES (?, ?, ?, ?, ?, ?)",
+                   [("Tea", "100", 5, 1.1, 19.99, 0.1 + 0.2),
+                    ("Coffee", "200", 2, 7.0, 12.5, 10.05),
+                    ("Gone", "300", 0, 1.0, 2.0, 1.5)])
+    # The highest id is deleted; the migration must not let it be reused
+    db.execute("DELETE FROM products WHERE sku = '300'")
+    db.execute("INSERT INTO invoices (date, total) VALUES ('2024-03-01 10:00:00', 52.47)")
+    db.executemany("INSERT INTO invoice_items VALUES (1, ?, ?, ?, ?, ?, ?)",
+                   [(1, 2, 19.99, 39.98, 1.1, 19.99), (2, 1, 12.49, 12.49, 7.0, 12.5)])
+    db.commit()
+    db.close()
+
+def column_types(db, table):
+    return {row[1]: row[2].upper() for row in db.execute(f"PRAGMA table_info({table})")}
+
+def test_legacy_amounts_become_cents(tmp_path):
+    make_legacy_database(tmp_path)
+    store = load_store_database(tmp_path)
+    db = store['conn']
+
+    for table, columns in store['MONEY_COLUMNS'].items():
+        types = column_types(db, table)
+        for column in columns:
+            assert types[column] == 'INTEGER', (table, column)
+
+    assert db.execute("SELECT sku, purchase_price, selling_price, wholesale_price FROM products "
+                      "ORDER BY id").fetchall() == [("100", 110, 1999, 30), ("200", 700, 1250, 1005)]
+    assert db.execute("SELECT total FROM invoices").fetchall() == [(5247,)]
+    assert db.execute("SELECT product_id, unit_price, total_price, historical_purchase_price, "
+                      "historical_selling_price FROM invoice_items ORDER BY product_id").fetchall() == \
+        [(1, 1999, 3998, 110, 1999), (2, 1249, 1249, 700, 1250)]
+    # Values come back as ints, not floats that happen to be whole
+    assert all(type(value) is int for value in db.execute("SELECT purchase_price, selling_price FROM products").fetchone())
+
+    # Constraints and the AUTOINCREMENT high-water mark survive the rebuild
+    db.execute("INSERT INTO products (name, sku, stock, purchase_price, selling_price, wholesale_price) "
+               "VALUES ('New', '400', 1, 100, 200, 150)")
+    assert db.execute("SELECT id FROM products WHERE sku = '400'").fetchone() == (4,)
+    try:
+        db.execute("INSERT INTO products (name, sku) VALUES ('Duplicate', '100')")
+        assert False, "sku must stay unique"
+    except sqlite3.IntegrityError:
+        pass
+    db.rollback()
+    db.close()
+
+def test_migration_runs_once(tmp_path):
+    make_legacy_database(tmp_path)
+    first = load_store_database(tmp_path)
+    before = first['conn'].execute("SELECT * FROM products ORDER BY id").fetchall()
+    first['conn'].close()
+
+    # Starting again must not multiply the amounts by 100 a second time
+    second = load_store_database(tmp_path)
+    assert second['conn'].execute("SELECT * FROM products ORDER BY id").fetchall() == before
+    second['conn'].close()
+
+def test_archive_file_is_converted(tmp_path):
+    # Yearly archives written by older versions go through the same migration
+    store = load_store_database(tmp_path)
+    archive = sqlite3.connect(str(tmp_path / "inventory_2020.db"))
+    archive.executescript(LEGACY_SCHEMA)
+    archive.execute("INSERT INTO invoices (date, total) VALUES ('2020-01-02 09:00:00', 3.3)")
+    archive.commit()
+
+    store['migrate_money_columns'](archive.cursor())
+    archive.commit()
+    assert column_types(archive, 'invoices')['total'] == 'INTEGER'
+    assert archive.execute("SELECT total FROM invoices").fetchall() == [(330,)]
+    archive.close()
+    store['conn'].close()
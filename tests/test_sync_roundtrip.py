@@ -0,0 +1,110 @@
+import gzip
+import json
+import sqlite3
+
+import pytest
+
+from conftest import load_store_database
+import sync
+
+def open_shop(directory):
+    directory.mkdir()
+    store = load_store_database(directory)
+    store['conn'].close()
+    # sync.py opens its transactions itself
+    return sqlite3.connect(str(directory / "inventory.db"), isolation_level=None)
+
+@pytest.fixture
+def shops(tmp_path):
+    a = open_shop(tmp_path / "a")
+    b = open_shop(tmp_path / "b")
+    a.execute("INSERT INTO companies (name, daily_price_percentage) VALUES ('Acme', 0)")
+    a.execute("""INSERT INTO products (name, sku, stock, purchase_price, selling_price, wholesale_price, company_id)
+                 VALUES ('Tea', '100', 7, 500, 900, 700, 1)""")
+    a.execute("INSERT INTO invoices (date, total) VALUES ('2024-05-01 10:00:00', 1800)")
+    a.execute("""INSERT INTO invoice_items (invoice_id, product_id, quantity, unit_price, total_price,
+                                            historical_purchase_price, historical_selling_price)
+                 VALUES (1, 1, 2, 900, 1800, 500, 900)""")
+    yield a, b
+    a.close()
+    b.close()
+
+def transfer(source, target, path):
+    sync.export_changes(source, sync.shop_id(target), str(path))
+    return sync.import_changes(target, str(path))
+
+def test_first_export_copies_products_and_invoices(shops, tmp_path):
+    a, b = shops
+    header, applied, skipped = transfer(a, b, tmp_path / "a_to_b.json.gz")
+    assert applied and skipped == 0
+    assert header['money'] == 'cents'
+
+    assert b.execute("SELECT name, stock, purchase_price, selling_price, wholesale_price FROM products "
+                     "WHERE sku = '100'").fetchone() == ('Tea', 0, 500, 900, 700)
+    assert b.execute("SELECT stock FROM peer_stock WHERE peer_id = ? AND sku = '100'",
+                     (sync.shop_id(a),)).fetchone() == (7,)
+    assert b.execute("SELECT date, total, origin_shop, origin_id FROM invoices").fetchall() == \
+        [('2024-05-01 10:00:00', 1800, sync.shop_id(a), 1)]
+    assert b.execute("SELECT quantity, unit_price, historical_purchase_price FROM invoice_items").fetchall() == \
+        [(2, 900, 500)]
+    assert b.execute("SELECT invoice_count, revenue, cost FROM daily_sales WHERE day = '2024-05-01'").fetchone() == \
+        (1, 1800, 1000)
+
+def test_importing_the_same_file_again_counts_nothing_twice(shops, tmp_path):
+    a, b = shops
+    path = tmp_path / "a_to_b.json.gz"
+    transfer(a, b, path)
+    sync.import_changes(b, str(path))
+    assert b.execute("SELECT COUNT(*) FROM invoices").fetchone() == (1,)
+    assert b.execute("SELECT COUNT(*) FROM invoice_items").fetchone() == (1,)
+    assert b.execute("SELECT invoice_count, revenue, cost FROM daily_sales").fetchall() == [(1, 1800, 1000)]
+
+def test_newer_price_wins_and_is_logged(shops, tmp_path):
+    a, b = shops
+    transfer(a, b, tmp_path / "first.json.gz")
+    a.execute("UPDATE products SET selling_price = 1000 WHERE sku = '100'")
+    a.execute("""INSERT INTO price_history (product_id, changed_at, source, old_purchase_price, new_purchase_price,
+                                            old_selling_price, new_selling_price,
+                                            old_wholesale_price, new_wholesale_price)
+                 VALUES (1, '2099-01-01 00:00:00', 'manual', 500, 500, 900, 1000, 700, 700)""")
+    header, applied, skipped = transfer(a, b, tmp_path / "second.json.gz")
+    assert applied and header['to_seq'] > 0
+    assert b.execute("SELECT selling_price, stock FROM products WHERE sku = '100'").fetchone() == (1000, 0)
+    assert b.execute("""SELECT source, old_selling_price, new_selling_price FROM price_history
+                        ORDER BY changed_at DESC LIMIT 1""").fetchone() == ('sync', 900, 1000)
+
+def test_round_trip_does_not_echo(shops, tmp_path):
+    a, b = shops
+    transfer(a, b, tmp_path / "first.json.gz")
+    # Logged now that A has a peer; B acknowledges it on its way back
+    a.execute("UPDATE products SET stock = 6 WHERE sku = '100'")
+    transfer(a, b, tmp_path / "second.json.gz")
+    assert b.execute("SELECT stock FROM peer_stock WHERE sku = '100'").fetchone() == (6,)
+    assert b.execute("SELECT COUNT(*) FROM change_log").fetchone() == (0,)
+
+    header, applied, skipped = transfer(b, a, tmp_path / "b_to_a.json.gz")
+    assert applied and skipped == 0 and header['ack'] > 0
+    # A's invoice is not sent back, and A keeps its own stock
+    assert a.execute("SELECT COUNT(*) FROM invoices").fetchone() == (1,)
+    assert a.execute("SELECT stock, selling_price FROM products WHERE sku = '100'").fetchone() == (6, 900)
+    # Nothing A imported is logged again, and the acknowledged changes are pruned
+    assert a.execute("SELECT COUNT(*) FROM change_log").fetchone() == (0,)
+
+    path = tmp_path / "again.json.gz"
+    assert sync.export_changes(a, sync.shop_id(b), str(path))['records'] == 0
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+
+def test_dollar_files_are_refused(shops, tmp_path):
+    a, b = shops
+    path = tmp_path / "old.json.gz"
+    sync.export_changes(a, sync.shop_id(b), str(path))
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        lines = f.readlines()
+    header = json.loads(lines[0])
+    del header['money']
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header) + "\n" + "".join(lines[1:]))
+    with pytest.raises(ValueError):
+        sync.import_changes(b, str(path))
+    assert b.execute("SELECT COUNT(*) FROM products").fetchone() == (0,)